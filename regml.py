@@ -5,9 +5,22 @@
 from __future__ import print_function
 
 import glob
-import json
+import multiprocessing
 import os
 import sys
+import threading
+from timeit import default_timer
+import traceback
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
 
 import click
 from lxml import etree
@@ -15,28 +28,29 @@ from termcolor import colored, cprint
 from itertools import permutations
 
 from regulation.validation import EregsValidator
+from regulation import inflection
 import regulation.settings as settings
-from regulation.diff import diff_files
+from regulation.diff import DiffVersion, diff_versions
+from regulation.header import HeaderIndex
+from regulation.manifest import JSONManifest, file_digest
+from regulation.output import compressed_path, write_json
+from regulation.archive import (ARCHIVE_DIR, JSONArchive, JSONArchiveWriter,
+                                json_layout, member_name)
 
 from regulation.tree import (
-    build_analysis,
-    build_external_citations_layer,
-    build_formatting_layer,
-    build_graphics_layer,
+    FormattedContentCache,
+    LayerPipeline,
     build_internal_citations_layer,
-    build_interp_layer,
-    build_keyterm_layer,
-    build_meta_layer,
-    build_notice,
-    build_paragraph_marker_layer,
     build_reg_tree,
-    build_terms_layer,
-    build_toc_layer
+    build_terms_layer
 )
 from regulation.changes import (
+    generate_changeset,
     process_changes,
     process_analysis,
-    generate_diff,
+    freeze_reg_tree,
+    generate_diff_pair,
+    index_frozen_tree,
     rectify_analysis
 )
 
@@ -108,6 +122,11 @@ def find_all(part, is_notice=False):
     return files
 
 
+def header_index():
+    """ The index of the headers of RegML files """
+    return HeaderIndex(getattr(settings, 'HEADER_INDEX_FILE', None))
+
+
 def find_version(part, notice, is_notice=False):
     """ Wrap find file in a semantic sort of way to find a RegML version
         of a particular part """
@@ -115,17 +134,76 @@ def find_version(part, notice, is_notice=False):
 
 
 def write_layer(layer_object, reg_number, notice, layer_type,
-                diff_notice=None):
-    """ Write a layer. """
+                diff_notice=None, compact=False, archive=None):
+    """ Write a layer, to its own file or to the given version archive.
+        Compact layers have no whitespace. """
+    if archive is not None:
+        print("writing", member_name(layer_type, reg_number, notice,
+                                     diff_notice=diff_notice),
+              "to", archive.path)
+        archive.write(layer_object, layer_type, reg_number, notice,
+                      diff_notice=diff_notice)
+        return
+
     layer_path = os.path.join(settings.JSON_ROOT, layer_type, reg_number)
     if diff_notice is not None:
         layer_path = os.path.join(layer_path, diff_notice)
     if not os.path.exists(layer_path):
-        os.makedirs(layer_path)
+        try:
+            os.makedirs(layer_path)
+        except OSError:
+            # Another process building a version in parallel may have
+            # created it in the meantime
+            if not os.path.isdir(layer_path):
+                raise
     layer_file = os.path.join(layer_path, notice)
-    print("writing", layer_file)
-    json.dump(layer_object, open(layer_file, 'w'), indent=4,
-              separators=(',', ':'))
+    compression = getattr(settings, 'JSON_COMPRESSION', None)
+    print("writing", compressed_path(layer_file, compression))
+    write_json(layer_object, layer_file, compact=compact,
+               compression=compression)
+
+
+class TreeWriter(object):
+    """ Write XML trees to files on a background thread, in the order
+        they're given. Trees are serialized when they're given to the
+        writer, so lxml is only ever used from the calling thread. """
+
+    def __init__(self):
+        self.queue = Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            path, xml_string = item
+            if self.error is not None:
+                continue
+            try:
+                with open(path, 'w') as f:
+                    f.write(xml_string)
+            except Exception as e:
+                self.error = e
+
+    def write(self, path, xml_tree):
+        if self.error is not None:
+            raise self.error
+        xml_string = etree.tostring(xml_tree,
+                                    pretty_print=True,
+                                    xml_declaration=True,
+                                    encoding='UTF-8')
+        self.queue.put((path, xml_string))
+
+    def close(self):
+        """ Wait for everything to be written """
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
 
 
 def get_validator(xml_tree, raise_instead_of_exiting=False):
@@ -144,7 +222,7 @@ def get_validator(xml_tree, raise_instead_of_exiting=False):
     return validator
 
 
-def generate_json(regulation_file, check_terms=False):
+def generate_json(regulation_file, check_terms=False, compact=False):
     with open(find_file(regulation_file), 'r') as f:
         reg_xml = f.read()
     parser = etree.XMLParser(huge_tree=True)
@@ -153,33 +231,28 @@ def generate_json(regulation_file, check_terms=False):
     # Validate the file relative to schema
     validator = get_validator(xml_tree)
 
-    reg_tree = build_reg_tree(xml_tree)
+    # Formatted paragraph content is shared by the tree and the layers
+    formatted_cache = FormattedContentCache()
+
+    reg_tree = build_reg_tree(xml_tree, cache=formatted_cache)
     reg_number = reg_tree.label[0]
 
-    paragraph_markers = build_paragraph_marker_layer(xml_tree)
-    internal_citations = build_internal_citations_layer(xml_tree)
-    external_citations = build_external_citations_layer(xml_tree)
-    terms = build_terms_layer(xml_tree)
-    meta = build_meta_layer(xml_tree)
-    toc = build_toc_layer(xml_tree)
-    keyterms = build_keyterm_layer(xml_tree)
-    graphics = build_graphics_layer(xml_tree)
-    formatting = build_formatting_layer(xml_tree)
-    interps = build_interp_layer(xml_tree)
-    analysis = build_analysis(xml_tree)
-    notice_dict = build_notice(xml_tree)
+    layers = LayerPipeline().run(xml_tree, cache=formatted_cache)
 
     # if the validator had problems then we should report them and bail out
 
+    terms = layers['layer/terms']
     validator.validate_terms(xml_tree, terms)
-    validator.validate_internal_cites(xml_tree, internal_citations)
+    validator.validate_internal_cites(xml_tree,
+                                      layers['layer/internal-citations'])
     if check_terms:
         validator.validate_term_references(xml_tree, terms, regulation_file)
     for event in validator.events:
         print(str(event))
+    inflection.save()
 
+    # The tree is written to JSON as it's encoded
     reg_tree.include_children = True
-    reg_json = reg_tree.to_json()
 
     notice = xml_tree.find('.//{eregs}documentNumber').text
     version = os.path.split(regulation_file)[-1].replace('.xml', '')
@@ -188,26 +261,83 @@ def generate_json(regulation_file, check_terms=False):
               'using version'.format(notice, version))
         notice = version
 
-    write_layer(reg_json, reg_number, notice, 'regulation')
-    write_layer(meta, reg_number, notice, 'layer/meta')
-    write_layer(paragraph_markers, reg_number, notice,
-                'layer/paragraph-markers')
-    write_layer(internal_citations, reg_number, notice,
-                'layer/internal-citations')
-    write_layer(external_citations, reg_number, notice,
-                'layer/external-citations')
-    write_layer(terms, reg_number, notice, 'layer/terms')
-    write_layer(toc, reg_number, notice, 'layer/toc')
-    write_layer(keyterms, reg_number, notice, 'layer/keyterms')
-    write_layer(graphics, reg_number, notice, 'layer/graphics')
-    write_layer(formatting, reg_number, notice, 'layer/formatting')
-    write_layer(interps, reg_number, notice, 'layer/interpretations')
-    write_layer(analysis, reg_number, notice, 'layer/analyses')
-    write_layer(notice_dict, reg_number, notice, 'notice')
+    def write_layers(archive=None):
+        write_layer(reg_tree, reg_number, notice, 'regulation',
+                    compact=compact, archive=archive)
+        for layer_type, layer in layers.items():
+            write_layer(layer, reg_number, notice, layer_type,
+                        compact=compact, archive=archive)
+
+    if json_layout() == 'archive':
+        with JSONArchiveWriter.for_version(reg_number, notice,
+                                           compact=compact) as archive:
+            write_layers(archive)
+    else:
+        write_layers()
 
     return reg_number, notice, xml_tree
 
 
+def generate_json_job(args):
+    """ Run generate_json in a worker process. Output is captured so
+        that it can be printed in order by the parent process, and exits
+        and errors are returned rather than raised. """
+    regulation_file, check_terms, compact = args
+
+    stdout = sys.stdout
+    output = StringIO()
+    sys.stdout = output
+    try:
+        reg_number, notice, xml_tree = generate_json(
+            regulation_file, check_terms=check_terms, compact=compact)
+        return output.getvalue(), (reg_number, notice), None
+    except SystemExit as e:
+        return output.getvalue(), None, e.code
+    except Exception:
+        output.write(traceback.format_exc())
+        return output.getvalue(), None, 1
+    finally:
+        sys.stdout = stdout
+
+
+# The frozen version trees and their indexes, for generate_diff_job in a
+# worker process
+diff_job_trees = {}
+diff_job_nodes = {}
+
+
+def init_xml_diff_job(versions):
+    """ Give an XML diff worker process every prepared version """
+    global xml_diff_job_versions
+    xml_diff_job_versions = versions
+
+
+def generate_xml_diff_job(files):
+    """ Generate the XML diff between two versions in a worker process """
+    left_file, right_file = files
+    tree, left_version, right_version = diff_versions(
+        xml_diff_job_versions[left_file], xml_diff_job_versions[right_file])
+    return left_version, right_version, etree.tostring(
+        tree, pretty_print=True, xml_declaration=True, encoding='UTF-8')
+
+
+def init_diff_job(frozen_trees, frozen_nodes):
+    """ Give a diff worker process the frozen trees of every version """
+    global diff_job_trees, diff_job_nodes
+    diff_job_trees = frozen_trees
+    diff_job_nodes = frozen_nodes
+
+
+def generate_diff_job(versions):
+    """ Generate the diffs both ways between two versions in a worker
+        process """
+    left_version, right_version = versions
+    return generate_diff_pair(diff_job_trees[left_version],
+                              diff_job_trees[right_version],
+                              diff_job_nodes[left_version],
+                              diff_job_nodes[right_version])
+
+
 # Main CLI Commands ####################################################
 
 # Create a general CLI that can take additional commands
@@ -251,6 +381,7 @@ def validate(file, no_terms=False, no_citations=False, no_keyterms=False):
 
         for event in validator.events:
             print(str(event))
+        inflection.save()
 
     # Validate notice-specific documents
     if xml_tree.tag == '{eregs}notice':
@@ -303,6 +434,7 @@ def check_terms(file, label=None, term=None, with_notice=None):
     validator.validate_terms(reg_tree, terms)
     validator.validate_term_references(reg_tree, terms, file,
             label=label, term=term, notice=notice_tree)
+    inflection.save()
 
 
 @cli.command()
@@ -496,7 +628,17 @@ def fix_analysis(file, always_save=False):
 @click.argument('regulation_files', nargs=-1, required=True)
 @click.option('--check-terms', is_flag=True)
 @click.option('--skip_diffs', is_flag=True, help="Suppresses generation of diffs between versions.")
-def json_command(regulation_files, from_notices=[], check_terms=False, skip_diffs=False):
+@click.option('--jobs', default=1, type=int,
+              help="Number of versions to build in parallel.")
+@click.option('--diff-jobs', default=1, type=int,
+              help="Number of diffs to generate in parallel.")
+@click.option('--incremental', is_flag=True,
+              help="Only generate JSON for versions and diffs whose RegML "
+                   "has changed since it was last generated.")
+@click.option('--compact', is_flag=True,
+              help="Write JSON without indentation or whitespace.")
+def json_command(regulation_files, from_notices=[], check_terms=False, skip_diffs=False,
+                 jobs=1, diff_jobs=1, incremental=False, compact=False):
     """ Generate JSON from RegML files """
 
     # If the "file" is a directory, assume we want to operate on all the
@@ -506,14 +648,83 @@ def json_command(regulation_files, from_notices=[], check_terms=False, skip_diff
         regulation_files = [os.path.join(regulation_dir, f)
                             for f in os.listdir(regulation_dir)]
 
+    # Checking terms prompts for input, which can't be done from a
+    # worker process
+    if check_terms and jobs > 1:
+        print("--check-terms requires input, building versions one at a time.")
+        jobs = 1
+
     # Generate JSON for each version
     versions = {}
+    version_files = {}
     reg_number = None
+
+    # The manifest records what each version's JSON was generated from.
+    # When generating incrementally, versions whose RegML hasn't changed
+    # since their JSON was written, as compact or not, are skipped, and
+    # their trees are only loaded if they're needed for a diff.
+    manifest = JSONManifest.load(compact=compact)
+    digests = {}
+    files_to_build = []
     for file in regulation_files:
-        print("Building JSON for {}".format(file))
-        reg_number, notice, reg_xml_tree = generate_json(
-            file, check_terms=check_terms)
-        versions[notice] = reg_xml_tree
+        digests[file] = file_digest(find_file(file))
+        current = manifest.version(file, digests[file]) \
+            if incremental else None
+        if current is not None:
+            print("JSON for {} is up to date".format(file))
+            reg_number, notice = current
+            versions[notice] = None
+            version_files[notice] = file
+        else:
+            manifest.remove_version(file)
+            files_to_build.append(file)
+
+    # Forget the versions that are about to be rewritten, in case this
+    # run doesn't finish
+    manifest.save()
+
+    try:
+        if jobs > 1:
+            # Versions are built in worker processes. Results come back
+            # in the order of the files, and each version's output is
+            # printed as it would have been if it had been built here.
+            pool = multiprocessing.Pool(jobs)
+            results = pool.imap(generate_json_job,
+                                [(file, check_terms, compact)
+                                 for file in files_to_build])
+            try:
+                for i, (output, result, exit_code) in enumerate(results):
+                    file = files_to_build[i]
+                    print("Building JSON for {}".format(file))
+                    sys.stdout.write(output)
+                    if result is None:
+                        sys.exit(exit_code)
+
+                    # The parsed trees can't be sent back from the
+                    # workers, so they're parsed again if they're needed
+                    # for the diffs
+                    reg_number, notice = result
+                    versions[notice] = None
+                    version_files[notice] = file
+                    manifest.add_version(file, digests[file],
+                                         reg_number, notice)
+            except BaseException:
+                pool.terminate()
+                raise
+            else:
+                pool.close()
+            finally:
+                pool.join()
+        else:
+            for file in files_to_build:
+                print("Building JSON for {}".format(file))
+                reg_number, notice, reg_xml_tree = generate_json(
+                    file, check_terms=check_terms, compact=compact)
+                versions[notice] = reg_xml_tree
+                version_files[notice] = file
+                manifest.add_version(file, digests[file], reg_number, notice)
+    finally:
+        manifest.save()
 
     # Generate diff JSON between each version
     # now build diffs - include "empty" diffs comparing a version to itself
@@ -522,11 +733,113 @@ def json_command(regulation_files, from_notices=[], check_terms=False, skip_diff
         print(colored("WARNING: This may take an extended period of time.",
               'red', attrs=['bold']))
         print("To skip diff creation, use the --skip_diffs command line argument.\n")
-        for left_version, left_tree in versions.items():
-            for right_version, right_tree in versions.items():
-                diff = generate_diff(left_tree, right_tree)
+
+        versions_to_diff = [(left_version, right_version)
+                            for left_version in versions
+                            for right_version in versions]
+
+        def version_digest(version):
+            return digests[version_files[version]]
+
+        versions_to_write = []
+        for left_version, right_version in versions_to_diff:
+            if incremental and manifest.diff_is_current(
+                    reg_number, left_version, right_version,
+                    version_digest(left_version),
+                    version_digest(right_version)):
+                continue
+            manifest.remove_diff(reg_number, left_version, right_version)
+            versions_to_write.append((left_version, right_version))
+        if len(versions_to_write) < len(versions_to_diff):
+            print("{} of {} diffs are up to date\n".format(
+                len(versions_to_diff) - len(versions_to_write),
+                len(versions_to_diff)))
+        manifest.save()
+
+        # A version's diff with itself is always empty, and the diff from
+        # B to A comes along with the diff from A to B, so only one pair
+        # of diffs has to be generated for each pair of versions.
+        versions_to_generate = []
+        versions_generated = set()
+        for left_version, right_version in versions_to_write:
+            if left_version != right_version and \
+                    (right_version, left_version) not in versions_generated:
+                versions_to_generate.append((left_version, right_version))
+                versions_generated.add((left_version, right_version))
+
+        # Build the tree to diff for each version just once, and only
+        # for the versions that have diffs to generate
+        frozen_trees = {}
+        for versions_pair in versions_to_generate:
+            for version in versions_pair:
+                if version in frozen_trees:
+                    continue
+                if versions[version] is None:
+                    with open(find_file(version_files[version]), 'r') as f:
+                        reg_xml = f.read()
+                    parser = etree.XMLParser(huge_tree=True)
+                    versions[version] = etree.fromstring(reg_xml, parser)
+                frozen_trees[version] = freeze_reg_tree(versions[version])
+        frozen_nodes = dict((version, index_frozen_tree(tree))
+                            for version, tree in frozen_trees.items())
+
+        if diff_jobs > 1:
+            # Diffs are generated in worker processes and written here
+            # in order.
+            pool = multiprocessing.Pool(diff_jobs, initializer=init_diff_job,
+                                        initargs=(frozen_trees, frozen_nodes))
+            diff_pairs = pool.imap(generate_diff_job, versions_to_generate)
+        else:
+            pool = None
+            diff_pairs = (generate_diff_pair(frozen_trees[left_version],
+                                             frozen_trees[right_version],
+                                             frozen_nodes[left_version],
+                                             frozen_nodes[right_version])
+                          for left_version, right_version
+                          in versions_to_generate)
+
+        # In the archive layout, the diffs to each version are written to
+        # its archive
+        diff_archives = {}
+
+        try:
+            reverse_diffs = {}
+            for left_version, right_version in versions_to_write:
+                if left_version == right_version:
+                    diff = {}
+                elif (left_version, right_version) in reverse_diffs:
+                    diff = reverse_diffs.pop((left_version, right_version))
+                else:
+                    diff, reverse_diff = next(diff_pairs)
+                    reverse_diffs[(right_version, left_version)] = reverse_diff
+                archive = None
+                if json_layout() == 'archive':
+                    if right_version not in diff_archives:
+                        diff_archives[right_version] = \
+                            JSONArchiveWriter.for_version(
+                                reg_number, right_version, compact=compact)
+                    archive = diff_archives[right_version]
                 write_layer(diff, reg_number, right_version, 'diff',
-                            diff_notice=left_version)
+                            diff_notice=left_version, compact=compact,
+                            archive=archive)
+                manifest.add_diff(reg_number, left_version, right_version,
+                                  version_digest(left_version),
+                                  version_digest(right_version))
+        except BaseException:
+            if pool is not None:
+                pool.terminate()
+            for archive in diff_archives.values():
+                archive.abort()
+            raise
+        else:
+            if pool is not None:
+                pool.close()
+            for archive in diff_archives.values():
+                archive.close()
+        finally:
+            if pool is not None:
+                pool.join()
+            manifest.save()
 
 
 # Given a regulation title and part number, prompts the user to select
@@ -546,24 +859,30 @@ def json_command(regulation_files, from_notices=[], check_terms=False, skip_diff
               help="Suppresses generation of diffs between versions.")
 @click.option('--suppress_output', is_flag=True,
               help="Suppresses output except for errors")
+@click.option('--jobs', default=1, type=int,
+              help="Number of versions to build in parallel.")
+@click.option('--diff-jobs', default=1, type=int,
+              help="Number of diffs to generate in parallel.")
+@click.option('--force', is_flag=True,
+              help="Regenerates JSON for all versions and diffs, even "
+                   "those whose RegML hasn't changed.")
+@click.option('--compact', is_flag=True,
+              help="Write JSON without indentation or whitespace.")
 @click.pass_context
-def json_through(ctx, cfr_title, cfr_part, start=None, through=None, suppress_output=False, skip_diffs=False):
+def json_through(ctx, cfr_title, cfr_part, start=None, through=None, suppress_output=False, skip_diffs=False,
+                 jobs=1, diff_jobs=1, force=False, compact=False):
     # Get list of available regs
     regml_reg_files = find_all(cfr_part)
 
     regml_regs = []
     regulation_files = []
+    headers = header_index()
     for reg_file in regml_reg_files:
         file_name = os.path.join(reg_file)
-        with open(file_name, 'r') as f:
-            reg_xml = f.read()
-        parser = etree.XMLParser(huge_tree=True)
-        xml_tree = etree.fromstring(reg_xml, parser)
-        doc_number = xml_tree.find(
-            './{eregs}preamble/{eregs}documentNumber').text
-        effective_date = xml_tree.find(
-            './{eregs}preamble/{eregs}effectiveDate').text
-        regml_regs.append((doc_number, effective_date, file_name))
+        header = headers.get(file_name)
+        regml_regs.append((header.document_number, header.effective_date,
+                           file_name))
+    headers.save()
 
     regml_regs.sort(key=lambda n: n[1])
     regulation_files = [r[2] for r in regml_regs]
@@ -649,7 +968,11 @@ def json_through(ctx, cfr_title, cfr_part, start=None, through=None, suppress_ou
         # reuse the existing json structure
         ctx.invoke(json_command,
                    regulation_files=regulation_files[first_ver_idx:last_ver_idx+1],
-                   skip_diffs=skip_diffs)
+                   skip_diffs=skip_diffs,
+                   jobs=jobs,
+                   diff_jobs=diff_jobs,
+                   incremental=not force,
+                   compact=compact)
 
     else:
         print(colored("\nApplying JSON through {0[0]}{1}\n".format(
@@ -662,7 +985,32 @@ def json_through(ctx, cfr_title, cfr_part, start=None, through=None, suppress_ou
         # json_command(regulation_files[:last_ver_idx+1], skip_diffs=skip_diffs)
         ctx.invoke(json_command,
                    regulation_files=regulation_files[:last_ver_idx+1],
-                   skip_diffs=skip_diffs)
+                   skip_diffs=skip_diffs,
+                   jobs=jobs,
+                   diff_jobs=diff_jobs,
+                   incremental=not force,
+                   compact=compact)
+
+
+# Write the JSON in a regulation's version archives to a file for each
+# layer, as it would have been written without archives.
+@cli.command('explode-archive')
+@click.argument('reg_number')
+@click.argument('notices', nargs=-1)
+def explode_archive(reg_number, notices):
+    """ Write archived JSON to a file for each layer """
+    if not notices:
+        archive_dir = os.path.join(settings.JSON_ROOT, ARCHIVE_DIR,
+                                   reg_number)
+        notices = sorted(f[:-len('.zip')] for f in os.listdir(archive_dir)
+                         if f.endswith('.zip'))
+
+    compression = getattr(settings, 'JSON_COMPRESSION', None)
+    for notice in notices:
+        with JSONArchive.for_version(reg_number, notice) as archive:
+            print("exploding", archive.path)
+            for path in archive.explode(compression=compression):
+                print("writing", path)
 
 
 # Given a notice, apply it to a previous RegML regulation verson to
@@ -710,6 +1058,23 @@ def apply_notice(regulation_file, notice_file):
         f.write(new_xml_string)
 
 
+# Given two RegML regulation versions, generate the notice changeset that
+# changes the first into the second.
+@cli.command('generate-changeset')
+@click.argument('left_file')
+@click.argument('right_file')
+def generate_changeset_command(left_file, right_file):
+    """ Generate the changeset between two versions """
+    parser = etree.XMLParser(huge_tree=True)
+    with open(find_file(left_file), 'r') as f:
+        left_xml_tree = etree.fromstring(f.read(), parser)
+    with open(find_file(right_file), 'r') as f:
+        right_xml_tree = etree.fromstring(f.read(), parser)
+
+    changeset = generate_changeset(left_xml_tree, right_xml_tree)
+    print(etree.tostring(changeset, pretty_print=True, encoding='UTF-8'))
+
+
 # Given a regulation part number, iterate over all existing *regulations* (not notices)
 # and write out the XML files representing the diffs.
 @cli.command('generate-diff-xml')
@@ -717,7 +1082,9 @@ def apply_notice(regulation_file, notice_file):
 @click.option('--versions',
               help="If provided, supplies the list of regulations from which to generate diffs",
               multiple=True)
-def generate_diff_xml(cfr_part, versions=None):
+@click.option('--jobs', default=1, type=int,
+              help="Number of diffs to generate in parallel.")
+def generate_diff_xml(cfr_part, versions=None, jobs=1):
 
     def version(regml_file):
         return os.path.split(regml_file)[-1].replace('.xml', '')
@@ -727,22 +1094,51 @@ def generate_diff_xml(cfr_part, versions=None):
     else:
         regml_files = find_all(cfr_part)
 
-    import time
-
     diff_base = os.path.join(settings.XML_ROOT, 'diff', cfr_part)
     if not os.path.exists(diff_base):
         os.mkdir(diff_base)
 
-    start_time = time.clock()
-    for pair in permutations(regml_files, 2):
-        tree, left_version, right_version = diff_files(pair[0], pair[1])
-        diff_path = os.path.join(diff_base, '{}:{}.xml'.format(left_version, right_version))
-        with open(diff_path, 'w') as f:
-            print('Writing diff from {} to {} to {}'.format(left_version, right_version, diff_path))
-            f.write(etree.tostring(tree, pretty_print=True, xml_declaration=True, encoding='UTF-8'))
-    end_time = time.clock()
+    start_time = default_timer()
+
+    # Each version is read and prepared once, rather than once for every
+    # diff it's in
+    prepared_versions = dict((regml_file, DiffVersion(regml_file))
+                             for regml_file in regml_files)
+    pairs = list(permutations(regml_files, 2))
+
+    if jobs > 1:
+        # Diffs are generated in worker processes and written here in
+        # order.
+        pool = multiprocessing.Pool(jobs, initializer=init_xml_diff_job,
+                                    initargs=(prepared_versions,))
+        diffs = pool.imap(generate_xml_diff_job, pairs)
+    else:
+        pool = None
+        init_xml_diff_job(prepared_versions)
+        diffs = (generate_xml_diff_job(pair) for pair in pairs)
+
+    try:
+        for i, (left_version, right_version, diff_xml) in enumerate(diffs):
+            diff_path = os.path.join(diff_base, '{}:{}.xml'.format(left_version, right_version))
+            with open(diff_path, 'w') as f:
+                print('Writing diff {} of {} from {} to {} to {}'.format(
+                    i + 1, len(pairs), left_version, right_version, diff_path))
+                f.write(diff_xml)
+    except BaseException:
+        if pool is not None:
+            pool.terminate()
+        raise
+    else:
+        if pool is not None:
+            pool.close()
+    finally:
+        if pool is not None:
+            pool.join()
+
+    end_time = default_timer()
     print('Diff calculation for part {} took {} minutes'.format(cfr_part, (end_time - start_time) / 60.0))
 
+
 # Given a regulation title and part number, prompts the user to select
 # which notice to stop at and applies all notices applicable to the reg
 @cli.command('apply-through')
@@ -766,25 +1162,20 @@ def apply_through(cfr_title, cfr_part, start=None, through=None,
     regml_notice_files = find_all(cfr_part, is_notice=True)
 
     regml_notices = []
+    headers = header_index()
     for notice_file in regml_notice_files:
         file_name = os.path.join(notice_file)
-        with open(file_name, 'r') as f:
-            notice_xml = f.read()
-        parser = etree.XMLParser(huge_tree=True)
 
         try:
-            xml_tree = etree.fromstring(notice_xml, parser)
+            header = headers.get(file_name)
         except etree.XMLSyntaxError as e:
             print(colored('Syntax error in {}'.format(notice_file), 'red'))
             print(e)
             return
 
-        doc_number = xml_tree.find(
-            './{eregs}preamble/{eregs}documentNumber').text
-        effective_date = xml_tree.find(
-            './{eregs}preamble/{eregs}effectiveDate').text
-        applies_to = xml_tree.find(
-            './{eregs}changeset').get('leftDocumentNumber')
+        doc_number = header.document_number
+        effective_date = header.effective_date
+        applies_to = header.left_document_number
         if applies_to is None:
             # Major problem here
             print(colored("Error locating"),
@@ -795,6 +1186,7 @@ def apply_through(cfr_title, cfr_part, start=None, through=None,
             return
 
         regml_notices.append((doc_number, effective_date, applies_to, file_name))
+    headers.save()
 
     if cfr_part in settings.CUSTOM_NOTICE_ORDER:
         order = settings.CUSTOM_NOTICE_ORDER[cfr_part]
@@ -877,102 +1269,114 @@ def apply_through(cfr_title, cfr_part, start=None, through=None,
     parser = etree.XMLParser(huge_tree=True)
     left_xml_tree = etree.fromstring(left_reg_xml, parser)
 
-    kk = 1
-    prev_tree = left_xml_tree
-    for notice in regml_notices[:last_ver_idx+1]:
-        doc_number, effective_date, prev_notice, file_name = notice
-
-        print("[{}] Applying notice {} from {} to version {}".format(kk,
-                                                                     doc_number,
-                                                                     file_name,
-                                                                     prev_notice))
-
-        # Open the notice file
-        notice_file = find_file(file_name, is_notice=True)
-        with open(notice_file, 'r') as f:
-            notice_string = f.read()
-        parser = etree.XMLParser(huge_tree=True)
-
-        notice_xml = etree.fromstring(notice_string, parser)
-
-        # TODO: Validate labels for json-compliance?
-        # Example: JSON fails on upload only for interpParagraphs without "Interp" in them
-
-        # Validate the files
-        regulation_validator = get_validator(prev_tree)
-        terms_layer = build_terms_layer(prev_tree)
-
-        try:
-            notice_validator = get_validator(notice_xml, raise_instead_of_exiting=True)
-        except Exception as e:
-            print("[{}]".format(kk),
-                  colored("Exception occurred in notice", 'red'),
-                  colored(doc_number, attrs=['bold']),
-                  colored("; details are below. ", 'red'),
-                  "To retry this single notice, use:\n\n",
-                  colored("> ./regml.py apply-notice {0}/{1} {0}/{2}\n".format(cfr_part,
-                                                                               prev_notice,
-                                                                               doc_number),
-                          attrs=['bold']))
-            sys.exit(0)
-
-        # validate the notice XML with the layers derived from the
-        # tree of the previous version
-        reload_notice = False
-        skip_notices = list(skip_fix_notices)
-
-        if skip_fix_notices_through is not None:
-            if skip_fix_notices_through in possible_notices:
-                last_fix_idx = possible_notices.index(skip_fix_notices_through)
-                skip_notices.extend(possible_notices[:last_fix_idx + 1])
-
-        if fix_notices and doc_number not in skip_notices:
-            print('Fixing notice number {}:'.format(doc_number))
-            notice_validator.validate_terms(notice_xml, terms_layer)
-            notice_validator.validate_term_references(notice_xml, terms_layer, notice_file)
-            notice_terms_layer = build_terms_layer(notice_xml)
-            notice_validator.validate_term_references(notice_xml, notice_terms_layer, notice_file)
-            notice_validator.fix_omitted_cites(notice_xml, notice_file)
-            reload_notice = True
-
-        # at this point the file has possibly changed, so we should really reload it
-        if reload_notice:
+    # Each version is written on a background thread while the next
+    # notice is applied
+    writer = TreeWriter()
+    applied = False
+    try:
+        kk = 1
+        prev_tree = left_xml_tree
+        for notice in regml_notices[:last_ver_idx+1]:
+            doc_number, effective_date, prev_notice, file_name = notice
+
+            print("[{}] Applying notice {} from {} to version {}".format(kk,
+                                                                         doc_number,
+                                                                         file_name,
+                                                                         prev_notice))
+
+            # Open the notice file
+            notice_file = find_file(file_name, is_notice=True)
             with open(notice_file, 'r') as f:
                 notice_string = f.read()
             parser = etree.XMLParser(huge_tree=True)
 
             notice_xml = etree.fromstring(notice_string, parser)
 
-        # Process the notice changeset
-        try:
-            new_xml_tree = process_changes(prev_tree, notice_xml)
-        except Exception as e:
-            print("[{}]".format(kk),
-                  colored("Exception occurred; details are below. ".format(kk), 'red'),
-                  "To retry this single notice, use:\n\n",
-                  colored("> ./regml.py apply-notice {0}/{1} {0}/{2}\n".format(cfr_part,
-                                                                               prev_notice,
-                                                                               doc_number),
-                          attrs=['bold']))
-            raise e
-
-        # Add in any new analysis
-        new_xml_tree = process_analysis(new_xml_tree, notice_xml)
-
-        # Write the new xml tree
-        new_xml_string = etree.tostring(new_xml_tree,
-                                        pretty_print=True,
-                                        xml_declaration=True,
-                                        encoding='UTF-8')
-        new_path = os.path.join(
-            os.path.dirname(regulation_file),
-            os.path.basename(notice_file))
-        with open(new_path, 'w') as f:
+            # TODO: Validate labels for json-compliance?
+            # Example: JSON fails on upload only for interpParagraphs without "Interp" in them
+
+            # Validate the files
+            regulation_validator = get_validator(prev_tree)
+
+            try:
+                notice_validator = get_validator(notice_xml, raise_instead_of_exiting=True)
+            except Exception as e:
+                print("[{}]".format(kk),
+                      colored("Exception occurred in notice", 'red'),
+                      colored(doc_number, attrs=['bold']),
+                      colored("; details are below. ", 'red'),
+                      "To retry this single notice, use:\n\n",
+                      colored("> ./regml.py apply-notice {0}/{1} {0}/{2}\n".format(cfr_part,
+                                                                                   prev_notice,
+                                                                                   doc_number),
+                              attrs=['bold']))
+                sys.exit(0)
+
+            # validate the notice XML with the layers derived from the
+            # tree of the previous version
+            skip_notices = list(skip_fix_notices)
+
+            if skip_fix_notices_through is not None:
+                if skip_fix_notices_through in possible_notices:
+                    last_fix_idx = possible_notices.index(skip_fix_notices_through)
+                    skip_notices.extend(possible_notices[:last_fix_idx + 1])
+
+            if fix_notices and doc_number not in skip_notices:
+                print('Fixing notice number {}:'.format(doc_number))
+                terms_layer = build_terms_layer(prev_tree)
+                notice_validator.validate_terms(notice_xml, terms_layer)
+                saved = notice_validator.validate_term_references(notice_xml, terms_layer, notice_file)
+                notice_terms_layer = build_terms_layer(notice_xml)
+                saved = notice_validator.validate_term_references(notice_xml, notice_terms_layer, notice_file) or saved
+                saved = notice_validator.fix_omitted_cites(notice_xml, notice_file) or saved
+
+                # at this point the file has possibly changed, so we
+                # should really reload it. Fixes that weren't saved are
+                # discarded by parsing the original notice again.
+                if saved:
+                    with open(notice_file, 'r') as f:
+                        notice_string = f.read()
+                parser = etree.XMLParser(huge_tree=True)
+
+                notice_xml = etree.fromstring(notice_string, parser)
+
+            # Process the notice changeset
+            try:
+                new_xml_tree = process_changes(prev_tree, notice_xml)
+            except Exception as e:
+                print("[{}]".format(kk),
+                      colored("Exception occurred; details are below. ".format(kk), 'red'),
+                      "To retry this single notice, use:\n\n",
+                      colored("> ./regml.py apply-notice {0}/{1} {0}/{2}\n".format(cfr_part,
+                                                                                   prev_notice,
+                                                                                   doc_number),
+                              attrs=['bold']))
+                raise e
+
+            # Add in any new analysis
+            new_xml_tree = process_analysis(new_xml_tree, notice_xml)
+
+            # Write the new xml tree
+            new_path = os.path.join(
+                os.path.dirname(regulation_file),
+                os.path.basename(notice_file))
             print("[{}] Writing regulation to {}".format(kk, new_path))
-            f.write(new_xml_string)
-
-        prev_tree = new_xml_tree
-        kk += 1
+            writer.write(new_path, new_xml_tree)
+
+            prev_tree = new_xml_tree
+            kk += 1
+        applied = True
+    finally:
+        if applied:
+            writer.close()
+        else:
+            # The versions given to the writer are still written, but an
+            # error writing them mustn't hide the error that stopped
+            # the notices being applied
+            try:
+                writer.close()
+            except Exception:
+                pass
 
 
 # Given a notice, apply it to a previous RegML regulation verson to
@@ -1069,18 +1473,11 @@ def versions(title, part, from_fr=False, from_regml=True):
     regml_notice_files = find_all(part, is_notice=True)
     print(colored("RegML Notices are available for:", attrs=['bold']))
     regml_notices = []
+    headers = header_index()
     for notice_file in regml_notice_files:
-        with open(os.path.join(notice_file), 'r') as f:
-            notice_xml = f.read()
-        parser = etree.XMLParser(huge_tree=True)
-        xml_tree = etree.fromstring(notice_xml, parser)
-        doc_number = xml_tree.find(
-            './{eregs}preamble/{eregs}documentNumber').text
-        effective_date = xml_tree.find(
-            './{eregs}preamble/{eregs}effectiveDate').text
-        applies_to = xml_tree.find(
-            './{eregs}changeset').get('leftDocumentNumber')
-        regml_notices.append((doc_number, effective_date, applies_to))
+        header = headers.get(os.path.join(notice_file))
+        regml_notices.append(tuple(header))
+    headers.save()
 
     regml_notices.sort(key=lambda n: n[1])
     for notice in regml_notices:
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import json
+import os
+import zipfile
+
+import regulation.settings as settings
+from regulation.output import encode_json, write_json_bytes
+
+
+# The directory within JSON_ROOT that archives are kept in
+ARCHIVE_DIR = 'archive'
+
+# The layouts JSON can be written in: a file for each layer of each
+# version, or an archive for each version
+JSON_LAYOUTS = ('files', 'archive')
+
+# Archive members all have the same time, so that the same JSON is
+# always archived the same way
+MEMBER_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+
+def json_layout():
+    """ The layout JSON is written in, from the JSON_LAYOUT setting """
+    layout = getattr(settings, 'JSON_LAYOUT', None) or 'files'
+    if layout not in JSON_LAYOUTS:
+        raise ValueError('Unknown JSON layout {}'.format(layout))
+    return layout
+
+
+def archive_path(reg_number, notice, json_root=None):
+    """ The path of the archive for a version of a regulation """
+    if json_root is None:
+        json_root = settings.JSON_ROOT
+    return os.path.join(json_root, ARCHIVE_DIR, reg_number,
+                        notice + '.zip')
+
+
+def member_name(layer_type, reg_number, notice, diff_notice=None):
+    """ The name of a layer within an archive, which is its path within
+        JSON_ROOT when it's written to its own file """
+    parts = [layer_type, reg_number]
+    if diff_notice is not None:
+        parts.append(diff_notice)
+    parts.append(notice)
+    return '/'.join(parts)
+
+
+class JSONArchive(object):
+    """ An archive of the JSON for a version of a regulation: its tree,
+        its layers, and the diffs to it from other versions. Each is kept
+        under its member_name(). """
+
+    def __init__(self, path):
+        self.path = path
+        self.zipfile = zipfile.ZipFile(path, 'r')
+
+    @classmethod
+    def for_version(cls, reg_number, notice, json_root=None):
+        return cls(archive_path(reg_number, notice, json_root=json_root))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __contains__(self, name):
+        try:
+            self.zipfile.getinfo(name)
+        except KeyError:
+            return False
+        return True
+
+    def names(self):
+        return self.zipfile.namelist()
+
+    def read(self, name):
+        """ The encoded JSON of a member """
+        return self.zipfile.read(name)
+
+    def load(self, name, **kwargs):
+        """ Load the JSON of a member. Keyword arguments are passed to
+            json.loads. """
+        return json.loads(self.read(name).decode('utf-8'), **kwargs)
+
+    def load_layer(self, layer_type, reg_number, notice, diff_notice=None,
+                   **kwargs):
+        return self.load(member_name(layer_type, reg_number, notice,
+                                     diff_notice=diff_notice), **kwargs)
+
+    def explode(self, json_root=None, compression=None):
+        """ Write each member to its own file within json_root, as it
+            would have been written without an archive. Returns the paths
+            of the files. """
+        if json_root is None:
+            json_root = settings.JSON_ROOT
+        paths = []
+        for name in self.names():
+            path = os.path.join(json_root, *name.split('/'))
+            directory = os.path.dirname(path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            paths.append(write_json_bytes([self.read(name)], path,
+                                          compression=compression))
+        return paths
+
+    def close(self):
+        self.zipfile.close()
+
+
+class JSONArchiveWriter(object):
+    """ Write layers to the archive for a version of a regulation.
+
+        The archive is written to a temporary file that replaces it when
+        the writer is closed. Members of the previous archive that
+        weren't written again are kept. """
+
+    def __init__(self, path, compact=False):
+        self.path = path
+        self.compact = compact
+        self.temp_path = path + '.tmp'
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Another process may have created it in the meantime
+                if not os.path.isdir(directory):
+                    raise
+        self.zipfile = zipfile.ZipFile(self.temp_path, 'w',
+                                       zipfile.ZIP_DEFLATED)
+        self.written = set()
+
+    @classmethod
+    def for_version(cls, reg_number, notice, json_root=None, compact=False):
+        return cls(archive_path(reg_number, notice, json_root=json_root),
+                   compact=compact)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, layer_object, layer_type, reg_number, notice,
+              diff_notice=None):
+        """ Write a layer as JSON """
+        name = member_name(layer_type, reg_number, notice,
+                           diff_notice=diff_notice)
+        self.write_member(name, b''.join(
+            encode_json(layer_object, compact=self.compact)))
+
+    def write_member(self, name, data):
+        info = zipfile.ZipInfo(name, date_time=MEMBER_DATE_TIME)
+        info.compress_type = zipfile.ZIP_DEFLATED
+        info.external_attr = 0o644 << 16
+        self.zipfile.writestr(info, data)
+        self.written.add(name)
+
+    def close(self):
+        """ Keep the members of the previous archive that weren't written
+            again, and replace it """
+        try:
+            if os.path.isfile(self.path):
+                with JSONArchive(self.path) as previous:
+                    for name in previous.names():
+                        if name not in self.written:
+                            self.write_member(name, previous.read(name))
+            self.zipfile.close()
+            os.rename(self.temp_path, self.path)
+        except BaseException:
+            self.abort()
+            raise
+
+    def abort(self):
+        """ Leave the previous archive as it was """
+        self.zipfile.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
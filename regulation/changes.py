@@ -5,6 +5,7 @@ from __future__ import unicode_literals
 from copy import deepcopy
 import itertools
 import logging
+import re
 
 from lxml import etree
 
@@ -12,10 +13,16 @@ from lxml import etree
 # we're using in the RegML parser into a library both can share.
 from regparser.tree.paragraph import p_levels
 from regparser.tree.struct import FrozenNode
-from regparser.diff.tree import changes_between
+from regparser.diff.text import get_opcodes
+from regparser.diff.tree import changes_between, label_opcodes
 
 import string
 
+from regulation.fmes.fast_match import Delete, EditScript, Move, Update
+from regulation.node import LabelIndex
+from regulation.tree import build_reg_tree
+
+
 def roman_nums():
     """Generator for roman numerals."""
     mapping = [(1, 'i'), (4, 'iv'), (5, 'v'), (9, 'ix'),
@@ -45,13 +52,14 @@ p_levels = [
      for i in itertools.islice(roman_nums(), 0, 50)]
 ]
 
-from regulation.tree import build_reg_tree
-
-
 logger = logging.getLogger(__name__)
 
 TAGS_WITH_SUBCONTENT = ["{eregs}part", "{eregs}subpart"]
 
+# regulations-parser compares text and titles with every kind of whitespace
+# as a plain space
+WHITESPACE = re.compile(r'\s', re.UNICODE)
+
 
 def get_parent_label(label_parts):
     """ Determine the parent label for the given label part list. """
@@ -190,6 +198,10 @@ def process_changes(original_xml, original_notice_xml, dry=False):
     additions = list(sorted(additions, key=get_label, cmp=label_compare))
     movements = list(sorted(movements, key=get_label, cmp=label_compare))
 
+    # Index the labels in the new tree so we don't have to search the
+    # whole tree for every label a change refers to.
+    label_index = LabelIndex(new_xml)
+
     changes = itertools.chain(additions, movements, deletions, modifications, relabelings)
     for change in changes:
         label = change.get('label')
@@ -210,8 +222,7 @@ def process_changes(original_xml, original_notice_xml, dry=False):
             new_index = 0
 
             # First make sure the label doesn't already exist
-            matching_elm = new_xml.find('.//*[@label="{}"]'.format(label))
-            if matching_elm is not None:
+            if label in label_index:
                 raise KeyError("Label {} cannot be added because it "
                                "already exists. Was it added in another "
                                "change?".format(label))
@@ -219,7 +230,7 @@ def process_changes(original_xml, original_notice_xml, dry=False):
             # Get the parent of the added label
             if parent_label is None:
                 parent_label = '-'.join(get_parent_label(label_parts))
-            parent_elm = new_xml.find('.//*[@label="{}"]'.format(parent_label))
+            parent_elm = label_index.get(parent_label)
 
             if parent_elm is None:
                 raise TypeError("Label {} cannot be added because its parent "
@@ -239,14 +250,12 @@ def process_changes(original_xml, original_notice_xml, dry=False):
             # An explicit following-sibling was given
             if before_label is not None:
                 sibling_label = before_label
-                sibling_elm = new_xml.find('.//*[@label="{}"]'.format(
-                    before_label))
+                sibling_elm = label_index.get(before_label)
                 new_index = parent_elm.index(sibling_elm)
             # An explicit preceding-sibling was given
             elif after_label is not None:
                 sibling_label = after_label
-                sibling_elm = new_xml.find('.//*[@label="{}"]'.format(
-                    after_label))
+                sibling_elm = label_index.get(after_label)
                 try:
                     new_index = parent_elm.index(sibling_elm) + 1
                 except Exception as e:
@@ -261,8 +270,7 @@ def process_changes(original_xml, original_notice_xml, dry=False):
                 sibling_label_parts = get_sibling_label(label_parts)
                 if sibling_label_parts is not None:
                     sibling_label = '-'.join(sibling_label_parts)
-                    sibling_elm = new_xml.find(
-                        './/*[@label="{}"]'.format(sibling_label))
+                    sibling_elm = label_index.get(sibling_label)
                     try:
                         new_index = parent_elm.index(sibling_elm) + 1
                     except TypeError:
@@ -276,6 +284,7 @@ def process_changes(original_xml, original_notice_xml, dry=False):
             # Insert the new xml!
             if not dry:
                 parent_elm.insert(new_index, new_elm)
+                label_index.add(new_elm)
 
 
         # Handle existing elements
@@ -286,14 +295,14 @@ def process_changes(original_xml, original_notice_xml, dry=False):
             # will PROBABLY be the problem you're looking for
             if subpath is not None:
                 findstr = './/*[@label="{}"]/{}{}'.format(label, "{eregs}", subpath)
-                matching_elm = new_xml.find(findstr)
+                matching_elm = label_index.find(label, '{eregs}' + subpath)
                 logging.debug("Performing {} operation on '{}'".format(op, findstr))
 
                 if matching_elm is None:
                     logging.debug("Finding str: {}".format(repr(findstr)))
                     raise KeyError("Unable to find element '{}' to be {}".format(findstr, op))
             else:
-                matching_elm = new_xml.find('.//*[@label="{}"]'.format(label))
+                matching_elm = label_index.get(label)
                 logging.debug("Performing {} operation on '{}'".format(op, label))
                 if matching_elm is None:
                     raise KeyError("Unable to find label {} to be {}".format(label, op))
@@ -307,7 +316,7 @@ def process_changes(original_xml, original_notice_xml, dry=False):
                 after_label = change.get('after')
 
                 # Find the new parent element
-                parent_elm = new_xml.find('.//*[@label="{}"]'.format(parent_label))
+                parent_elm = label_index.get(parent_label)
                 if parent_elm is None:
                     raise ValueError("'parent' attribute is required "
                                      "for 'moved' operation on "
@@ -322,10 +331,8 @@ def process_changes(original_xml, original_notice_xml, dry=False):
                 # move it. If we're given a before or after label, look
                 # for the corresponding elements.
                 new_index = 0
-                before_elm = new_xml.find('.//*[@label="{}"]'.format(
-                    before_label))
-                after_elm = new_xml.find('.//*[@label="{}"]'.format(
-                    after_label))
+                before_elm = label_index.get(before_label)
+                after_elm = label_index.get(after_label)
                 if before_elm is not None:
                     new_index = parent_elm.index(before_elm)
                 elif after_elm is not None:
@@ -347,6 +354,8 @@ def process_changes(original_xml, original_notice_xml, dry=False):
                 if not dry:
                     new_elm = change.getchildren()[0]
                     match_parent.replace(matching_elm, new_elm)
+                    label_index.remove(matching_elm)
+                    label_index.add(new_elm)
 
             # For deleted labels, find the node and remove it.
             if op == 'deleted':
@@ -355,6 +364,7 @@ def process_changes(original_xml, original_notice_xml, dry=False):
 
                     # Remove the element itself
                     match_parent.remove(matching_elm)
+                    label_index.remove(matching_elm)
 
         if op == 'changeTarget':
 
@@ -376,11 +386,11 @@ def process_changes(original_xml, original_notice_xml, dry=False):
             new_label = change.get('newLabel')
             if new_label is None:
                 raise ValueError('Need to know the new label to assign to the target')
-            matching_elm = new_xml.find('.//*[@label="{}"]'.format(label))
+            matching_elm = label_index.get(label)
             logging.debug("Performing {} operation on '{}'".format(op, label))
             if matching_elm is None:
                 raise KeyError("Unable to find label {} to be {}".format(label, op))
-            matching_elm.set('label', new_label)
+            label_index.relabel(matching_elm, new_label)
 
     return new_xml
 
@@ -447,12 +457,466 @@ def rectify_analysis(notice_xml, dry=False):
     return new_xml
 
 
+def freeze_reg_tree(xml_tree):
+    """ Build the regulations-parser tree used by generate_diff for the
+        given RegML tree. Freezing each version once lets it be diffed
+        against any number of other versions. """
+    return FrozenNode.from_node(build_reg_tree(xml_tree))
+
+
+def generate_frozen_diff(left_tree, right_tree):
+    """ Given two frozen trees from freeze_reg_tree, generate a
+        dictionary of changes between the two in the style of
+        regulations-parser. """
+    return dict(changes_between(left_tree, right_tree))
+
+
 def generate_diff(left_xml, right_xml):
     """ Given two full RegML trees, generate a dictionary of changes
         between the two in the style of regulations-parser.
         This wraps regulatons-parser's changes_between() function. """
-    left_tree = build_reg_tree(left_xml)
-    right_tree = build_reg_tree(right_xml)
-    diff = dict(changes_between(FrozenNode.from_node(left_tree),
-                                FrozenNode.from_node(right_tree)))
-    return diff
+    return generate_frozen_diff(freeze_reg_tree(left_xml),
+                                freeze_reg_tree(right_xml))
+
+
+def index_frozen_tree(tree):
+    """ Map the label of every node in a frozen tree to the node. If a
+        label is used more than once, diffs involving the tree can't be
+        reversed, and None is returned. """
+    nodes = {}
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if node.label_id in nodes:
+            return None
+        nodes[node.label_id] = node
+        stack.extend(node.children)
+    return nodes
+
+
+def _added_change(node):
+    """ The change that adds a frozen node, in the style of
+        regulations-parser. """
+    return {'op': 'added',
+            'node': {'child_labels': node.child_labels,
+                     'label': node.label,
+                     'node_type': node.node_type,
+                     'tagged_text': node.tagged_text or None,
+                     'text': node.text,
+                     'title': node.title or None}}
+
+
+def _modified_change(left_node, right_node):
+    """ The change that modifies one frozen node into another with the
+        same label, in the style of regulations-parser, or None if their
+        text, title and children's labels are the same. """
+    left_text, right_text, left_title, right_title = [
+        WHITESPACE.sub(' ', text) for text in
+        (left_node.text, right_node.text, left_node.title, right_node.title)]
+
+    modified = False
+    change = {'op': 'modified'}
+    if left_text != right_text or left_title != right_title:
+        modified = True
+        text_opcodes = get_opcodes(left_text, right_text)
+        if text_opcodes:
+            change['text'] = text_opcodes
+        title_opcodes = get_opcodes(left_title, right_title)
+        if title_opcodes:
+            change['title'] = title_opcodes
+    if left_node.child_labels != right_node.child_labels:
+        modified = True
+        change['child_ops'] = list(label_opcodes(left_node.child_labels,
+                                                 right_node.child_labels))
+    return change if modified else None
+
+
+def reverse_frozen_diff(diff, left_nodes, right_nodes):
+    """ Given the diff from a left tree to a right tree, and the indexes of
+        both trees from index_frozen_tree, derive the diff from the right
+        tree to the left tree: additions become deletions, deletions
+        become additions, and modifications are compared the other way
+        around. Returns None if the reverse diff can't be derived. """
+    if left_nodes is None or right_nodes is None:
+        return None
+
+    reverse = {}
+    for label, change in diff.items():
+        op = change.get('op')
+        if op == 'added' and label not in left_nodes \
+                and label in right_nodes:
+            reverse[label] = {'op': 'deleted'}
+        elif op == 'deleted' and label in left_nodes \
+                and label not in right_nodes:
+            reverse[label] = _added_change(left_nodes[label])
+        elif op == 'modified' and label in left_nodes \
+                and label in right_nodes:
+            reverse_change = _modified_change(right_nodes[label],
+                                              left_nodes[label])
+            if reverse_change is None:
+                return None
+            reverse[label] = reverse_change
+        else:
+            return None
+    return reverse
+
+
+def generate_diff_pair(left_tree, right_tree, left_nodes=None,
+                       right_nodes=None):
+    """ Given two frozen trees, generate the diffs from left to right and
+        from right to left. The second is derived from the first unless
+        it can't be done exactly, in which case it is generated in full.
+        The indexes of the trees from index_frozen_tree are built if they
+        aren't given. """
+    changes = changes_between(left_tree, right_tree)
+    diff = dict(changes)
+
+    reverse = None
+    # If a label appears more than once in the changes, the diff depends
+    # on the order of the changes and can't be reversed.
+    if len(diff) == len(changes):
+        if left_nodes is None:
+            left_nodes = index_frozen_tree(left_tree)
+        if right_nodes is None:
+            right_nodes = index_frozen_tree(right_tree)
+        reverse = reverse_frozen_diff(diff, left_nodes, right_nodes)
+
+    if reverse is None:
+        reverse = generate_frozen_diff(right_tree, left_tree)
+
+    return diff, reverse
+
+
+class ChangesetGenerator(object):
+    """ Generate the notice changeset that changes one version of a
+        regulation into another, from the edit script between them.
+
+        Labelled elements are added, moved and deleted. A change to an
+        unlabelled element is a change to the nearest labelled element
+        that contains it: if it's within the only sub-element of that
+        tag, such as a paragraph's <content>, just that sub-element is
+        modified. Anything that can't be expressed otherwise modifies the
+        nearest labelled element that contains it.
+
+        Changes are placed relative to the siblings that will be in place
+        when process_changes applies them: additions are applied first,
+        then moves, each in label order. """
+
+    def __init__(self, left_xml, right_xml):
+        self.left_xml = left_xml
+        self.right_xml = right_xml
+        self.script = EditScript(left_xml, right_xml)
+        self.left_elements = dict((node.element, node)
+                                  for node in self.script.left_nodes)
+        self.right_elements = dict((node.element, node)
+                                   for node in self.script.right_nodes)
+        self.left_labels = set(node.key for node in self.script.left_nodes
+                               if node.key is not None)
+        self.added_labels = {}
+        for node in self.script.right_nodes:
+            if node.key is not None and self.original(node) is None:
+                self.added_labels[node.key] = \
+                    self.added_labels.get(node.key, 0) + 1
+        self.moved = set(operation.node for operation in self.script
+                         if isinstance(operation, Move) and
+                         operation.node.key is not None)
+
+        # Labelled elements of the right tree that are modified as a
+        # whole, and the sub-elements of others that are modified
+        self.modified = set()
+        self.subpaths = {}
+
+    def generate(self):
+        """ The {eregs}changeset element """
+        self.find_modifications()
+        while True:
+            escalated = set()
+            changes = self.plan(escalated)
+            if escalated <= self.modified:
+                break
+            self.modified |= escalated
+
+        changeset = etree.Element('{eregs}changeset', nsmap={None: 'eregs'})
+        left_number = self.left_xml.findtext(
+            './{eregs}preamble/{eregs}documentNumber')
+        right_number = self.right_xml.findtext(
+            './{eregs}preamble/{eregs}documentNumber')
+        if left_number is not None:
+            changeset.set('leftDocumentNumber', left_number)
+        if right_number is not None:
+            changeset.set('rightDocumentNumber', right_number)
+        changeset.extend(changes)
+        return changeset
+
+    def original(self, node):
+        """ The node of the left tree matched to a node of the right
+            tree, if it isn't one that was inserted """
+        partner = node.partner
+        if partner is None or partner.inserted:
+            return None
+        return partner
+
+    def left_parent(self, node):
+        """ The parent of a node of the left tree before the edit script
+            was applied """
+        return self.left_elements.get(node.element.getparent())
+
+    def owner(self, node):
+        """ The nearest labelled ancestor of a node of the right tree """
+        node = node.parent
+        while node is not None and node.key is None:
+            node = node.parent
+        return node
+
+    def escalate(self, node):
+        """ The nearest labelled node of the right tree, the given one or
+            one of its ancestors, that can be modified as a whole """
+        while node is not None and (node.key is None or
+                                    self.original(node) is None):
+            node = node.parent
+        if node is None:
+            raise ValueError('Unable to express the changes to the '
+                             'regulation as a changeset')
+        return node
+
+    def find_modifications(self):
+        """ Find the labelled elements and sub-elements modified by the
+            edit script's changes to unlabelled elements """
+        for operation in self.script:
+            node = operation.node
+            if isinstance(operation, Delete):
+                if node.key is None:
+                    self.touch_left(node)
+            elif isinstance(operation, Update):
+                if node.key is None:
+                    self.touch_right(node.partner)
+                else:
+                    self.modified.add(node.partner)
+            elif node.key is None:
+                # Moving an unlabelled node changes the order of its owners'
+                # children, so they're modified as a whole
+                moved = isinstance(operation, Move)
+                self.touch_right(node.partner, moved)
+                if moved:
+                    self.touch_left(node, moved)
+
+        for owner, children in self.subpaths.items():
+            if not all(self.has_subpath(owner, child) for child in children):
+                self.modified.add(owner)
+
+    def touch_right(self, node, moved=False):
+        """ Note a change at an unlabelled node of the right tree """
+        child, owner = node, node.parent
+        while owner is not None and owner.key is None:
+            child, owner = owner, owner.parent
+        # Changes within added elements are part of their addition
+        if owner is None or self.original(owner) is None:
+            return
+        if moved:
+            self.modified.add(owner)
+        else:
+            self.subpaths.setdefault(owner, set()).add(child)
+
+    def touch_left(self, node, moved=False):
+        """ Note a change at an unlabelled node of the left tree """
+        child, owner = node.element, node.element.getparent()
+        while owner is not None and owner.get('label') is None:
+            child, owner = owner, owner.getparent()
+        if owner is None:
+            return
+        # Changes within deleted elements are part of their deletion
+        right_owner = self.left_elements[owner].partner
+        if right_owner is None:
+            return
+        right_child = self.left_elements[child].partner
+        if not moved and right_child is not None and \
+                right_child.parent is right_owner:
+            self.subpaths.setdefault(right_owner, set()).add(right_child)
+        else:
+            self.modified.add(right_owner)
+
+    def has_subpath(self, owner, child):
+        """ Whether a child of a labelled node of the right tree can be
+            modified on its own, by the subpath of its tag """
+        left_child = self.original(child)
+        if left_child is None or not child.tag.startswith('{eregs}') or \
+                self.left_parent(left_child) is not self.original(owner):
+            return False
+        for element in (child.element, left_child.element):
+            siblings = element.getparent().findall(child.tag)
+            if len(siblings) != 1 or \
+                    element.find('.//*[@label]') is not None:
+                return False
+        return True
+
+    def is_moved(self, node, left_node):
+        """ Whether a labelled node of the right tree has moved """
+        if left_node in self.moved:
+            return True
+        parent = self.left_parent(left_node)
+        if parent is None or parent.partner is not node.parent:
+            return True
+        # Anything matched within an added element is moved into it
+        owner = self.owner(node)
+        return owner is not None and self.original(owner) is None
+
+    def covered(self):
+        """ The nodes of each tree that are changed along with one of their
+            ancestors """
+        right_covered = set()
+        for node in self.script.right_nodes:
+            parent = node.parent
+            if parent is not None and (parent in right_covered or
+                                       parent in self.modified):
+                right_covered.add(node)
+
+        left_covered = set()
+        for node in self.script.left_nodes:
+            parent = self.left_parent(node)
+            if parent is not None and (
+                    parent in left_covered or
+                    (parent.key is not None and
+                     (parent.partner is None or
+                      parent.partner in self.modified))):
+                left_covered.add(node)
+        return right_covered, left_covered
+
+    def plan(self, escalated):
+        """ The changes, given the labelled elements that are modified as
+            a whole. Any others that need to be are added to escalated. """
+        right_covered, left_covered = self.covered()
+        changes = []
+
+        for node in self.script.left_nodes:
+            if node.key is not None and node.partner is None and \
+                    node not in left_covered:
+                changes.append(self.change('deleted', node.key))
+
+        for node in self.script.right_nodes:
+            if node.key is None or node.parent is None:
+                continue
+            left_node = self.original(node)
+            if node in right_covered:
+                # It's replaced along with a modified ancestor, so it's
+                # deleted from anywhere else it was
+                if left_node is not None and left_node not in left_covered:
+                    changes.append(self.change('deleted', node.key))
+                continue
+
+            owner = self.owner(node)
+            if left_node is None:
+                if owner is None:
+                    raise ValueError('Unable to place {} in the '
+                                     'changeset'.format(node.key))
+                # Added along with its owner
+                if self.original(owner) is None:
+                    continue
+                # Labels can't be added while they're still in use
+                addition = self.addition(node)
+                if self.added_labels[node.key] > 1 or any(
+                        element.get('label') in self.left_labels
+                        for element in addition.iter()
+                        if not callable(element.tag)):
+                    escalated.add(self.escalate(owner))
+                    continue
+                change = self.place('added', node, owner, escalated)
+                if change is not None:
+                    change.append(addition)
+                    changes.append(change)
+                continue
+
+            if self.is_moved(node, left_node):
+                if owner is None:
+                    raise ValueError('Unable to place {} in the '
+                                     'changeset'.format(node.key))
+                change = self.place('moved', node, owner, escalated)
+                if change is not None:
+                    changes.append(change)
+
+            if node in self.modified:
+                change = self.change('modified', node.key)
+                change.append(deepcopy(node.element))
+                changes.append(change)
+            else:
+                for child in sorted(self.subpaths.get(node, ()),
+                                    key=lambda child: child.start):
+                    change = self.change('modified', node.key,
+                                         subpath=child.tag[len('{eregs}'):])
+                    change.append(deepcopy(child.element))
+                    changes.append(change)
+
+        return changes
+
+    def change(self, operation, label, **attributes):
+        change = etree.Element('{eregs}change', operation=operation,
+                               label=label)
+        for name, value in sorted(attributes.items()):
+            change.set(name, value)
+        return change
+
+    def place(self, operation, node, owner, escalated):
+        """ The change that adds or moves a labelled node to its place
+            among its siblings, or None if the owner is escalated """
+        container = node.parent
+        if owner.tag in TAGS_WITH_SUBCONTENT:
+            expressible = container.tag == '{eregs}content' and \
+                container.parent is owner
+        else:
+            expressible = container is owner
+        if not expressible:
+            escalated.add(self.escalate(owner))
+            return None
+
+        siblings = container.children
+        index = siblings.index(node)
+        change = self.change(operation, node.key, parent=owner.key)
+        if index > 0 and self.is_available(operation, siblings[index - 1],
+                                           node):
+            change.set('after', siblings[index - 1].key)
+        elif index + 1 < len(siblings) and self.is_available(
+                operation, siblings[index + 1], node):
+            change.set('before', siblings[index + 1].key)
+        elif index + 1 < len(siblings):
+            escalated.add(self.escalate(owner))
+            return None
+        # Otherwise the node is appended to its parent
+        return change
+
+    def is_available(self, operation, sibling, node):
+        """ Whether a sibling is in place when a node is added or moved """
+        if sibling.key is None:
+            return False
+        left_sibling = self.original(sibling)
+        if left_sibling is not None and \
+                not self.is_moved(sibling, left_sibling):
+            return True
+        if left_sibling is None and operation == 'moved':
+            return True
+        # Siblings added or moved the same way are in place if they're
+        # placed first
+        return (left_sibling is None) == (operation == 'added') and \
+            label_compare(sibling.key, node.key) < 0
+
+    def addition(self, node):
+        """ A copy of an added element without the matched labelled
+            elements that are moved into it """
+        copy = deepcopy(node.element)
+        moved_in = []
+        for element, copied in zip(node.element.iter(), copy.iter()):
+            if element is node.element or callable(element.tag) or \
+                    element.get('label') is None:
+                continue
+            descendant = self.right_elements.get(element)
+            if descendant is not None and \
+                    self.original(descendant) is not None:
+                moved_in.append(copied)
+        for copied in moved_in:
+            copied.getparent().remove(copied)
+        return copy
+
+
+def generate_changeset(left_xml, right_xml):
+    """ Generate the notice changeset that changes the left regulation
+        tree into the right one. The result is an {eregs}changeset
+        element. """
+    return ChangesetGenerator(left_xml, right_xml).generate()
@@ -1,5 +1,6 @@
 from node import *
 from tree import *
+from collections import Counter
 from itertools import product
 
 
@@ -57,27 +58,25 @@ def diff_trees(left_version, right_version):
         pass
 
 
-def gather_labels(tree):
+def same_subtree(left_element, right_element):
+    """ Whether two elements and everything in them are the same """
+    return etree.tostring(left_element, with_tail=False) == \
+        etree.tostring(right_element, with_tail=False)
 
-    labels = []
 
-    def recursive_gather(node):
-        if node.get('label') is not None:
-            labels.append(node.get('label'))
-        for child in node:
-            recursive_gather(child)
+# The labels of an element and its descendants, in document order
+LABELS_XPATH = etree.XPath('descendant-or-self::*/@label', smart_strings=False)
 
-    recursive_gather(tree)
 
-    return labels
+def gather_labels(tree):
 
+    return LABELS_XPATH(tree)
 
-def set_descendants_property(root, prop_name, prop_value):
 
-    root.set(prop_name, prop_value)
+def set_descendants_property(root, prop_name, prop_value):
 
-    for child in root:
-        set_descendants_property(child, prop_name, prop_value)
+    for element in root.iter():
+        element.set(prop_name, prop_value)
 
 
 def set_modified_toc_entry(root, element):
@@ -122,39 +121,107 @@ def merge_tocs(left_toc, right_toc):
                       and right_toc.find('.//*[target="{}"]'.format(entry.get('target'))) is not None]
 
 
+class DiffVersion(object):
+    """
+    A RegML regulation version, read and prepared for diffing once so that
+    it can be diffed against any number of other versions. Versions can be
+    pickled to send them to worker processes, and are parsed at most once
+    in each process.
+
+    :param filename: the path of the RegML regulation file.
+    :type filename: :class:`str`
+    """
+
+    def __init__(self, filename):
+        tree = load_xml(filename)
+
+        comments = tree.xpath('//comment()')
+        for comment in comments:
+            parent = comment.getparent()
+            parent.remove(comment)
+
+        self.xml = etree.tostring(tree)
+        self.version = extract_version(tree)
+        self.labels = gather_labels(tree)
+        self.label_set = set(self.labels)
+        self.label_counts = Counter(self.labels)
+        self._tree = tree
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_tree'] = None
+        return state
+
+    def tree(self):
+        """
+        Return a copy of the version's tree, which diffing changes.
+
+        :return: the root of the copy.
+        :rtype: :class:`etree.Element`
+        """
+        if self._tree is None:
+            self._tree = etree.fromstring(self.xml)
+        return deepcopy(self._tree)
+
+
 def diff_files(left_filename, right_filename, output_file='diff.xml'):
 
-    left_tree = load_xml(left_filename)
-    right_tree = load_xml(right_filename)
+    return diff_versions(DiffVersion(left_filename),
+                         DiffVersion(right_filename))
+
+
+def diff_versions(left_version, right_version):
 
-    comments = left_tree.xpath('//comment()')
-    for comment in comments:
-        parent = comment.getparent()
-        parent.remove(comment)
+    left_tree = left_version.tree()
+    right_tree = right_version.tree()
 
-    comments = right_tree.xpath('//comment()')
-    for comment in comments:
-        parent = comment.getparent()
-        parent.remove(comment)
+    left_labels = left_version.labels
+    right_labels = right_version.labels
 
-    left_labels = gather_labels(left_tree)
-    right_labels = gather_labels(right_tree)
+    # Index the labels of both trees once, rather than searching the
+    # trees for every label. Labels are still partitioned in document
+    # order.
+    left_index = LabelIndex(left_tree)
+    right_index = LabelIndex(right_tree)
+    left_label_set = left_version.label_set
+    right_label_set = right_version.label_set
 
     right_toc = right_tree.find('.//{eregs}tableOfContents')
     left_toc = left_tree.find('.//{eregs}tableOfContents')
 
-    only_left_labels = [label for label in left_labels if label not in right_labels]
-    only_right_labels = [label for label in right_labels if label not in left_labels]
-
-    common_labels = [label for label in left_labels if label in right_labels]
+    only_left_labels = [label for label in left_labels if label not in right_label_set]
+    only_right_labels = [label for label in right_labels if label not in left_label_set]
+    only_right_label_set = set(only_right_labels)
+
+    common_labels = [label for label in left_labels if label in right_label_set]
+
+    # Skip labelled elements that are the same in both trees, along with
+    # everything in them, working down from the top of the tree so that
+    # only the parts that changed are looked at. Labels used more than
+    # once aren't skipped, since the elements compared for them may not be
+    # the ones in the subtree.
+    def unique(label):
+        return left_version.label_counts[label] == 1 and \
+            right_version.label_counts[label] == 1
+
+    unchanged_labels = set()
+    elements = [left_tree]
+    while elements:
+        element = elements.pop()
+        label = element.get('label')
+        if unique(label) and same_subtree(element, right_index.get(label)):
+            unchanged_labels.update(label for label in gather_labels(element)
+                                    if unique(label))
+            continue
+        elements.extend(element.iterchildren('*'))
 
     # clear out any right-hand labels that aren't top-level
     top_level_right_labels = set()
     for label in only_right_labels:
-        element = right_tree.find('.//*[@label="{}"]'.format(label))
+        element = right_index.get(label)
         current_parent = element.getparent()
         last_label = element.get('label')
-        while current_parent.get('label') in only_right_labels:
+        while current_parent.get('label') in only_right_label_set:
             last_label = current_parent.get('label')
             current_parent = current_parent.getparent()
         top_level_right_labels.add(last_label)
@@ -166,32 +233,36 @@ def diff_files(left_filename, right_filename, output_file='diff.xml'):
 
     for label in top_level_right_labels:
         # print 'Processing right label {}'.format(label)
-        element = right_tree.find('.//*[@label="{}"]'.format(label))
+        element = right_index.get(label)
         # print 'element {} was added:'.format(label)
         # print etree.tostring(element, pretty_print=True)
-        common_ancestor, prev_sibling = left_tree_ancestor(left_tree, element)
+        common_ancestor, prev_sibling = left_tree_ancestor(left_index, element)
         #print 'the ancestor in the left tree is', common_ancestor.get('label'), 'to be inserted after', prev_sibling.get('label')
         #element.attrib['action'] = 'added'
         set_descendants_property(element, 'action', 'added')
+        added_element = deepcopy(element)
         if prev_sibling is not None:
-            prev_sibling.addnext(deepcopy(element))
+            prev_sibling.addnext(added_element)
             #print 'adding {} after {}'.format(element.get('label'), prev_sibling.get('label'))
         else:
-            common_ancestor.append(deepcopy(element))
+            common_ancestor.append(added_element)
+        left_index.add(added_element)
 
     for label in only_left_labels:
         # print 'Processing left label {}'.format(label)
-        element = left_tree.find('.//*[@label="{}"]'.format(label))
+        element = left_index.get(label)
         #print 'element {} was deleted:'.format(label)
         #element.attrib['action'] = 'deleted'
         set_descendants_property(element, 'action', 'deleted')
         # print etree.tostring(element, pretty_print=True)
 
     for label in common_labels:
+        if label in unchanged_labels:
+            continue
         # print 'Processing common label {}'.format(label)
         # print 'analyzing common label', label
-        left_element = left_tree.find('.//*[@label="{}"]'.format(label))
-        right_element = right_tree.find('.//*[@label="{}"]'.format(label))
+        left_element = left_index.get(label)
+        right_element = right_index.get(label)
         assert (left_element.tag == right_element.tag)
 
         if left_element.tag == '{eregs}section':
@@ -265,12 +336,12 @@ def diff_files(left_filename, right_filename, output_file='diff.xml'):
     #with open(output_file, 'w') as f:
     #    f.write(etree.tostring(left_tree, pretty_print=True))
     left_toc.getparent().replace(left_toc, right_toc)
-    return left_tree, extract_version(left_tree), extract_version(right_tree)
+    return left_tree, left_version.version, right_version.version
 
 
-def left_tree_ancestor(left_tree, right_node):
+def left_tree_ancestor(left_index, right_node):
     """
-    :param left_tree: The left XML tree
+    :param left_index: The LabelIndex of the left XML tree
     :param right_node: A node from the right tree that was added
     :return: The element from the left tree under which the right_node can be inserted
     and the element *after* which it is to be inserted
@@ -283,7 +354,7 @@ def left_tree_ancestor(left_tree, right_node):
 
     while common_ancestor is None and not stop:
         right_node_parent = current_right.getparent()
-        left_ancestor = left_tree.find('.//*[@label="{}"]'.format(right_node_parent.get('label')))
+        left_ancestor = left_index.get(right_node_parent.get('label'))
         #if left_ancestor is None:
         #    import ipdb; ipdb.set_trace()
 
@@ -1 +1,479 @@
+# -*- coding: utf-8 -*-
+"""
+The FastMatch and EditScript algorithms from Chawathe, Rajaraman,
+Garcia-Molina and Widom, "Change Detection in Hierarchically Structured
+Information" (SIGMOD 1996), over RegML element trees.
+
+FastMatch matches the nodes of two trees, and EditScript turns the
+matching into a minimal script of inserts, deletes, updates and moves
+that transforms the left tree into the right one.
+
+A node's label in the paper is its element's tag. Elements with mixed
+content, such as paragraph <content>, are leaves whose value is their
+serialized content; other elements' values are their attributes. RegML
+labels identify elements, so elements with the same tag and label are
+matched to each other before anything else, and elements with different
+labels are never matched.
+"""
+from __future__ import unicode_literals
+
+from bisect import bisect_left
+from collections import deque, namedtuple
+from difflib import SequenceMatcher
+import re
+
+from lxml import etree
+
 __author__ = 'vinokurovy'
+
+
+# The operations of an edit script. Nodes and parents are nodes of the
+# left tree, and positions are indexes among the parent's children at the
+# time the operation is applied.
+Insert = namedtuple('Insert', ['node', 'parent', 'position'])
+Delete = namedtuple('Delete', ['node'])
+Update = namedtuple('Update', ['node', 'value'])
+Move = namedtuple('Move', ['node', 'parent', 'position'])
+
+
+class Node(object):
+    """ A node of a tree being compared, built from an element """
+
+    __slots__ = ('element', 'tag', 'value', 'key', 'parent', 'children',
+                 'partner', 'in_order', 'inserted', 'start', 'end', 'size')
+
+    def __init__(self, element, tag, value, key=None, parent=None):
+        self.element = element
+        self.tag = tag
+        self.value = value
+        self.key = key
+        self.parent = parent
+        self.children = []
+        self.partner = None
+        self.in_order = False
+        self.inserted = False
+        # The node's range in preorder and its number of leaves
+        self.start = self.end = None
+        self.size = 0
+
+    @property
+    def is_leaf(self):
+        return not self.children
+
+    def __repr__(self):
+        if self.key is not None:
+            return '<Node {} {}>'.format(self.tag, self.key)
+        return '<Node {}>'.format(self.tag)
+
+
+# Namespace declarations repeated on every serialized child element
+NAMESPACE_DECLARATION = re.compile(r' xmlns(?::\w+)?="[^"]*"')
+
+
+def _normalize(text):
+    return ' '.join(NAMESPACE_DECLARATION.sub('', text).split())
+
+
+def _is_atomic(element, children):
+    """ Whether an element is a leaf: it has no child elements, or it has
+        mixed content that can't be broken up """
+    if not children:
+        return True
+    if element.text is not None and element.text.strip():
+        return True
+    return any(child.tail is not None and child.tail.strip()
+               for child in element)
+
+
+def build_tree(element, parent=None):
+    """ Build the tree of nodes for an element and its descendants.
+        Comments and processing instructions are ignored. """
+    children = [child for child in element if not callable(child.tag)]
+    attributes = tuple(sorted(element.attrib.items()))
+    atomic = _is_atomic(element, children)
+
+    if atomic:
+        content = (element.text or '') + ''.join(
+            etree.tostring(child, encoding='unicode', with_tail=True)
+            for child in element)
+        value = (attributes, _normalize(content))
+    else:
+        value = (attributes, None)
+
+    node = Node(element, element.tag, value, element.get('label'), parent)
+    if not atomic:
+        node.children = [build_tree(child, node) for child in children]
+    return node
+
+
+def preorder(root):
+    """ The nodes of a tree in preorder """
+    nodes = []
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        nodes.append(node)
+        stack.extend(reversed(node.children))
+    return nodes
+
+
+def postorder(root):
+    """ The nodes of a tree in postorder """
+    return list(reversed(_reversed_postorder(root)))
+
+
+def _reversed_postorder(root):
+    nodes = []
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        nodes.append(node)
+        stack.extend(node.children)
+    return nodes
+
+
+def _number(root):
+    """ Number the nodes of a tree in preorder, and count the leaves under
+        each. Returns the nodes in preorder. """
+    nodes = preorder(root)
+    for index, node in enumerate(nodes):
+        node.start = index
+    for node in reversed(nodes):
+        if node.children:
+            node.end = node.children[-1].end
+            node.size = sum(child.size for child in node.children)
+        else:
+            node.end = node.start
+            node.size = 1
+    return nodes
+
+
+def longest_common_subsequence(left, right, equal):
+    """ The longest common subsequence of two sequences under the given
+        equality, as a list of pairs of indexes, using Myers' O((N+M)D)
+        algorithm. """
+    n, m = len(left), len(right)
+    offset = n + m + 1
+    v = [0] * (2 * offset + 1)
+    trace = []
+
+    for d in range(n + m + 1):
+        # Only the diagonals reachable in d steps are needed to backtrack
+        trace.append(v[offset - d - 1:offset + d + 2])
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+                x = v[offset + k + 1]
+            else:
+                x = v[offset + k - 1] + 1
+            y = x - k
+            while x < n and y < m and equal(left[x], right[y]):
+                x += 1
+                y += 1
+            v[offset + k] = x
+            if x >= n and y >= m:
+                return _backtrack(trace, n, m)
+    return []
+
+
+def _backtrack(trace, x, y):
+    pairs = []
+    for d in range(len(trace) - 1, -1, -1):
+        v = trace[d]
+        offset = d + 1
+        k = x - y
+        if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+            prev_k = k + 1
+        else:
+            prev_k = k - 1
+        prev_x = v[offset + prev_k]
+        prev_y = prev_x - prev_k
+        while x > prev_x and y > prev_y and x > 0 and y > 0:
+            x -= 1
+            y -= 1
+            pairs.append((x, y))
+        x, y = prev_x, prev_y
+    pairs.reverse()
+    return pairs
+
+
+def longest_increasing_subsequence(sequence):
+    """ The indexes of a longest strictly increasing subsequence """
+    tails = []
+    tail_indexes = []
+    previous = [None] * len(sequence)
+    for index, value in enumerate(sequence):
+        position = bisect_left(tails, value)
+        if position == len(tails):
+            tails.append(value)
+            tail_indexes.append(index)
+        else:
+            tails[position] = value
+            tail_indexes[position] = index
+        if position > 0:
+            previous[index] = tail_indexes[position - 1]
+
+    indexes = []
+    index = tail_indexes[-1] if tail_indexes else None
+    while index is not None:
+        indexes.append(index)
+        index = previous[index]
+    indexes.reverse()
+    return indexes
+
+
+class FastMatch(object):
+    """ Match the nodes of two trees.
+
+        Leaves are equal if their values are at least leaf_threshold
+        similar, and internal nodes are equal if more than
+        internal_threshold of their leaves are matched to each other. """
+
+    def __init__(self, left, right, leaf_threshold=0.6,
+                 internal_threshold=0.6):
+        self.left = left
+        self.right = right
+        self.leaf_threshold = leaf_threshold
+        self.internal_threshold = internal_threshold
+        self.left_nodes = _number(left)
+        self.right_nodes = _number(right)
+
+    def match(self):
+        """ Match the trees, setting the partner of each matched node """
+        if self.left.tag != self.right.tag:
+            raise ValueError('Trees with different roots {} and {} can\'t '
+                             'be matched'.format(self.left.tag,
+                                                 self.right.tag))
+        self.pair(self.left, self.right)
+        self.match_keys()
+        self.match_children()
+
+        left_leaves, left_internal = self.chains(self.left_nodes)
+        right_leaves, right_internal = self.chains(self.right_nodes)
+        for tag, chain in left_leaves.items():
+            self.match_chains(chain, right_leaves.get(tag, []),
+                              self.leaves_equal)
+        for tag, chain in left_internal.items():
+            self.match_chains(chain, right_internal.get(tag, []),
+                              self.internal_equal)
+
+    def pair(self, left, right):
+        left.partner = right
+        right.partner = left
+
+    def match_keys(self):
+        """ Match elements with the same tag and label """
+        def keyed(nodes):
+            keys = {}
+            for node in nodes:
+                if node.key is not None and node.partner is None:
+                    key = (node.tag, node.key)
+                    keys[key] = None if key in keys else node
+            return keys
+
+        right_keys = keyed(self.right_nodes)
+        for key, node in keyed(self.left_nodes).items():
+            partner = right_keys.get(key)
+            if node is not None and partner is not None:
+                self.pair(node, partner)
+
+    def match_children(self):
+        """ Match the children of matched nodes to each other, top down.
+            The only unmatched children of the same tag and label under a
+            pair of matched nodes, such as a paragraph's <content>, are
+            matched whatever their values; otherwise children are matched
+            by their chains. """
+        for node in self.left_nodes:
+            partner = node.partner
+            if partner is None or not node.children or \
+                    not partner.children:
+                continue
+            left_children = self.chains(node.children)
+            right_children = self.chains(partner.children)
+            for left_chains, right_chains, equal in (
+                    (left_children[0], right_children[0], self.leaves_equal),
+                    (left_children[1], right_children[1],
+                     self.internal_equal)):
+                for tag, chain in left_chains.items():
+                    other = right_chains.get(tag)
+                    if other is None:
+                        continue
+                    if len(chain) == 1 and len(other) == 1 and \
+                            chain[0].key == other[0].key:
+                        self.pair(chain[0], other[0])
+                    else:
+                        self.match_chains(chain, other, equal)
+
+    def chains(self, nodes):
+        """ The unmatched leaves and internal nodes among some nodes, in
+            document order, by tag """
+        leaves = {}
+        internal = {}
+        for node in nodes:
+            if node.partner is None:
+                chains = leaves if node.is_leaf else internal
+                chains.setdefault(node.tag, []).append(node)
+        return leaves, internal
+
+    def match_chains(self, left_chain, right_chain, equal):
+        """ Match the nodes of two chains with the same tag: first those
+            in their longest common subsequence, then any others that are
+            equal. """
+        for i, j in longest_common_subsequence(left_chain, right_chain,
+                                               equal):
+            self.pair(left_chain[i], right_chain[j])
+
+        unmatched = [node for node in right_chain if node.partner is None]
+        for node in left_chain:
+            if node.partner is not None:
+                continue
+            for other in unmatched:
+                if other.partner is None and equal(node, other):
+                    self.pair(node, other)
+                    break
+
+    def leaves_equal(self, left, right):
+        if left.key != right.key:
+            return False
+        if left.value == right.value:
+            return True
+
+        left_text, right_text = left.value[1], right.value[1]
+        if not left_text or not right_text:
+            return left_text == right_text
+        matcher = SequenceMatcher(None, left_text, right_text,
+                                  autojunk=False)
+        return matcher.real_quick_ratio() >= self.leaf_threshold and \
+            matcher.quick_ratio() >= self.leaf_threshold and \
+            matcher.ratio() >= self.leaf_threshold
+
+    def internal_equal(self, left, right):
+        if left.key != right.key:
+            return False
+        common = 0
+        for node in self.left_nodes[left.start:left.end + 1]:
+            partner = node.partner
+            if node.is_leaf and partner is not None and \
+                    right.start <= partner.start <= right.end:
+                common += 1
+        return float(common) / max(left.size, right.size) > \
+            self.internal_threshold
+
+
+class EditScript(object):
+    """ The edit script that transforms the left element tree into the
+        right one.
+
+        The script is applied to the left tree of nodes as it's
+        generated, so afterwards every node of the right tree is matched
+        to a node of the left tree with the same tag and value, in the
+        same place. Nodes inserted into the left tree have no element and
+        are marked as inserted. """
+
+    def __init__(self, left, right, **options):
+        self.left = build_tree(left)
+        self.right = build_tree(right)
+        matcher = FastMatch(self.left, self.right, **options)
+        matcher.match()
+        # The nodes of both trees in preorder, before the script changes
+        # the left one
+        self.left_nodes = matcher.left_nodes
+        self.right_nodes = matcher.right_nodes
+        self.operations = []
+        self.generate()
+
+    def __iter__(self):
+        return iter(self.operations)
+
+    def __len__(self):
+        return len(self.operations)
+
+    def generate(self):
+        queue = deque([self.right])
+        while queue:
+            node = queue.popleft()
+            queue.extend(node.children)
+            if node is not self.right:
+                self.place(node)
+            self.align_children(node.partner, node)
+
+        for node in postorder(self.left):
+            if node.partner is None:
+                self.operations.append(Delete(node))
+                node.parent.children.remove(node)
+
+    def place(self, node):
+        """ Insert, update or move the partner of a node of the right tree
+            so that it's in the same place in the left tree """
+        parent = node.parent.partner
+        partner = node.partner
+
+        if partner is None:
+            partner = Node(None, node.tag, node.value, node.key)
+            partner.inserted = True
+            node.partner = partner
+            partner.partner = node
+            position = self.find_position(node)
+            self.insert(partner, parent, position)
+            self.operations.append(Insert(partner, parent, position))
+            partner.in_order = node.in_order = True
+            return
+
+        if partner.value != node.value:
+            self.operations.append(Update(partner, node.value))
+            partner.value = node.value
+
+        if partner.parent.partner is not node.parent:
+            self.move(partner, node, parent)
+
+    def align_children(self, left, right):
+        """ Move the children of a node of the left tree whose partners
+            are children of its partner into the same order """
+        for child in left.children:
+            child.in_order = False
+        for child in right.children:
+            child.in_order = False
+
+        left_children = [child for child in left.children
+                         if child.partner is not None and
+                         child.partner.parent is right]
+        right_children = [child for child in right.children
+                          if child.partner is not None and
+                          child.partner.parent is left]
+        positions = dict((id(child), index)
+                         for index, child in enumerate(right_children))
+        in_order = longest_increasing_subsequence(
+            [positions[id(child.partner)] for child in left_children])
+        for index in in_order:
+            left_children[index].in_order = True
+            left_children[index].partner.in_order = True
+
+        for child in right_children:
+            if not child.partner.in_order:
+                self.move(child.partner, child, left)
+
+    def move(self, node, partner, parent):
+        """ Move a node of the left tree to the place of its partner """
+        node.parent.children.remove(node)
+        position = self.find_position(partner)
+        self.insert(node, parent, position)
+        self.operations.append(Move(node, parent, position))
+        node.in_order = partner.in_order = True
+
+    def insert(self, node, parent, position):
+        parent.children.insert(position, node)
+        node.parent = parent
+
+    def find_position(self, node):
+        """ The position in the left tree for the partner of a node of the
+            right tree: after the partner of its nearest sibling to the
+            left that's in order. """
+        previous = None
+        for sibling in node.parent.children:
+            if sibling is node:
+                break
+            if sibling.in_order:
+                previous = sibling
+        if previous is None:
+            return 0
+        partner = previous.partner
+        return partner.parent.children.index(partner) + 1
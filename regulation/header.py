@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from collections import namedtuple
+import json
+import os
+
+from lxml import etree
+
+
+# What's needed from a RegML file to list and order versions and notices
+Header = namedtuple('Header', ['document_number',
+                               'effective_date',
+                               'left_document_number'])
+
+
+def read_header(filename):
+    """ Read the header of a RegML regulation or notice file without
+        parsing the whole file. Reading stops once the <changeset> of a
+        notice or the <part> of a regulation opens.
+
+        :param filename: the path of the RegML file.
+        :return: :class:`Header`, with None for anything that isn't in the
+                 file. """
+    document_number = effective_date = left_document_number = None
+
+    context = etree.iterparse(filename, events=('start', 'end'),
+                              huge_tree=True)
+    depth = 0
+    in_preamble = False
+    for event, element in context:
+        if event == 'start':
+            depth += 1
+            if depth == 2:
+                if element.tag == '{eregs}changeset':
+                    left_document_number = element.get('leftDocumentNumber')
+                    break
+                if element.tag == '{eregs}part':
+                    break
+                in_preamble = element.tag == '{eregs}preamble'
+            continue
+
+        depth -= 1
+        if in_preamble and depth == 2:
+            if element.tag == '{eregs}documentNumber':
+                document_number = element.text
+            elif element.tag == '{eregs}effectiveDate':
+                effective_date = element.text
+        if depth == 1:
+            # Elements before the changeset or part aren't needed
+            element.clear()
+    del context
+
+    return Header(document_number, effective_date, left_document_number)
+
+
+class HeaderIndex(object):
+    """ The headers of RegML files, read again from a file only when its
+        modification time or size changes. Without a path the index is
+        kept in memory only. """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.changed = False
+        self.entries = {}
+        if path is not None:
+            try:
+                with open(path, 'r') as f:
+                    self.entries = json.load(f)
+            except (IOError, ValueError):
+                pass
+
+    def get(self, filename):
+        """ The header of a RegML file """
+        filename = os.path.abspath(filename)
+        stat = os.stat(filename)
+        entry = self.entries.get(filename)
+        if entry is not None and entry['mtime'] == stat.st_mtime and \
+                entry['size'] == stat.st_size:
+            return Header(*entry['header'])
+
+        header = read_header(filename)
+        self.entries[filename] = {
+            'mtime': stat.st_mtime,
+            'size': stat.st_size,
+            'header': list(header),
+        }
+        self.changed = True
+        return header
+
+    def save(self):
+        """ Write the index if it has changed. An index that can't be
+            written is simply rebuilt next time. """
+        if self.path is None or not self.changed:
+            return
+        try:
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(self.entries, f, indent=4, separators=(',', ':'),
+                          sort_keys=True)
+            os.rename(self.path + '.tmp', self.path)
+            self.changed = False
+        except EnvironmentError:
+            pass
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Singular and plural forms of defined terms, shared by the terms layer, the
+validator and the UI.
+
+inflect is slow and the same terms are inflected over and over, so each
+form is only worked out once per process. If INFLECTION_CACHE_FILE is set,
+the forms are also kept there between runs.
+"""
+from __future__ import unicode_literals
+
+import json
+import os
+
+import inflect
+
+import regulation.settings as settings
+
+
+# Nouns inflect gets wrong, as (singular, plural)
+NOUN_OVERRIDES = [
+    ('bonus', 'bonuses'),
+]
+
+
+class Inflector(object):
+    """ An inflect engine that remembers every form it works out, and
+        optionally keeps them in a file at path. Nouns in
+        SPECIAL_SINGULAR_NOUNS are always singular. """
+
+    def __init__(self, path=None):
+        self.engine = inflect.engine()
+        for singular, plural in NOUN_OVERRIDES:
+            self.engine.defnoun(singular, plural)
+        self.special_singular_nouns = set(
+            getattr(settings, 'SPECIAL_SINGULAR_NOUNS', []))
+        self.singulars = {}
+        self.plurals = {}
+
+        self.path = path
+        self.changed = False
+        if path is not None:
+            self.load()
+
+    @property
+    def fingerprint(self):
+        """ What the forms depend on besides the words themselves. Forms
+            kept with another fingerprint are worked out again. """
+        return [getattr(inflect, '__version__', ''),
+                [list(override) for override in NOUN_OVERRIDES],
+                sorted(self.special_singular_nouns)]
+
+    def singular(self, word):
+        """ The singular form of a noun, which is the noun itself if it's
+            already singular """
+        try:
+            return self.singulars[word]
+        except KeyError:
+            pass
+        if word in self.special_singular_nouns:
+            singular = word
+        else:
+            singular = self.engine.singular_noun(word) or word
+        self.singulars[word] = singular
+        self.changed = True
+        return singular
+
+    def plural(self, word):
+        """ The plural form of a noun """
+        try:
+            return self.plurals[word]
+        except KeyError:
+            pass
+        plural = self.engine.plural(word)
+        self.plurals[word] = plural
+        self.changed = True
+        return plural
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return
+        if data.get('fingerprint') == self.fingerprint:
+            self.singulars.update(data.get('singular', {}))
+            self.plurals.update(data.get('plural', {}))
+
+    def save(self):
+        """ Write the forms to the file if there are new ones. Forms that
+            can't be written are simply worked out again next time. """
+        if self.path is None or not self.changed:
+            return
+        # Worker processes may be saving at the same time
+        temp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump({'fingerprint': self.fingerprint,
+                           'singular': self.singulars,
+                           'plural': self.plurals},
+                          f, separators=(',', ':'), sort_keys=True)
+            os.rename(temp_path, self.path)
+            self.changed = False
+        except EnvironmentError:
+            pass
+
+
+_inflector = None
+
+
+def inflector():
+    """ The process's shared Inflector """
+    global _inflector
+    if _inflector is None:
+        _inflector = Inflector(
+            getattr(settings, 'INFLECTION_CACHE_FILE', None))
+    return _inflector
+
+
+def singular(word):
+    """ The singular form of a noun, which is the noun itself if it's
+        already singular or in SPECIAL_SINGULAR_NOUNS """
+    return inflector().singular(word)
+
+
+def plural(word):
+    """ The plural form of a noun """
+    return inflector().plural(word)
+
+
+def save():
+    """ Keep the forms worked out so far in INFLECTION_CACHE_FILE """
+    if _inflector is not None:
+        _inflector.save()
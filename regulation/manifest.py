@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import glob
+import hashlib
+import json
+import os
+
+from regulation.archive import (JSONArchive, archive_path, json_layout,
+                                member_name)
+from regulation.output import compressed_path
+import regulation.settings as settings
+from regulation.tree import LAYER_BUILDERS
+
+
+# The name of the manifest file within JSON_ROOT
+MANIFEST_FILE = '.regml-manifest.json'
+
+# The output of a version is the regulation tree and its layers
+VERSION_OUTPUT_TYPES = ('regulation',) + tuple(
+    builder.layer_type for builder in LAYER_BUILDERS)
+
+
+def file_digest(filename):
+    """ The SHA-256 hex digest of a file's contents """
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def parser_version():
+    """ A fingerprint of the parser that produces the JSON: the source of
+        regml.py, the regulation package, and the local settings, along
+        with the installed regparser's version. Any change to them
+        invalidates the manifest. """
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    sources = sorted(glob.glob(os.path.join(package_dir, '*.py')) +
+                     glob.glob(os.path.join(package_dir, '*', '*.py')))
+    sources.append(os.path.join(os.path.dirname(package_dir), 'regml.py'))
+    local_settings = getattr(settings, 'local_settings', None)
+    if getattr(local_settings, '__file__', None) is not None:
+        sources.append(local_settings.__file__.replace('.pyc', '.py'))
+
+    digest = hashlib.sha256()
+    for source in sources:
+        if os.path.exists(source):
+            digest.update(file_digest(source).encode('ascii'))
+
+    try:
+        import pkg_resources
+        regparser_version = pkg_resources.get_distribution(
+            'regparser').version
+    except Exception:
+        regparser_version = ''
+    digest.update(regparser_version.encode('utf-8'))
+
+    return digest.hexdigest()
+
+
+class JSONManifest(object):
+    """ A record of the inputs that JSON output in JSON_ROOT was generated
+        from, so that a version or a diff only needs to be generated again
+        when its RegML or the parser has changed.
+
+        Versions are recorded by their RegML file, relative to XML_ROOT,
+        with the SHA-256 of the file and the regulation and notice they
+        were written as. Diffs are recorded by regulation and the notices
+        on each side, with the SHA-256 of each side's RegML. Both record
+        whether the JSON is compact, and JSON written the other way isn't
+        up to date. """
+
+    def __init__(self, json_root=None, parser=None, compact=False):
+        self.json_root = json_root if json_root is not None \
+            else settings.JSON_ROOT
+        self.path = os.path.join(self.json_root, MANIFEST_FILE)
+        self.parser = parser if parser is not None else parser_version()
+        self.compact = compact
+        self.versions = {}
+        self.diffs = {}
+
+    @classmethod
+    def load(cls, json_root=None, parser=None, compact=False):
+        """ Load the manifest in json_root. A manifest that is missing,
+            unreadable, or written by another parser version is empty. """
+        manifest = cls(json_root=json_root, parser=parser, compact=compact)
+        try:
+            with open(manifest.path, 'r') as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return manifest
+
+        if data.get('parser') == manifest.parser:
+            manifest.versions = data.get('versions', {})
+            manifest.diffs = data.get('diffs', {})
+        return manifest
+
+    def save(self):
+        """ Write the manifest, replacing the previous one only once it
+            has been written in full """
+        if not os.path.isdir(self.json_root):
+            os.makedirs(self.json_root)
+        data = {'parser': self.parser,
+                'versions': self.versions,
+                'diffs': self.diffs}
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(data, f, indent=4, separators=(',', ':'),
+                      sort_keys=True)
+        os.rename(temp_path, self.path)
+
+    def source_key(self, regulation_file):
+        """ The key for a RegML file, relative to XML_ROOT where possible """
+        path = os.path.abspath(regulation_file)
+        xml_root = os.path.abspath(settings.XML_ROOT)
+        if path.startswith(xml_root + os.sep):
+            path = os.path.relpath(path, xml_root)
+        return path.replace(os.sep, '/')
+
+    def output_exists(self, layer_type, reg_number, notice,
+                      diff_notice=None):
+        """ Whether a file written by write_layer exists, compressed as
+            JSON_COMPRESSION says it should be, or in the archive layout,
+            whether the layer is in its version's archive """
+        if json_layout() == 'archive':
+            path = archive_path(reg_number, notice, json_root=self.json_root)
+            if not os.path.isfile(path):
+                return False
+            with JSONArchive(path) as archive:
+                return member_name(layer_type, reg_number, notice,
+                                   diff_notice=diff_notice) in archive
+
+        path = os.path.join(self.json_root, layer_type, reg_number)
+        if diff_notice is not None:
+            path = os.path.join(path, diff_notice)
+        return os.path.isfile(compressed_path(
+            os.path.join(path, notice),
+            getattr(settings, 'JSON_COMPRESSION', None)))
+
+    def version(self, regulation_file, digest):
+        """ The (reg_number, notice) of a version whose JSON is up to date
+            with the given digest of its RegML, or None if it has to be
+            generated """
+        entry = self.versions.get(self.source_key(regulation_file))
+        if entry is None or entry['source'] != digest or \
+                entry.get('compact', False) != self.compact:
+            return None
+
+        reg_number, notice = entry['reg_number'], entry['notice']
+        for layer_type in VERSION_OUTPUT_TYPES:
+            if not self.output_exists(layer_type, reg_number, notice):
+                return None
+        return reg_number, notice
+
+    def add_version(self, regulation_file, digest, reg_number, notice):
+        self.versions[self.source_key(regulation_file)] = {
+            'source': digest,
+            'reg_number': reg_number,
+            'notice': notice,
+            'compact': self.compact,
+        }
+
+    def remove_version(self, regulation_file):
+        self.versions.pop(self.source_key(regulation_file), None)
+
+    def diff_key(self, reg_number, left_notice, right_notice):
+        return '/'.join([reg_number, left_notice, right_notice])
+
+    def diff_is_current(self, reg_number, left_notice, right_notice,
+                        left_digest, right_digest):
+        """ Whether the diff between two versions is up to date with the
+            digests of their RegML """
+        entry = self.diffs.get(
+            self.diff_key(reg_number, left_notice, right_notice))
+        return entry is not None and \
+            entry['left'] == left_digest and \
+            entry['right'] == right_digest and \
+            entry.get('compact', False) == self.compact and \
+            self.output_exists('diff', reg_number, right_notice,
+                               diff_notice=left_notice)
+
+    def add_diff(self, reg_number, left_notice, right_notice,
+                 left_digest, right_digest):
+        self.diffs[self.diff_key(reg_number, left_notice, right_notice)] = {
+            'left': left_digest,
+            'right': right_digest,
+            'compact': self.compact,
+        }
+
+    def remove_diff(self, reg_number, left_notice, right_notice):
+        self.diffs.pop(
+            self.diff_key(reg_number, left_notice, right_notice), None)
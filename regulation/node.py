@@ -2,6 +2,7 @@
 
 from __future__ import unicode_literals
 
+from bisect import bisect_right
 from collections import OrderedDict
 from termcolor import colored
 
@@ -9,13 +10,16 @@ import re
 import json
 import hashlib
 
+from regulation.output import (compact_encoder, encode_json, INDENT,
+                               pretty_encoder)
+
 """
 Created on Jan 1, 2016
 @author: Jerry Vinokurov, Will Barton
 """
 
 
-class RegNode:
+class RegNode(object):
     """
     The RegNode class represents a regular text node in a regulation.
     It provides for some convenience functions for manipulating the
@@ -24,6 +28,12 @@ class RegNode:
     Keyword arguments:
         `include_children` (**bool**): whether or not to include children when generating JSON
     """
+    # A regulation has a node for every paragraph, so they don't each
+    # get a __dict__
+    __slots__ = ('label', 'marker', 'children', 'text', 'title',
+                 'node_type', 'hash', 'depth', 'mixed_text', 'source_xml',
+                 'include_children')
+
     def __init__(self, **kwargs):
         """
         The initializer for the RegNode class.
@@ -68,19 +78,90 @@ class RegNode:
             node_dict['children'] = [node.to_json()
                                      for node in self.children]
 
-        node_dict['label'] = self.label
-        node_dict['node_type'] = self.node_type
-        node_dict['text'] = self.text
+        node_dict.update(self.json_fields())
+
+        return node_dict
+
+    def json_fields(self):
+        """
+        The node's own fields in its JSON, without its children.
+
+        Returns:
+            :class:`list` of (key, value) pairs, in the order they're written.
+        """
+        fields = [('label', self.label),
+                  ('node_type', self.node_type),
+                  ('text', self.text)]
         if self.title and self.title != '':
-            node_dict['title'] = self.title
+            fields.append(('title', self.title))
         if self.marker is not None:
-            node_dict['marker'] = self.marker
+            fields.append(('marker', self.marker))
 
         if self.mixed_text != []:
             pass
-            #node_dict['mixed_text'] = self.mixed_text
+            #fields.append(('mixed_text', self.mixed_text))
 
-        return node_dict
+        return fields
+
+    def iterencode(self, compact=False):
+        """
+        Encode yourself, and possibly all your children, as JSON a piece
+        at a time, depth-first. This is the same JSON as encoding
+        to_json() with :func:`regulation.output.iterencode`, without
+        building the whole dict first.
+
+        Args:
+            compact (bool): whether to leave out all whitespace
+
+        Returns:
+            An iterator over the pieces of JSON.
+        """
+        if compact:
+            return self._iterencode(compact_encoder().encode, None, 0)
+        return self._iterencode(pretty_encoder().encode, INDENT, 0)
+
+    def _iterencode(self, encode, indent, level):
+        def newline(level):
+            if indent is None:
+                return str('')
+            return str('\n') + str(' ') * (indent * level)
+
+        field_newline = newline(level + 1)
+        yield str('{') + field_newline
+        separator = str('')
+        if self.include_children:
+            if self.children:
+                child_newline = newline(level + 2)
+                child_separator = str('"children":[') + child_newline
+                for child in self.children:
+                    yield child_separator
+                    for chunk in child._iterencode(encode, indent, level + 2):
+                        yield chunk
+                    child_separator = str(',') + child_newline
+                yield field_newline + str(']')
+            else:
+                yield str('"children":[]')
+            separator = str(',') + field_newline
+
+        for key, value in self.json_fields():
+            # Values are encoded on their own, so their lines are indented
+            # to this level afterward
+            yield (separator + encode(key) + str(':') +
+                   encode(value).replace(str('\n'), field_newline))
+            separator = str(',') + field_newline
+        yield newline(level) + str('}')
+
+    def write_json(self, stream, compact=False):
+        """
+        Write yourself, and possibly all your children, to a stream as
+        JSON in UTF-8, as it's encoded.
+
+        Args:
+            stream: a file-like object open for writing bytes
+            compact (bool): whether to leave out all whitespace
+        """
+        for chunk in encode_json(self, compact=compact):
+            stream.write(chunk)
 
     def __repr__(self):
         return json.dumps(self.to_json(), indent=4)
@@ -113,15 +194,20 @@ class RegNode:
         :rtype: :class:`int`
         """
 
-        if node.children == []:
-            #return hash('-'.join(node.label) + node.node_type + node.text + node.source_xml)
-            return hash(node.node_type + node.text + node.source_xml)
-        else:
-            child_hashes = ''
-            for child in node.children:
-                child_hash = str(RegNode.merkle_hash(child))
-                child_hashes += child_hash
-            return hash(child_hashes)
+        # Every node comes after its descendants in reverse preorder, so
+        # their hashes are known by the time it's hashed
+        hashes = {}
+        for descendant in reversed(list(node.iter_nodes())):
+            if descendant.children == []:
+                #hashes[id(descendant)] = hash('-'.join(descendant.label) + descendant.node_type + descendant.text + descendant.source_xml)
+                hashes[id(descendant)] = hash(descendant.node_type +
+                                              descendant.text +
+                                              descendant.source_xml)
+            else:
+                child_hashes = ''.join(str(hashes[id(child)])
+                                       for child in descendant.children)
+                hashes[id(descendant)] = hash(child_hashes)
+        return hashes[id(node)]
 
     def __hash__(self):
         if self.hash is None:
@@ -152,6 +238,55 @@ class RegNode:
         """
         return '-'.join(self.label)
 
+    def iter_nodes(self):
+        """
+        Iterate over this node and all the nodes below it, each node before
+        its children.
+
+        :param: None
+
+        :return: an iterator over the RegNodes in the tree.
+        :rtype: iterator of :class:`regulation.node.RegNode`
+        """
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(node.children))
+
+    def iter_labels(self):
+        """
+        Iterate over the labels used in the tree, in the order of
+        iter_nodes().
+
+        :param: None
+
+        :return: an iterator over the labels used in the tree.
+        :rtype: iterator of :class:`str`
+        """
+        for node in self.iter_nodes():
+            yield node.string_label
+
+    def iter_find(self, func):
+        """
+        Iterate over the nodes in the subtree of self that match the
+        specified predicate. The matching children of a node come before
+        the matches below each child in turn.
+
+        :param func: predicate to match.
+        :type func: :class:`function`
+
+        :return: an iterator over the RegNodes matching that predicate
+        :rtype: iterator of :class:`regulation.node.RegNode`
+        """
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            for child in node.children:
+                if func(child):
+                    yield child
+            stack.extend(reversed(node.children))
+
     def find_node(self, func):
         """
         Find all nodes in the subtree of self that match the specified predicate.
@@ -162,14 +297,7 @@ class RegNode:
         :return: a flat list of the RegNodes matching that predicate
         :rtype: :class:`list` of :class:`regulation.node.RegNode`
          """
-        matches = [child for child in self.children if func(child)]
-
-        submatches = []
-        for child in self.children:
-            submatches.extend(child.find_node(func))
-        matches.extend(submatches)
-
-        return matches
+        return list(self.iter_find(func))
 
     def flatten(self):
         """
@@ -181,25 +309,16 @@ class RegNode:
         :rtype: :class:`list` of :class:`regulation.node.RegNode`:
         """
 
-        if self.children == []:
-            new_node = RegNode()
-            new_node.node_type = self.node_type
-            new_node.label = self.label
-            new_node.text = self.text
-            new_node.mixed_text = self.mixed_text
-            new_node.source_xml = self.source_xml
-            return [new_node]
-        else:
+        flattened = []
+        for node in self.iter_nodes():
             new_node = RegNode()
-            new_node.node_type = self.node_type
-            new_node.label = self.label
-            new_node.text = self.text
-            new_node.mixed_text = self.mixed_text
-            new_node.source_xml = self.source_xml
-            flatten_children = [new_node]
-            for child in self.children:
-                flatten_children.extend(child.flatten())
-            return flatten_children
+            new_node.node_type = node.node_type
+            new_node.label = node.label
+            new_node.text = node.text
+            new_node.mixed_text = node.mixed_text
+            new_node.source_xml = node.source_xml
+            flattened.append(new_node)
+        return flattened
 
     def labels(self):
         """
@@ -211,13 +330,7 @@ class RegNode:
         :rtype: :class:`list` of :class:`str`
         """
 
-        if self.children == []:
-            return [self.string_label]
-        else:
-            child_labels = []
-            for child in self.children:
-                child_labels.extend(child.labels())
-            return [self.string_label] + child_labels
+        return list(self.iter_labels())
 
     def height(self):
         """
@@ -227,10 +340,13 @@ class RegNode:
         :return: the tree height.
         :rtype: :class:`int`
         """
-        if len(self.children) == 0:
-            return 1
-        else:
-            return 1 + max([child.height() for child in self.children])
+        height = 0
+        stack = [(self, 1)]
+        while stack:
+            node, node_height = stack.pop()
+            height = max(height, node_height)
+            stack.extend((child, node_height + 1) for child in node.children)
+        return height
 
 
 def xml_node_text(node, include_children=True):
@@ -338,6 +454,109 @@ def find_all_occurrences(source, target, boundary=True):
     return positions
 
 
+# Zero-width matches at every word boundary, as \b matches them in
+# find_all_occurrences
+WORD_BOUNDARY = re.compile(r'\b')
+
+
+class PatternMatcher(object):
+    """
+    An Aho-Corasick automaton that finds all occurrences of any number of
+    patterns in a text in a single pass, rather than searching the text
+    once for each pattern.
+
+    :param patterns: the strings to search for.
+    :type patterns: iterable of :class:`str`
+    """
+
+    def __init__(self, patterns):
+        self.patterns = []
+        # The transitions, failure link and the indexes of the patterns
+        # that end at each state of the automaton
+        self.transitions = [{}]
+        self.failures = [0]
+        self.outputs = [()]
+
+        for pattern in patterns:
+            if not pattern or pattern in self.patterns:
+                continue
+            state = 0
+            for character in pattern:
+                next_state = self.transitions[state].get(character)
+                if next_state is None:
+                    next_state = len(self.transitions)
+                    self.transitions[state][character] = next_state
+                    self.transitions.append({})
+                    self.failures.append(0)
+                    self.outputs.append(())
+                state = next_state
+            self.outputs[state] += (len(self.patterns),)
+            self.patterns.append(pattern)
+
+        # Breadth first, so that each state's failure link is to a state
+        # that's already complete
+        queue = list(self.transitions[0].values())
+        for state in queue:
+            for character, next_state in self.transitions[state].items():
+                failure = self.failures[state]
+                while failure and character not in self.transitions[failure]:
+                    failure = self.failures[failure]
+                failure = self.transitions[failure].get(character, 0)
+                self.failures[next_state] = failure
+                self.outputs[next_state] += self.outputs[failure]
+                queue.append(next_state)
+
+    def matches(self, text):
+        """
+        Find every occurrence of every pattern in `text`, including
+        overlapping ones.
+
+        :param text: the text to search.
+        :type text: :class:`str`
+
+        :return: the (position, pattern) of each occurrence, in order of where they end.
+        :rtype: generator of :class:`tuple`
+        """
+        transitions = self.transitions
+        failures = self.failures
+        outputs = self.outputs
+        patterns = self.patterns
+        state = 0
+        for end, character in enumerate(text, 1):
+            while state and character not in transitions[state]:
+                state = failures[state]
+            state = transitions[state].get(character, 0)
+            for index in outputs[state]:
+                pattern = patterns[index]
+                yield end - len(pattern), pattern
+
+    def find_all_occurrences(self, text):
+        """
+        Find all occurrences of each pattern in `text` that begin and end
+        at word boundaries, as :func:`find_all_occurrences` does for a
+        single pattern.
+
+        :param text: the text to search.
+        :type text: :class:`str`
+
+        :return: the positions at which each pattern occurs, by pattern. Patterns that don't occur are left out.
+        :rtype: :class:`dict` of :class:`list` of :class:`int`
+        """
+        boundaries = set(match.start()
+                         for match in WORD_BOUNDARY.finditer(text))
+        occurrences = {}
+        # Like a regular expression search, only the first of any
+        # overlapping occurrences of a pattern counts
+        ends = {}
+        for position, pattern in sorted(self.matches(text)):
+            end = position + len(pattern)
+            if position in boundaries and end in boundaries and \
+                    position >= ends.get(pattern, 0):
+                occurrences.setdefault(pattern, []).append(position)
+                ends[pattern] = end
+        return occurrences
+
+
 def interpolate_string(text, offsets, values, colorize=False):
     """
     Interpolate the `values` into the `text` at a given `offset`.
@@ -379,6 +598,7 @@ def interpolate_string(text, offsets, values, colorize=False):
 def enclosed_in_tag(source_text, tag, loc):
     """
     Determine whether within the `source_text`, the element present at `loc` is enclosed within the XML `tag`.
+    To check many locations in the same text, use :class:`TagSpans`.
 
     :param source_text: a string that possibly contains some XML markup.
     :type source_text: :class:`str`
@@ -398,16 +618,191 @@ def enclosed_in_tag(source_text, tag, loc):
         enclosed_in_tag(source_text, tag, loc)
         True
     """
-    trailing_text = source_text[loc:]
-    close_tag = '</{}>'.format(tag)
-    first_open_tag = re.search('<[^\/].*?>', trailing_text)
-    first_closed_tag = re.search('<\/.*?>', trailing_text)
-    if not first_closed_tag:
-        return False
-    else:
-        if first_open_tag is not None and first_open_tag.start() < first_closed_tag.start():
-            return False
-        elif first_closed_tag.group(0) == close_tag:
-            return True
-        else:
+    return TagSpans(source_text).encloses(tag, loc)
+
+
+# Zero-width matches at the start of every opening and closing tag
+OPEN_TAG = re.compile(r'(?=<[^\/].*?>)')
+CLOSE_TAG = re.compile(r'(?=(<\/.*?>))')
+
+
+class TagSpans(object):
+    """
+    The spans of a string of XML markup that are enclosed in each tag,
+    found in a single pass so that any number of locations can be checked
+    with a binary search.
+
+    A location is enclosed in a tag when the first tag at or after it is
+    that tag's closing tag. The span for each closing tag runs from just
+    after the start of the tag before it to the start of the closing tag.
+
+    :param source_text: a string that possibly contains some XML markup.
+    :type source_text: :class:`str`
+    """
+
+    def __init__(self, source_text):
+        # The starts and ends of the spans enclosed in each tag, in order
+        self.spans = {}
+        tags = [(match.start(), None)
+                for match in OPEN_TAG.finditer(source_text)]
+        tags.extend((match.start(), match.group(1))
+                    for match in CLOSE_TAG.finditer(source_text))
+        tags.sort()
+
+        previous = -1
+        for start, close_tag in tags:
+            if close_tag is not None:
+                starts, ends = self.spans.setdefault(close_tag[2:-1],
+                                                     ([], []))
+                starts.append(previous + 1)
+                ends.append(start)
+            previous = start
+
+    def encloses(self, tag, loc):
+        """
+        Determine whether `loc` is enclosed within the XML `tag`.
+
+        :param tag: a string specifying an XML tag.
+        :type tag: :class:`str`
+        :param loc: the location to test for enclosure.
+        :type loc: :class:`int`
+
+        :return: a boolean indicating whether `loc` is enclosed in the specified `tag`.
+        :rtype: :class:`bool`
+        """
+        spans = self.spans.get(tag)
+        if spans is None:
             return False
+        starts, ends = spans
+        index = bisect_right(starts, loc) - 1
+        return index >= 0 and loc <= ends[index]
+
+
+def tree_labels(root):
+    """
+    The labels of the elements within an XML tree.
+
+    :param root: the root of the XML tree. Its own label isn't included.
+    :type root: :class:`etree.Element`
+
+    :return: the labels used in the tree.
+    :rtype: :class:`frozenset` of :class:`str`
+    """
+    return frozenset(root.xpath('.//*/@label', smart_strings=False))
+
+
+class LabelIndex(object):
+    """
+    An index of the labelled elements in an XML tree, so that an element can
+    be found by its label without searching the whole tree.
+
+    Lookups give the same result as ``root.find('.//*[@label="..."]')`` as long
+    as the index is kept up to date with :meth:`add`, :meth:`remove` and
+    :meth:`relabel` when the tree is modified. If a label is (temporarily)
+    used by more than one element, the tree is searched to find the first one
+    in document order.
+
+    :param root: the root of the XML tree to index. The root itself is not
+        indexed.
+    :type root: :class:`etree.Element`
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._elements = {}
+        for element in root.xpath('.//*[@label]'):
+            self._elements.setdefault(element.get('label'), []).append(element)
+
+    def get(self, label):
+        """
+        Find the element with the given label.
+
+        :param label: the label to look for.
+        :type label: :class:`str`
+
+        :return: the element with that label, or None if there isn't one.
+        :rtype: :class:`etree.Element`
+        """
+        elements = self._elements.get(label)
+        if not elements:
+            return None
+        if len(elements) == 1:
+            return elements[0]
+        return self.root.find('.//*[@label="{}"]'.format(label))
+
+    def find(self, label, path):
+        """
+        Find a sub-element of the element with the given label.
+
+        :param label: the label of the element to search within.
+        :type label: :class:`str`
+        :param path: the path of the sub-element, relative to the labelled
+            element.
+        :type path: :class:`str`
+
+        :return: the matching sub-element, or None if there isn't one.
+        :rtype: :class:`etree.Element`
+        """
+        elements = self._elements.get(label)
+        if not elements:
+            return None
+        if len(elements) == 1:
+            return elements[0].find(path)
+        return self.root.find('.//*[@label="{}"]/{}'.format(label, path))
+
+    def __contains__(self, label):
+        return bool(self._elements.get(label))
+
+    def __len__(self):
+        return sum(len(elements) for elements in self._elements.values())
+
+    def labels(self):
+        """
+        Return the set of all labels in the index.
+
+        :return: the labels used in the tree.
+        :rtype: :class:`set` of :class:`str`
+        """
+        return set(label for label, elements in self._elements.items()
+                   if elements)
+
+    def add(self, element):
+        """
+        Index an element that has been added to the tree, along with all its
+        labelled descendants.
+
+        :param element: the added element.
+        :type element: :class:`etree.Element`
+        """
+        for labelled in element.xpath('descendant-or-self::*[@label]'):
+            self._elements.setdefault(labelled.get('label'), []).append(labelled)
+
+    def remove(self, element):
+        """
+        Remove an element that has been (or is about to be) removed from the
+        tree, along with all its labelled descendants, from the index.
+
+        :param element: the removed element.
+        :type element: :class:`etree.Element`
+        """
+        for labelled in element.xpath('descendant-or-self::*[@label]'):
+            elements = self._elements.get(labelled.get('label'), [])
+            if labelled in elements:
+                elements.remove(labelled)
+
+    def relabel(self, element, new_label):
+        """
+        Change the label of an element and update the index to match.
+
+        :param element: the element to relabel.
+        :type element: :class:`etree.Element`
+        :param new_label: the element's new label.
+        :type new_label: :class:`str`
+        """
+        old_label = element.get('label')
+        if old_label is not None:
+            elements = self._elements.get(old_label, [])
+            if element in elements:
+                elements.remove(element)
+        element.set('label', new_label)
+        self._elements.setdefault(new_label, []).append(element)
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import gzip
+import json
+import os
+
+# simplejson's encoder is used for compact output where it's installed.
+# Its C speedups are kept more current than the standard library's.
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
+
+# zstd compression requires the zstandard package
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+
+# Separators without whitespace. They're native strings so that Python 2
+# encodes JSON as byte strings, which are much faster to write.
+SEPARATORS = (str(','), str(':'))
+
+# How far each level of JSON that isn't compact is indented
+INDENT = 4
+
+# The suffix of a JSON file for each kind of compression
+COMPRESSION_SUFFIXES = {
+    None: '',
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+# Compression levels that compress well without being too slow
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 10
+
+# How many levels of nested objects and arrays the compact writer streams
+# itself. Anything deeper is encoded in one go, which is much faster.
+COMPACT_STREAM_DEPTH = 4
+
+
+def compact_encoder():
+    """ The encoder for compact JSON, with no whitespace at all """
+    if simplejson is not None:
+        # Encode namedtuples as arrays, as the standard library does
+        return simplejson.JSONEncoder(separators=SEPARATORS,
+                                      namedtuple_as_object=False)
+    return json.JSONEncoder(separators=SEPARATORS)
+
+
+def pretty_encoder():
+    """ The encoder for JSON that isn't compact """
+    return json.JSONEncoder(indent=INDENT, separators=SEPARATORS)
+
+
+def iterencode(obj, compact=False):
+    """ Encode an object as JSON, a piece at a time. The JSON is indented
+        by four spaces unless it's compact. Objects with their own
+        iterencode(), like regulation trees, encode themselves. """
+    if hasattr(obj, 'iterencode'):
+        return obj.iterencode(compact=compact)
+    if compact:
+        return _iterencode_compact(compact_encoder().encode, obj,
+                                   COMPACT_STREAM_DEPTH)
+    return pretty_encoder().iterencode(obj)
+
+
+def _iterencode_compact(encode, obj, depth):
+    # Encoding a whole value at once uses the encoder's C implementation,
+    # while iterencode() wouldn't, so only the outer levels are streamed.
+    if depth > 0 and isinstance(obj, dict) and obj and \
+            all(isinstance(key, string_types) for key in obj):
+        separator = '{'
+        for key, value in obj.items():
+            yield separator
+            yield encode(key)
+            yield ':'
+            for chunk in _iterencode_compact(encode, value, depth - 1):
+                yield chunk
+            separator = ','
+        yield '}'
+    elif depth > 0 and isinstance(obj, (list, tuple)) and obj:
+        separator = '['
+        for value in obj:
+            yield separator
+            for chunk in _iterencode_compact(encode, value, depth - 1):
+                yield chunk
+            separator = ','
+        yield ']'
+    else:
+        yield encode(obj)
+
+
+def compressed_path(path, compression):
+    """ The path of a JSON file with the given compression """
+    if compression not in COMPRESSION_SUFFIXES:
+        raise ValueError('Unknown JSON compression {}'.format(compression))
+    if compression == 'zstd' and zstandard is None:
+        raise ValueError('zstd compression requires the zstandard package')
+    return path + COMPRESSION_SUFFIXES[compression]
+
+
+def find_json(path):
+    """ The path of the JSON file written to path with any compression,
+        or None if there isn't one """
+    for compression in (None, 'gzip', 'zstd'):
+        candidate = path + COMPRESSION_SUFFIXES[compression]
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+
+def encode_json(obj, compact=False):
+    """ Encode an object as JSON in UTF-8, a piece at a time """
+    for chunk in iterencode(obj, compact=compact):
+        if not isinstance(chunk, bytes):
+            chunk = chunk.encode('utf-8')
+        yield chunk
+
+
+def write_json(obj, path, compact=False, compression=None):
+    """ Write an object to a file as JSON, as it's encoded. With gzip or
+        zstd compression, the file's path has a .gz or .zst suffix, and
+        the file it was written to before with any other compression is
+        removed. The file is only replaced once the JSON has been
+        written in full. Returns the path of the file. """
+    return write_json_bytes(encode_json(obj, compact=compact), path,
+                            compression=compression)
+
+
+def write_json_bytes(chunks, path, compression=None):
+    """ Write JSON that has already been encoded to a file, as
+        write_json() does """
+    output_path = compressed_path(path, compression)
+    temp_path = output_path + '.tmp'
+    try:
+        with open(temp_path, 'wb') as f:
+            if compression == 'gzip':
+                # Leave out the file name and time, so that the same JSON
+                # is always compressed the same way
+                writer = gzip.GzipFile(filename='', mode='wb', fileobj=f,
+                                       compresslevel=GZIP_LEVEL, mtime=0)
+            elif compression == 'zstd':
+                writer = zstandard.ZstdCompressor(
+                    level=ZSTD_LEVEL).stream_writer(f)
+            else:
+                writer = f
+            for chunk in chunks:
+                writer.write(chunk)
+            if writer is not f:
+                writer.close()
+        os.rename(temp_path, output_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    for other_path in set(path + suffix
+                          for suffix in COMPRESSION_SUFFIXES.values()):
+        if other_path != output_path and os.path.isfile(other_path):
+            os.remove(other_path)
+    return output_path
+
+
+def open_json(path):
+    """ Open the JSON file written to path with any compression for
+        reading, decompressing it as it's read """
+    json_path = find_json(path)
+    if json_path is None:
+        raise IOError(2, 'No JSON file', path)
+    if json_path.endswith(COMPRESSION_SUFFIXES['gzip']):
+        return gzip.open(json_path, 'rb')
+    if json_path.endswith(COMPRESSION_SUFFIXES['zstd']):
+        if zstandard is None:
+            raise ValueError(
+                'zstd compression requires the zstandard package')
+        return zstandard.ZstdDecompressor().stream_reader(
+            open(json_path, 'rb'))
+    return open(json_path, 'rb')
+
+
+def load_json(path, **kwargs):
+    """ Load the JSON file written to path with any compression. Keyword
+        arguments are passed to json.loads. """
+    f = open_json(path)
+    try:
+        data = b''.join(iter(lambda: f.read(1 << 16), b''))
+    finally:
+        f.close()
+    return json.loads(data.decode('utf-8'), **kwargs)
@@ -7,11 +7,9 @@ from copy import deepcopy
 from collections import OrderedDict
 import string
 
-import inflect
-
+from regulation import inflection
 from regulation.node import (RegNode, xml_node_text, xml_mixed_text,
                              find_all_occurrences, enclosed_in_tag)
-import settings
 
 from lxml import etree
 
@@ -33,10 +31,15 @@ TAGS_WITH_INTRO_PARAS = ['{eregs}section',
 # should not have offsets calculated for the layers
 TAGS_WITHOUT_OFFSETS = ['{eregs}interpParagraph']
 
+# Most layers are built from both regulation and interpretation
+# paragraphs, with all regulation paragraphs coming first
+PARAGRAPH_TAGS = ('{eregs}paragraph',
+                  '{eregs}interpParagraph')
+
 
-def build_reg_tree(root, parent=None, depth=0):
+def build_reg_tree(root, parent=None, depth=0, cache=None):
     """
-    This function builds the basic JSON regulation tree recursively from the supplied
+    This function builds the basic JSON regulation tree from the supplied
     root element of the XML.
 
     :param root: The XML root. If this function is called from the outside, the root
@@ -47,11 +50,55 @@ def build_reg_tree(root, parent=None, depth=0):
     :type parent: :class:`etree.Element`
     :param depth: The depth at which the current element resides.
     :type depth: :class:`int`
+    :param cache: The formatted content cache for the tree. A new one is
+        created if none is given.
+    :type cache: :class:`FormattedContentCache`
 
     :return: The top node of the resulting tree.
     :rtype: :class:`regulation.node.RegNode`
     """
 
+    if cache is None:
+        cache = FormattedContentCache()
+
+    top, children = build_reg_node(root, parent, depth, cache)
+
+    # Nodes are built each before its children, with a stack of the
+    # children left to build below each node
+    stack = [(top, iter(children))]
+    while stack:
+        node, children = stack[-1]
+        child = next(children, None)
+        if child is None:
+            stack.pop()
+            continue
+        child_node, grandchildren = build_reg_node(child, node, node.depth + 1,
+                                                   cache)
+        node.children.append(child_node)
+        stack.append((child_node, iter(grandchildren)))
+
+    return top
+
+
+def build_reg_node(root, parent, depth, cache):
+    """
+    Builds the node of the regulation tree for a single element of the
+    XML, without its children.
+
+    :param root: The XML element.
+    :type root: :class:`etree.Element`
+    :param parent: The node of the element's parent, or None for the
+        ``<regulation>`` element.
+    :type parent: :class:`regulation.node.RegNode`
+    :param depth: The depth at which the element resides.
+    :type depth: :class:`int`
+    :param cache: The formatted content cache for the tree.
+    :type cache: :class:`FormattedContentCache`
+
+    :return: The node, and the XML elements of its children.
+    :rtype: :class:`tuple` of :class:`regulation.node.RegNode` and
+        :class:`list` of :class:`etree.Element`
+    """
     ns_prefix = '{eregs}'
     tag = root.tag.replace(ns_prefix, '')
     node = RegNode(include_children=True)
@@ -111,8 +158,8 @@ def build_reg_tree(root, parent=None, depth=0):
 
     elif tag == 'paragraph':
         title = root.find('{eregs}title')
-        content = apply_formatting(root.find('{eregs}content'))
-        content_text = xml_node_text(content)
+        content = cache.formatted(root.find('{eregs}content'))
+        content_text = cache.text(root.find('{eregs}content'))
 
         if title is not None:
             if title.get('type') != 'keyterm':
@@ -211,8 +258,8 @@ def build_reg_tree(root, parent=None, depth=0):
     elif tag == 'interpParagraph':
 
         title = root.find('{eregs}title')
-        content = apply_formatting(root.find('{eregs}content'))
-        content_text = xml_node_text(content)
+        content = cache.formatted(root.find('{eregs}content'))
+        content_text = cache.text(root.find('{eregs}content'))
 
         if title is not None:
             if title.get('type') != 'keyterm':
@@ -238,54 +285,106 @@ def build_reg_tree(root, parent=None, depth=0):
 
     node.depth = depth
 
-    for child in children:
-        node.children.append(build_reg_tree(child, parent=node, depth=depth+1))
+    return node, children
 
-    return node
 
-
-def build_paragraph_marker_layer(root):
+class LayerBuilder(object):
     """
-    Build the paragraph marker layer from the provided root of the XML tree.
+    Base class for the layer builders run by :class:`LayerPipeline`.
+
+    A builder declares the element ``tags`` it is interested in. The pipeline
+    calls :meth:`visit` with every matching element, in document order, one tag
+    at a time in the order given by ``tags``, and finally calls :meth:`finish`
+    to get the finished layer. Builders that do not need to see individual
+    elements leave ``tags`` empty and do all their work in :meth:`finish`.
 
     :param root: The root element of the XML tree.
     :type root: :class:`etree.Element`
-
-    :return: An OrderedDict containing the locations of markers, suitable for direct
-        transformation into JSON for use with the eRegs frontend.
-    :rtype: :class:`collections.OrderedDict`:
+    :param cache: The formatted content cache for the tree.
+    :type cache: :class:`FormattedContentCache`
     """
-    paragraphs = root.findall('.//{eregs}paragraph') # + root.findall('.//{eregs}interpParagraph')
-    paragraph_dict = OrderedDict()
 
-    for paragraph in paragraphs:
+    #: The layer type, used as the output directory under ``JSON_ROOT``.
+    layer_type = None
 
+    #: The element tags this builder wants to visit.
+    tags = ()
+
+    def __init__(self, root, cache=None):
+        self.root = root
+        self.layer = OrderedDict()
+        if cache is None:
+            cache = FormattedContentCache()
+        self.cache = cache
+
+    def visit(self, element):
+        """
+        Process a single element matching one of ``tags``.
+
+        :param element: The element to process.
+        :type element: :class:`etree.Element`
+        """
+        pass
+
+    def finish(self):
+        """
+        Complete the layer once all elements have been visited.
+
+        :return: The finished layer, suitable for direct transformation into JSON.
+        :rtype: :class:`collections.OrderedDict`:
+        """
+        return self.layer
+
+    @classmethod
+    def build(cls, root):
+        """
+        Build just this layer from the provided root of the XML tree.
+
+        :param root: The root element of the XML tree.
+        :type root: :class:`etree.Element`
+
+        :return: The finished layer.
+        :rtype: :class:`collections.OrderedDict`:
+        """
+        return LayerPipeline([cls]).run(root)[cls.layer_type]
+
+
+class ParagraphMarkerLayerBuilder(LayerBuilder):
+    """ Builds the paragraph marker layer. """
+
+    layer_type = 'layer/paragraph-markers'
+    tags = ('{eregs}paragraph',)
+
+    def visit(self, paragraph):
         marker = paragraph.get('marker')
         label = paragraph.get('label')
         if marker != '':
             marker_dict = {'locations': [0],
                            'text': marker}
-            paragraph_dict[label] = [marker_dict]
+            self.layer[label] = [marker_dict]
 
-    return paragraph_dict
 
-
-def build_internal_citations_layer(root):
+def build_paragraph_marker_layer(root):
     """
-    Build the internal citations layer from the provided root of the XML tree.
+    Build the paragraph marker layer from the provided root of the XML tree.
 
     :param root: The root element of the XML tree.
     :type root: :class:`etree.Element`
 
-    :return: An OrderedDict containing the locations of internal citations, suitable for direct
+    :return: An OrderedDict containing the locations of markers, suitable for direct
         transformation into JSON for use with the eRegs frontend.
     :rtype: :class:`collections.OrderedDict`:
     """
+    return ParagraphMarkerLayerBuilder.build(root)
 
-    paragraphs = root.findall('.//{eregs}paragraph') + root.findall('.//{eregs}interpParagraph')
-    layer_dict = OrderedDict()
 
-    for paragraph in paragraphs:
+class InternalCitationsLayerBuilder(LayerBuilder):
+    """ Builds the internal citations layer. """
+
+    layer_type = 'layer/internal-citations'
+    tags = PARAGRAPH_TAGS
+
+    def visit(self, paragraph):
         marker = paragraph.get('marker', '')
         title = paragraph.find('{eregs}title')
 
@@ -305,25 +404,17 @@ def build_internal_citations_layer(root):
         cite_positions = OrderedDict()
         cite_targets = OrderedDict()
 
-        content = apply_formatting(paragraph.find('{eregs}content'))
+        content = self.cache.formatted(paragraph.find('{eregs}content'))
         cites = content.findall('{eregs}ref[@reftype="internal"]')
+        offsets = child_offsets(content)
         citation_list = []
         for cite in cites:
             target = cite.get('target').split('-')
             text = cite.text
 
-            running_par_text = content.text or ''
-            for child in content.getchildren():
-                if child != cite:
-                    tail = child.tail or ''
-                    running_par_text += (child.text or '') + tail
-                else:
-                    break
-
-            cite_position = len(running_par_text) + total_offset
+            cite_position = offsets[cite] + total_offset
             cite_positions.setdefault(text, []).append(cite_position)
             cite_targets[text] = target
-            running_par_text = ''
 
         for cite, positions in cite_positions.items():
             # positions = find_all_occurrences(par_text, text)
@@ -341,27 +432,30 @@ def build_internal_citations_layer(root):
                     citation_list.append(cite_dict)
 
         if citation_list != []:
-            layer_dict[par_label] = citation_list
-
-    return layer_dict
+            self.layer[par_label] = citation_list
 
 
-def build_external_citations_layer(root):
+def build_internal_citations_layer(root):
     """
-    Build the external citations layer from the provided root of the XML tree.
+    Build the internal citations layer from the provided root of the XML tree.
 
     :param root: The root element of the XML tree.
     :type root: :class:`etree.Element`
 
-    :return: An OrderedDict containing the locations of external citations, suitable for direct
+    :return: An OrderedDict containing the locations of internal citations, suitable for direct
         transformation into JSON for use with the eRegs frontend.
     :rtype: :class:`collections.OrderedDict`:
     """
+    return InternalCitationsLayerBuilder.build(root)
 
-    paragraphs = root.findall('.//{eregs}paragraph')
-    layer_dict = OrderedDict()
 
-    for paragraph in paragraphs:
+class ExternalCitationsLayerBuilder(LayerBuilder):
+    """ Builds the external citations layer. """
+
+    layer_type = 'layer/external-citations'
+    tags = ('{eregs}paragraph',)
+
+    def visit(self, paragraph):
         marker = paragraph.get('marker')
         par_text = marker + ' ' + xml_node_text(
             paragraph.find('{eregs}content'))
@@ -390,32 +484,35 @@ def build_external_citations_layer(root):
                 citation_list.append(cite_dict)
 
         if citation_list != []:
-            layer_dict[par_label] = citation_list
-
-    return layer_dict
+            self.layer[par_label] = citation_list
 
 
-def build_graphics_layer(root):
+def build_external_citations_layer(root):
     """
-    Build the graphics layer from the provided root of the XML tree.
+    Build the external citations layer from the provided root of the XML tree.
 
     :param root: The root element of the XML tree.
     :type root: :class:`etree.Element`
 
-    :return: An OrderedDict containing the locations of markers, suitable for direct
+    :return: An OrderedDict containing the locations of external citations, suitable for direct
         transformation into JSON for use with the eRegs frontend.
     :rtype: :class:`collections.OrderedDict`:
     """
+    return ExternalCitationsLayerBuilder.build(root)
 
-    layer_dict = OrderedDict()
-    paragraphs = root.findall('.//{eregs}paragraph')
 
-    for paragraph in paragraphs:
+class GraphicsLayerBuilder(LayerBuilder):
+    """ Builds the graphics layer. """
+
+    layer_type = 'layer/graphics'
+    tags = ('{eregs}paragraph',)
+
+    def visit(self, paragraph):
         content = paragraph.find('{eregs}content')
         graphics = content.findall('{eregs}graphic')
         label = paragraph.get('label')
         if len(graphics) > 0:
-            layer_dict[label] = []
+            self.layer[label] = []
         for graphic in graphics:
             text = graphic.find('{eregs}text').text
             alt_text = graphic.find('{eregs}altText').text
@@ -428,29 +525,31 @@ def build_graphics_layer(root):
             graphic_dict['text'] = text
             graphic_dict['url'] = url
 
-            layer_dict[label].append(graphic_dict)
-
-    return layer_dict
+            self.layer[label].append(graphic_dict)
 
 
-def build_formatting_layer(root):
+def build_graphics_layer(root):
     """
-    Build the formatting layer from the provided root of the XML tree. Formatting elements include
-    things like callouts, tables, lines indicating spaces on a form, and so on.
+    Build the graphics layer from the provided root of the XML tree.
 
     :param root: The root element of the XML tree.
     :type root: :class:`etree.Element`
 
-    :return: An OrderedDict containing the locations of formatting elements, suitable for direct
+    :return: An OrderedDict containing the locations of markers, suitable for direct
         transformation into JSON for use with the eRegs frontend.
     :rtype: :class:`collections.OrderedDict`:
     """
+    return GraphicsLayerBuilder.build(root)
 
-    layer_dict = OrderedDict()
-    paragraphs = root.findall('.//{eregs}paragraph') + \
-        root.findall('.//{eregs}interpParagraph')
 
-    for paragraph in paragraphs:
+class FormattingLayerBuilder(LayerBuilder):
+    """ Builds the formatting layer. """
+
+    layer_type = 'layer/formatting'
+    tags = PARAGRAPH_TAGS
+
+    def visit(self, paragraph):
+        layer_dict = self.layer
         content = paragraph.find('{eregs}content')
         dashes = content.findall('.//{eregs}dash')
         tables = content.findall('.//{eregs}table')
@@ -553,7 +652,20 @@ def build_formatting_layer(root):
                 table_dict['text'] = ''
                 layer_dict[label].append(table_dict)
 
-    return layer_dict
+
+def build_formatting_layer(root):
+    """
+    Build the formatting layer from the provided root of the XML tree. Formatting elements include
+    things like callouts, tables, lines indicating spaces on a form, and so on.
+
+    :param root: The root element of the XML tree.
+    :type root: :class:`etree.Element`
+
+    :return: An OrderedDict containing the locations of formatting elements, suitable for direct
+        transformation into JSON for use with the eRegs frontend.
+    :rtype: :class:`collections.OrderedDict`:
+    """
+    return FormattingLayerBuilder.build(root)
 
 
 def apply_formatting(content_elm):
@@ -638,50 +750,115 @@ def apply_formatting(content_elm):
     return working_content
 
 
-def build_terms_layer(root):
+class FormattedContentCache(object):
     """
-    Build the terms layer from the provided root of the XML tree.
+    A cache of formatted ``<content>`` elements for a single XML tree.
 
-    :param root: The root element of the XML tree.
-    :type root: :class:`etree.Element`
+    :func:`apply_formatting` deep-copies the content it is given, and the same
+    paragraph's content is needed by :func:`build_reg_tree` and by several
+    layers. The cache formats each content element once, keyed on the element
+    itself, and shares the result and its text between all of them. Formatted
+    elements returned by the cache must not be modified.
 
-    :return: An OrderedDict containing the locations of terms, suitable for direct
-        transformation into JSON for use with the eRegs frontend.
-    :rtype: :class:`collections.OrderedDict`:
+    If the tree is modified after content has been cached, the modified
+    element must be passed to :meth:`invalidate` (or the cache cleared).
     """
 
-    definitions_dict = OrderedDict()
-    terms_dict = OrderedDict()
+    def __init__(self):
+        self._formatted = {}
+        self._text = {}
+
+    def formatted(self, content_elm):
+        """
+        Get the formatted version of a content element.
+
+        :param content_elm: The ``<content>`` element.
+        :type content_elm: :class:`etree.Element`
+
+        :return: the element with the inline formatting applied.
+        :rtype: :class:`etree.Element`:
+        """
+        if content_elm is None:
+            return apply_formatting(content_elm)
+
+        formatted = self._formatted.get(content_elm)
+        if formatted is None:
+            formatted = apply_formatting(content_elm)
+            self._formatted[content_elm] = formatted
+        return formatted
+
+    def text(self, content_elm):
+        """
+        Get the text of the formatted version of a content element.
+
+        :param content_elm: The ``<content>`` element.
+        :type content_elm: :class:`etree.Element`
+
+        :return: the text of the formatted content, without any markup.
+        :rtype: :class:`str`
+        """
+        text = self._text.get(content_elm)
+        if text is None:
+            text = xml_node_text(self.formatted(content_elm))
+            self._text[content_elm] = text
+        return text
+
+    def invalidate(self, element):
+        """
+        Drop any cached content within or around an element that has been
+        modified.
+
+        :param element: The modified element.
+        :type element: :class:`etree.Element`
+        """
+        stale = list(element.iterancestors('{eregs}content'))
+        stale.extend(element.iter('{eregs}content'))
+        for content_elm in stale:
+            self._formatted.pop(content_elm, None)
+            self._text.pop(content_elm, None)
+
+    def clear(self):
+        """ Drop everything in the cache. """
+        self._formatted.clear()
+        self._text.clear()
+
+
+class TermsLayerBuilder(LayerBuilder):
+    """
+    Builds the terms layer. Definitions are collected while paragraphs are
+    visited; references are resolved in :meth:`finish`, since a reference may
+    point at a definition that appears later in the document.
+    """
 
-    inf_engine = inflect.engine()
-    inf_engine.defnoun('bonus', 'bonuses')
+    layer_type = 'layer/terms'
+    tags = PARAGRAPH_TAGS
 
-    paragraphs = root.findall('.//{eregs}paragraph') + \
-        root.findall('.//{eregs}interpParagraph')
+    def __init__(self, root, cache=None):
+        super(TermsLayerBuilder, self).__init__(root, cache=cache)
+        self.definitions = OrderedDict()
+        # The key of the first definition in each paragraph, by label
+        self.definition_keys = {}
+        self.paragraphs = []
 
-    definitions = root.findall('.//{eregs}def')
+    def visit(self, paragraph):
+        self.paragraphs.append(paragraph)
 
-    paragraphs_with_defs = [par for par in paragraphs if par.find('{eregs}content') is not None
-                            and par.find('{eregs}content').find('{eregs}def') is not None]
+        if paragraph.find('{eregs}content') is None or \
+                paragraph.find('{eregs}content').find('{eregs}def') is None:
+            return
 
-    for paragraph in paragraphs_with_defs:
         label = paragraph.get('label')
         marker = paragraph.get('marker') or ''
         title = paragraph.find('{eregs}title')
-        content = apply_formatting(paragraph.find('{eregs}content'))
-        par_text = xml_node_text(content).strip()
+        content = self.cache.formatted(paragraph.find('{eregs}content'))
+        par_text = self.cache.text(paragraph.find('{eregs}content')).strip()
         definitions = content.findall('{eregs}def')
 
         total_offset = get_offset(paragraph, marker, title)
 
         for defn in definitions:
             defined_term = defn.get('term')
-            if inf_engine.singular_noun(defined_term.lower()) and not \
-                    defined_term.lower() in settings.SPECIAL_SINGULAR_NOUNS:
-                key = inf_engine.singular_noun(defined_term.lower()) + \
-                    ':' + label
-            else:
-                key = defined_term.lower() + ':' + label
+            key = inflection.singular(defined_term.lower()) + ':' + label
 
             def_text = defn.text
             positions = find_all_occurrences(par_text, def_text)
@@ -691,83 +868,89 @@ def build_terms_layer(root):
             def_dict['reference'] = label
             def_dict['term'] = defined_term
             if def_dict['position'] != []:
-                definitions_dict[key] = def_dict
-
-    for paragraph in paragraphs:
-        content = apply_formatting(paragraph.find('{eregs}content'))
-        terms = content.findall('.//{eregs}ref[@reftype="term"]')
-        title = paragraph.find('{eregs}title')
-        marker = paragraph.get('marker') or ''
-
-        label = paragraph.get('label')
-        # If this is a subparagraph of a type that wants an intro paragraph
-        # and this paragraph is intro text, set the paragraph's label to reference
-        # the parent's
-        if wants_intro_text(paragraph.getparent()) and is_intro_text(paragraph):
-            # This intro paragraph will get attached to its parent node by
-            # build_reg_tree
-            label = paragraph.getparent().get('label')
-
-        if len(terms) > 0:
-            terms_dict[label] = []
+                self.definitions[key] = def_dict
+                self.definition_keys.setdefault(label, key)
 
-        total_offset = get_offset(paragraph, marker, title)
-
-        term_positions = OrderedDict()
-        term_targets = OrderedDict()
-
-        for term in terms:
-            running_par_text = content.text or ''
-            for child in content.getchildren():
-                if child != term:
-                    tail = child.tail or ''
-                    running_par_text += child.text + tail
-                else:
-                    break
-
-            text = term.text
-            target = term.get('target')
-            defn_location = [key for key, defn in definitions_dict.items() if defn['reference'] == target]
-            if len(defn_location) > 0:
-                defn_location = defn_location[0]
-                term_position = len(running_par_text) + total_offset
-                term_positions.setdefault(text, []).append(term_position)
-                term_targets[text] = defn_location
-
-        for term, positions in term_positions.items():
-            target = term_targets[term]
-            ref_dict = OrderedDict()
-            ref_dict['offsets'] = []
-            for pos in positions:
-                ref_dict['offsets'].append([pos, pos + len(term)])
-            ref_dict['ref'] = target
-            if len(ref_dict['offsets']) > 0 and \
-                    ref_dict not in terms_dict[label]:
-                terms_dict[label].append(ref_dict)
+    def finish(self):
+        definitions_dict = self.definitions
+        definition_keys = self.definition_keys
+        terms_dict = self.layer
 
-    terms_dict['referenced'] = definitions_dict
+        for paragraph in self.paragraphs:
+            content = self.cache.formatted(paragraph.find('{eregs}content'))
+            terms = content.findall('.//{eregs}ref[@reftype="term"]')
+            title = paragraph.find('{eregs}title')
+            marker = paragraph.get('marker') or ''
 
-    return terms_dict
+            label = paragraph.get('label')
+            # If this is a subparagraph of a type that wants an intro paragraph
+            # and this paragraph is intro text, set the paragraph's label to reference
+            # the parent's
+            if wants_intro_text(paragraph.getparent()) and is_intro_text(paragraph):
+                # This intro paragraph will get attached to its parent node by
+                # build_reg_tree
+                label = paragraph.getparent().get('label')
+
+            if len(terms) > 0:
+                terms_dict[label] = []
+            # The refs in the paragraph's list, by target and offsets
+            label_refs = set()
+
+            total_offset = get_offset(paragraph, marker, title)
+
+            term_positions = OrderedDict()
+            term_targets = OrderedDict()
+            offsets = child_offsets(content)
+
+            for term in terms:
+                text = term.text
+                target = term.get('target')
+                defn_location = definition_keys.get(target)
+                if defn_location is not None:
+                    term_position = offsets[term] + total_offset
+                    term_positions.setdefault(text, []).append(term_position)
+                    term_targets[text] = defn_location
+
+            for term, positions in term_positions.items():
+                target = term_targets[term]
+                ref_dict = OrderedDict()
+                ref_dict['offsets'] = []
+                for pos in positions:
+                    ref_dict['offsets'].append([pos, pos + len(term)])
+                ref_dict['ref'] = target
+                ref_key = (target, tuple(tuple(offset)
+                                         for offset in ref_dict['offsets']))
+                if len(ref_dict['offsets']) > 0 and ref_key not in label_refs:
+                    terms_dict[label].append(ref_dict)
+                    label_refs.add(ref_key)
+
+        terms_dict['referenced'] = definitions_dict
+
+        return terms_dict
 
 
-def build_toc_layer(root):
+def build_terms_layer(root):
     """
-    Build the paragraph table-of-contents layer from the provided root of the XML tree.
+    Build the terms layer from the provided root of the XML tree.
 
-    :param root: A root element containing tableOfContents elements.
+    :param root: The root element of the XML tree.
     :type root: :class:`etree.Element`
 
-    :return: An OrderedDict containing the table of contents, suitable for direct
+    :return: An OrderedDict containing the locations of terms, suitable for direct
         transformation into JSON for use with the eRegs frontend.
     :rtype: :class:`collections.OrderedDict`:
     """
+    return TermsLayerBuilder.build(root)
+
 
-    toc_dict = OrderedDict()
+class TocLayerBuilder(LayerBuilder):
+    """ Builds the table-of-contents layer. """
 
-    # Look for all tables of contents in the given element and add them
-    # to the layer.
-    tables_of_contents = root.findall('.//{eregs}tableOfContents')
-    for toc in tables_of_contents:
+    layer_type = 'layer/toc'
+    tags = ('{eregs}tableOfContents',)
+
+    def visit(self, toc):
+        toc_dict = self.layer
         parent = toc.getparent()
         if parent.tag == '{eregs}content':
             parent = parent.getparent()
@@ -801,37 +984,51 @@ def build_toc_layer(root):
             toc_entry = {'index': target, 'title': subject}
             toc_dict[label].append(toc_entry)
 
-    return toc_dict
-
 
-def build_keyterm_layer(root):
+def build_toc_layer(root):
     """
-    Build the keyterm layer from the provided XML tree.
+    Build the paragraph table-of-contents layer from the provided root of the XML tree.
 
-    :param root: The root element of an XML tree containing paragraphs.
+    :param root: A root element containing tableOfContents elements.
     :type root: :class:`etree.Element`
 
-    :return: An OrderedDict containing the locations of keyterms, suitable for direct
+    :return: An OrderedDict containing the table of contents, suitable for direct
         transformation into JSON for use with the eRegs frontend.
     :rtype: :class:`collections.OrderedDict`:
     """
+    return TocLayerBuilder.build(root)
+
 
-    keyterm_dict = OrderedDict()
-    paragraphs = root.findall('.//{eregs}paragraph') \
-               + root.findall('.//{eregs}interpParagraph')
+class KeytermLayerBuilder(LayerBuilder):
+    """ Builds the keyterm layer. """
 
-    for paragraph in paragraphs:
+    layer_type = 'layer/keyterms'
+    tags = PARAGRAPH_TAGS
+
+    def visit(self, paragraph):
         title = paragraph.find('{eregs}title')
         if title is not None and title.get('type') == 'keyterm':
             label = paragraph.get('label')
-            keyterm_dict[label] = [
+            self.layer[label] = [
                 {
                     'key_term': title.text,
                     'locations': [0]
                 }
             ]
 
-    return keyterm_dict
+
+def build_keyterm_layer(root):
+    """
+    Build the keyterm layer from the provided XML tree.
+
+    :param root: The root element of an XML tree containing paragraphs.
+    :type root: :class:`etree.Element`
+
+    :return: An OrderedDict containing the locations of keyterms, suitable for direct
+        transformation into JSON for use with the eRegs frontend.
+    :rtype: :class:`collections.OrderedDict`:
+    """
+    return KeytermLayerBuilder.build(root)
 
 
 def build_meta_layer(root):
@@ -1097,6 +1294,122 @@ def build_notice(root):
     return notice_dict
 
 
+class MetaLayerBuilder(LayerBuilder):
+    """ Builds the meta layer. """
+
+    layer_type = 'layer/meta'
+
+    def finish(self):
+        return build_meta_layer(self.root)
+
+
+class InterpLayerBuilder(LayerBuilder):
+    """ Builds the interpretations layer. """
+
+    layer_type = 'layer/interpretations'
+
+    def finish(self):
+        return build_interp_layer(self.root)
+
+
+class AnalysisLayerBuilder(LayerBuilder):
+    """ Builds the analysis layer. """
+
+    layer_type = 'layer/analyses'
+
+    def finish(self):
+        return build_analysis(self.root)
+
+
+class NoticeBuilder(LayerBuilder):
+    """ Builds the notice dictionary. """
+
+    layer_type = 'notice'
+
+    def finish(self):
+        return build_notice(self.root)
+
+
+class LayerPipeline(object):
+    """
+    Builds a set of layers from a single walk of the XML tree.
+
+    Every registered :class:`LayerBuilder` declares the element tags it wants to
+    see. The pipeline collects all of those elements in one pass over the tree
+    and hands them to each builder in document order, so that the layers are
+    identical to the ones produced by the individual ``build_*`` functions.
+
+    :param builders: The builder classes to run, in output order. Defaults to
+        :data:`LAYER_BUILDERS`.
+    :type builders: :class:`list` of :class:`LayerBuilder` subclasses
+    """
+
+    def __init__(self, builders=None):
+        if builders is None:
+            builders = LAYER_BUILDERS
+        self.builders = list(builders)
+
+    def register(self, builder):
+        """
+        Add a builder class to the pipeline.
+
+        :param builder: The builder class to add.
+        :type builder: :class:`LayerBuilder` subclass
+        """
+        self.builders.append(builder)
+
+    def run(self, root, cache=None):
+        """
+        Build every registered layer from the provided root of the XML tree.
+
+        :param root: The root element of the XML tree.
+        :type root: :class:`etree.Element`
+        :param cache: The formatted content cache for the tree, shared by all
+            builders. A new one is created if none is given.
+        :type cache: :class:`FormattedContentCache`
+
+        :return: An OrderedDict mapping each builder's layer type to its layer,
+            in the order the builders were registered.
+        :rtype: :class:`collections.OrderedDict`:
+        """
+        if cache is None:
+            cache = FormattedContentCache()
+        builders = [builder(root, cache=cache) for builder in self.builders]
+
+        elements = OrderedDict()
+        for builder in builders:
+            for tag in builder.tags:
+                elements.setdefault(tag, [])
+
+        if len(elements) > 0:
+            for element in root.iterdescendants(*elements.keys()):
+                elements[element.tag].append(element)
+
+        layers = OrderedDict()
+        for builder in builders:
+            for tag in builder.tags:
+                for element in elements[tag]:
+                    builder.visit(element)
+            layers[builder.layer_type] = builder.finish()
+
+        return layers
+
+
+# The layers written by the json command, in the order they are written.
+LAYER_BUILDERS = [MetaLayerBuilder,
+                  ParagraphMarkerLayerBuilder,
+                  InternalCitationsLayerBuilder,
+                  ExternalCitationsLayerBuilder,
+                  TermsLayerBuilder,
+                  TocLayerBuilder,
+                  KeytermLayerBuilder,
+                  GraphicsLayerBuilder,
+                  FormattingLayerBuilder,
+                  InterpLayerBuilder,
+                  AnalysisLayerBuilder,
+                  NoticeBuilder]
+
+
 def is_intro_text(item):
     """
     Determines whether an element is an intro paragraph to some type of
@@ -1143,6 +1456,28 @@ def wants_intro_text(element):
     else:
         return False
 
+def child_offsets(element):
+    """
+    Finds where each child of an element starts in the element's text,
+    the element's own text followed by each child's text and tail.
+    Elements nested further down are placed at the end of that text.
+
+    :param element: The element whose descendants to find
+    :type element: :class:`etree.Element`
+
+    :return: The offset of each descendant, by descendant
+    :rtype: dict
+    """
+    offsets = {}
+    offset = len(element.text or '')
+    for child in element:
+        offsets[child] = offset
+        offset += len(child.text or '') + len(child.tail or '')
+    for descendant in element.iterdescendants():
+        offsets.setdefault(descendant, offset)
+    return offsets
+
+
 def get_offset(element, marker='', title=None):
     """
     Determines the overall offset to apply to an element from the given
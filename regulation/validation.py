@@ -4,15 +4,24 @@ from __future__ import unicode_literals
 
 import copy
 from enum import Enum
+import hashlib
 import operator
+import os
 import re
+import time
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 
 from termcolor import colored, cprint
 from lxml import etree
-from .node import xml_node_text, find_all_occurrences, interpolate_string, enclosed_in_tag
+from .node import (xml_node_text, find_all_occurrences, interpolate_string,
+                   PatternMatcher, TagSpans, tree_labels)
 from .changes import get_parent_label
+from . import inflection
 
-import inflect
 import re
 
 import regulation.settings as settings
@@ -64,6 +73,148 @@ class EregsValidationEvent(Exception):
         return msg
 
 
+# Compiled schemas, by the path or URL of their XSD file and its
+# modification time, so that each schema is only compiled once per process
+_schema_cache = {}
+
+# How many seconds copies of remote XSD documents are used for, by default
+XSD_CACHE_MAX_AGE = 24 * 60 * 60
+
+
+def _schema_key(xsd_file):
+    """ The path or URL of an XSD file and the time it was last modified,
+        if it's a local file """
+    if '://' in xsd_file:
+        return xsd_file, None
+    xsd_path = os.path.abspath(xsd_file)
+    try:
+        return xsd_path, os.path.getmtime(xsd_path)
+    except OSError:
+        return xsd_path, None
+
+
+def _schema_copy_path(cache_dir, key):
+    digest = hashlib.sha256(key[0].encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, 'schema-{}.pickle'.format(digest))
+
+
+def _is_url(location):
+    return '://' in location
+
+
+def _document_mtimes(documents):
+    """ The modification time of each local file among the documents, or
+        None if it's gone """
+    mtimes = {}
+    for location in documents:
+        if not _is_url(location):
+            try:
+                mtimes[location] = os.path.getmtime(location)
+            except OSError:
+                mtimes[location] = None
+    return mtimes
+
+
+class _SchemaDocuments(etree.Resolver):
+    """ Resolves a schema's XSD documents, the one it's compiled from and
+        any it includes or imports, from the copies in documents, by their
+        path or URL. Documents that aren't there are read and kept, unless
+        the documents are fixed. """
+
+    def __init__(self, documents=None, fixed=False):
+        super(_SchemaDocuments, self).__init__()
+        self.documents = {} if documents is None else documents
+        self.fixed = fixed
+
+    def read(self, location):
+        if location not in self.documents:
+            self.documents[location] = etree.tostring(etree.parse(location))
+        return self.documents[location]
+
+    def resolve(self, url, public_id, context):
+        if self.fixed and url not in self.documents:
+            return None
+        return self.resolve_string(self.read(url), context, base_url=url)
+
+    def compile(self, location):
+        """ Compile the schema in the XSD at location """
+        try:
+            xsd = self.read(location)
+        except (IOError, etree.XMLSyntaxError) as e:
+            raise etree.XMLSchemaParseError(str(e))
+        parser = etree.XMLParser()
+        parser.resolvers.add(self)
+        return etree.XMLSchema(etree.fromstring(xsd, parser,
+                                                base_url=location))
+
+
+def _load_schema_copy(cache_dir, key, max_age):
+    """ Compile a schema from the copies of its XSD documents in cache_dir,
+        if there are copies of this version of each local file and any
+        remote documents were fetched less than max_age seconds ago """
+    try:
+        with open(_schema_copy_path(cache_dir, key), 'rb') as f:
+            copy_key, documents, mtimes, fetched = pickle.load(f)
+    except Exception:
+        return None
+    if tuple(copy_key) != key or _document_mtimes(documents) != mtimes:
+        return None
+    if any(_is_url(location) for location in documents) and \
+            not 0 <= time.time() - fetched < max_age:
+        return None
+    try:
+        return _SchemaDocuments(documents, fixed=True).compile(key[0])
+    except etree.LxmlError:
+        return None
+
+
+def _save_schema_copy(cache_dir, key, documents, fetched):
+    """ Save copies of a schema's XSD documents in cache_dir so they don't
+        need to be read or fetched again """
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        copy_path = _schema_copy_path(cache_dir, key)
+        with open(copy_path + '.tmp', 'wb') as f:
+            pickle.dump((key, documents, _document_mtimes(documents),
+                         fetched), f, pickle.HIGHEST_PROTOCOL)
+        os.rename(copy_path + '.tmp', copy_path)
+    except EnvironmentError:
+        pass
+
+
+def get_schema(xsd_file, cache_dir=None, max_age=XSD_CACHE_MAX_AGE):
+    """
+    Get the compiled schema for an XSD file. Each schema is compiled once
+    per process and again only if the XSD file changes. If a cache_dir is
+    given, copies of the XSD and every XSD it includes or imports are kept
+    there for other processes. The copies are replaced when a local file
+    among them changes, or, if any were fetched from a URL, once they're
+    max_age seconds old.
+
+    :param xsd_file: the local path or URL of the XSD file.
+    :param cache_dir: an optional directory for copies of the XSD documents.
+    :param max_age: how many seconds copies of remote XSD documents are used.
+    :return: :class:`etree.XMLSchema`: the compiled schema.
+    """
+    key = _schema_key(xsd_file)
+    schema = _schema_cache.get(key)
+    if schema is not None:
+        return schema
+
+    if cache_dir is not None:
+        schema = _load_schema_copy(cache_dir, key, max_age)
+    if schema is None:
+        fetched = time.time()
+        documents = _SchemaDocuments()
+        schema = documents.compile(key[0])
+        if cache_dir is not None:
+            _save_schema_copy(cache_dir, key, documents.documents, fetched)
+
+    _schema_cache[key] = schema
+    return schema
+
+
 class EregsValidator:
     """
     A class encapsulating various validation strategies for ensuring correct output.
@@ -85,7 +236,10 @@ class EregsValidator:
         :return: :class:`etree.XMLSchema`: the schema object used to validate the reg.
         """
         try:
-            return etree.XMLSchema(file=self.xsd_file)
+            return get_schema(self.xsd_file,
+                              getattr(settings, 'XSD_CACHE_DIR', None),
+                              getattr(settings, 'XSD_CACHE_MAX_AGE',
+                                      XSD_CACHE_MAX_AGE))
         except etree.XMLSchemaParseError:
             cprint(
                 'Error occurred when reading schema file {}; did you forget '
@@ -217,8 +371,6 @@ class EregsValidator:
         :return: None.
         """
 
-        inf = inflect.engine()
-
         problem_flag = False
 
         definitions = terms_layer['referenced']
@@ -242,9 +394,7 @@ class EregsValidator:
             for ref in refs:
                 term = (ref.text or '').lower()
 
-                if term not in settings.SPECIAL_SINGULAR_NOUNS and \
-                        inf.singular_noun(term):
-                    term = inf.singular_noun(term)
+                term = inflection.singular(term)
 
                 location = ref.get('target') or ''
 
@@ -297,11 +447,11 @@ class EregsValidator:
         :type term: :class:`str`
         :param notice: the root of a notice XML tree
         :type notice: :class:`etree.Element`
-        :return: None
+        :return: whether the altered tree was written to regulation_file.
+        :rtype: :class:`bool`
         """
 
         problem_flag = False
-        inf = inflect.engine()
 
         definitions = terms_layer['referenced']
         terms = set([(defn['term'], defn['reference']) for key, defn in definitions.items()])
@@ -315,7 +465,7 @@ class EregsValidator:
             except StopIteration:
                 print(colored("{} is not a defined term".format(term),
                     'red'))
-                return
+                return False
             terms = set([(term, reference),
                          (term[0].upper() + term[1:], reference)])
 
@@ -334,26 +484,33 @@ class EregsValidator:
         ignore = set()
         always = set()
 
+        # Every form of every term is found in a paragraph in one pass
+        plurals = dict((t, inflection.plural(t)) for t, reference in terms)
+        matcher = PatternMatcher(sorted(set(plurals.keys()) |
+                                        set(plurals.values())))
+
         for paragraph in paragraphs:
             content = paragraph.find('.//{eregs}content')
             par_text = unicode(etree.tostring(content,
                 encoding='UTF-8'))
             label = paragraph.get('label')
             offsets_and_values = []
+            occurrences = matcher.find_all_occurrences(par_text)
+            spans = TagSpans(par_text)
 
             for term in terms:
                 if term[0] not in ignore and label != term[1]:
                     input_state = None
-                    term_locations = set(find_all_occurrences(par_text, term[0]))
-                    plural_term = inf.plural(term[0])
-                    plural_term_locations = set(find_all_occurrences(par_text, plural_term))
+                    term_locations = set(occurrences.get(term[0], []))
+                    plural_term = plurals[term[0]]
+                    plural_term_locations = set(occurrences.get(plural_term, []))
                     unmarked_locs = list(plural_term_locations | term_locations ^ plural_term_locations)
                     for term_loc in unmarked_locs:
                         if term_loc in plural_term_locations:
                             term_to_use = plural_term
                         elif term_loc in term_locations:
                             term_to_use = term[0]
-                        if not enclosed_in_tag(par_text, 'ref', term_loc) and not enclosed_in_tag(par_text, 'def', term_loc):
+                        if not spans.encloses('ref', term_loc) and not spans.encloses('def', term_loc):
                             if input_state is None:
 
                                 highlighted_par = colored(par_text[0:term_loc], 'yellow') + \
@@ -426,8 +583,12 @@ class EregsValidator:
                         # path given is to the notice, not the
                         # regulation.
                         f.write(etree.tostring(notice, pretty_print=True, encoding='UTF-8'))
+                return True
+
+        return False
 
-    def validate_internal_cites(self, tree, internal_cites_layer):
+    def validate_internal_cites(self, tree, internal_cites_layer,
+                                labels=None):
         """
         Validate the tree to make sure that all internal cites refer to
         an existing label. After validation, ``self.events``
@@ -437,18 +598,28 @@ class EregsValidator:
         :type tree: :class:`etree.Element`
         :param internal_cites_layer: the dictionary of internal cites.
         :type internal_cites_layer: :class:`collections.OrderedDict`
+        :param labels: the labels in the tree, if they're already known, as a set or a :class:`regulation.node.LabelIndex`.
+        :type labels: :class:`frozenset` of :class:`str`
         :return: None
 
         """
         problem_flag = False
 
-        # cites = tree.findall('.//{eregs}ref[@reftype="internal"]')
-        labeled_elements = tree.findall('.//')
-        labels = [elem.get('label') for elem in labeled_elements
-                  if elem.get('label') is not None]
+        if labels is None:
+            labels = tree_labels(tree)
+
+        # Check every label and citation in the layer at once, so that
+        # only those that are missing have to be looked at one by one
+        citations = dict((label, ['-'.join(cite['citation'])
+                                  for cite in cites])
+                         for label, cites in internal_cites_layer.items())
+        referenced = set(internal_cites_layer.keys())
+        for label_citations in citations.values():
+            referenced.update(label_citations)
+        missing = set(label for label in referenced if label not in labels)
 
         for label, cites in internal_cites_layer.items():
-            if label not in labels:
+            if label in missing:
                 msg = 'NONEXISTENT LABEL: ' \
                       'Internal layer attempts to reference label {} ' \
                       'but that label does not exist in the XML! ' \
@@ -457,9 +628,8 @@ class EregsValidator:
                 self.events.append(event)
                 problem_flag = True
 
-            for cite in cites:
-                citation = '-'.join(cite['citation'])
-                if citation not in labels:
+            for citation in citations[label]:
+                if citation in missing:
                     msg = 'NONEXISTENT CITATION: ' \
                           'There is a reference to label {} in {} but ' \
                           'that referenced label does not exist. ' \
@@ -490,7 +660,8 @@ class EregsValidator:
         :type tree: :class:`etree.Element`
         :param regulation_file: path to the regulation file to which to save changes.
         :type regulation_file: :class:`str`
-        :return: None
+        :return: whether the altered tree was written to regulation_file.
+        :rtype: :class:`bool`
         """
         paragraphs = tree.findall('.//{eregs}paragraph') + tree.findall('.//{eregs}interpParagraph')
         pattern = re.compile('([0-9]{4}\.([0-9]+)(\(([a-zA-Z]+|[0-9])+\))+)')
@@ -512,12 +683,13 @@ class EregsValidator:
             matches = set([match[0] for match in pattern.findall(par_text)])
             label = paragraph.get('label')
             offsets_and_values = []
+            spans = TagSpans(par_text)
 
             for match in matches:
                 locations = set(find_all_occurrences(par_text, match, boundary=False))
                 input_state = None
                 for loc in locations:
-                    if not enclosed_in_tag(par_text, 'ref', loc):
+                    if not spans.encloses('ref', loc):
                         highlighted_par = colored(par_text[0:loc], 'yellow') + \
                                           colored(match, 'red') + \
                                           colored(par_text[loc + len(match):], 'yellow')
@@ -561,6 +733,9 @@ class EregsValidator:
             if answer == 'y':
                 with open(regulation_file, 'w') as f:
                     f.write(etree.tostring(tree, pretty_print=True))
+                return True
+
+        return False
 
     def headerize_interps(self, tree, regulation_file):
         """
@@ -8,6 +8,15 @@ import os
 # XSD_FILE = '../regulations-schema/src/eregs.xsd'
 XSD_FILE = os.environ.get('XSD_FILE', '../regulations-schema/src/eregs.xsd')
 
+# XSD_CACHE_DIR is an optional directory in which to keep copies of the
+# RegML schema and the XSD files it includes or imports, so that a remote
+# XSD_FILE doesn't have to be fetched on every run. The copies are
+# replaced whenever one of the local files changes, and copies of remote
+# files once they're XSD_CACHE_MAX_AGE seconds old.
+# XSD_CACHE_DIR = '.schema-cache'
+XSD_CACHE_DIR = os.environ.get('XSD_CACHE_DIR')
+XSD_CACHE_MAX_AGE = int(os.environ.get('XSD_CACHE_MAX_AGE', 24 * 60 * 60))
+
 # XML_ROOT is the path to Regulations XML files that this parser is
 # intended to parse. Files in this location are expected to be stored
 # under regulation/[PART NUMBER] and notice/[PART NUMBER] for regulation
@@ -18,6 +27,12 @@ XSD_FILE = os.environ.get('XSD_FILE', '../regulations-schema/src/eregs.xsd')
 # XML_ROOT = '../regulations-xml'
 XML_ROOT = os.environ.get('XML_ROOT', '../regulations-xml')
 
+# HEADER_INDEX_FILE is an optional file in which to keep the document
+# numbers and dates read from the RegML files in XML_ROOT, so that listing
+# versions and notices only reads the files that have changed.
+# HEADER_INDEX_FILE = '.regml-headers.json'
+HEADER_INDEX_FILE = os.environ.get('HEADER_INDEX_FILE')
+
 # JSON_ROOT is the path to the JSON output of this parser that is
 # expected by regulations-core.
 #
@@ -26,6 +41,19 @@ XML_ROOT = os.environ.get('XML_ROOT', '../regulations-xml')
 # JSON_ROOT = '../regulations-stub/stub'
 JSON_ROOT = os.environ.get('JSON_ROOT', '../regulations-stub/stub')
 
+# JSON_COMPRESSION is how the JSON output is compressed: None for plain
+# JSON files, 'gzip' for files with a .gz suffix, or 'zstd' for files
+# with a .zst suffix. zstd requires the zstandard package.
+# JSON_COMPRESSION = 'gzip'
+JSON_COMPRESSION = os.environ.get('JSON_COMPRESSION') or None
+
+# JSON_LAYOUT is how the JSON output is laid out in JSON_ROOT: 'files' for
+# a file for each layer of each version, or 'archive' for a single zip
+# archive for each version, in archive/[PART NUMBER]/[VERSION].zip.
+# Archives can be exploded into files with the explode-archive command.
+# JSON_LAYOUT = 'archive'
+JSON_LAYOUT = os.environ.get('JSON_LAYOUT', 'files')
+
 # SPECIAL_SINGULAR_NOURS provides overrides for singular nouns that the
 # inflect module has problems with.
 SPECIAL_SINGULAR_NOUNS = [
@@ -34,6 +62,12 @@ SPECIAL_SINGULAR_NOUNS = [
     'surplus',
 ]
 
+# INFLECTION_CACHE_FILE is an optional file in which to keep the singular
+# and plural forms of defined terms, so that they don't have to be worked
+# out again on every run.
+# INFLECTION_CACHE_FILE = '.regml-inflections.json'
+INFLECTION_CACHE_FILE = os.environ.get('INFLECTION_CACHE_FILE')
+
 CUSTOM_NOTICE_ORDER = {
 
     '1005': ['2013-06861', '2012-1728', '2012-16245', '2012-19702',
@@ -1 +1,139 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+
+import lxml.etree as etree
+
+from regulation.fmes.fast_match import (Delete, EditScript, FastMatch, Insert,
+                                        Move, Update, build_tree,
+                                        longest_common_subsequence,
+                                        longest_increasing_subsequence)
+
 __author__ = 'vinokurovy'
+
+
+class FastMatchTests(TestCase):
+
+    regulation = """
+        <regulation xmlns="eregs">
+          <part label="1234">
+            <section label="1234-1">
+              <subject>Section 1</subject>
+              {}
+            </section>
+            <section label="1234-2">
+              <subject>Section 2</subject>
+              {}
+            </section>
+          </part>
+        </regulation>"""
+
+    paragraphs = {
+        'a': '<paragraph label="1234-1-a" marker="a"><content>The first paragraph of <ref target="1234-2">section 2</ref>.</content></paragraph>',
+        'b': '<paragraph label="1234-1-b" marker="b"><content>The second paragraph</content></paragraph>',
+        'c': '<paragraph label="1234-1-c" marker="c"><content>The third paragraph</content></paragraph>',
+        'd': '<paragraph label="1234-2-a" marker="a"><content>Another paragraph</content></paragraph>',
+    }
+
+    def tree(self, first, second):
+        return etree.fromstring(self.regulation.format(
+            ''.join(self.paragraphs[p] for p in first),
+            ''.join(self.paragraphs[p] for p in second)))
+
+    def shape(self, node):
+        return (node.tag, node.value,
+                [self.shape(child) for child in node.children])
+
+    def edit_script(self, left, right):
+        script = EditScript(left, right)
+        # The script transforms the left tree into the right one
+        self.assertEqual(self.shape(script.right), self.shape(script.left))
+        return script
+
+    def test_build_tree(self):
+        root = build_tree(self.tree('a', 'd'))
+        self.assertEqual('{eregs}regulation', root.tag)
+        part = root.children[0]
+        self.assertEqual('1234', part.key)
+        self.assertEqual(((('label', '1234'),), None), part.value)
+
+        # Elements with mixed content are leaves
+        content = part.children[0].children[1].children[0]
+        self.assertTrue(content.is_leaf)
+        self.assertEqual(
+            ((), 'The first paragraph of <ref target="1234-2">section 2</ref>.'),
+            content.value)
+
+    def test_longest_common_subsequence(self):
+        equal = lambda left, right: left == right
+        self.assertEqual([(0, 0), (2, 1), (3, 3)],
+                         longest_common_subsequence('abcd', 'acxd', equal))
+        self.assertEqual([], longest_common_subsequence('abc', '', equal))
+        self.assertEqual([], longest_common_subsequence('abc', 'xyz', equal))
+
+    def test_longest_increasing_subsequence(self):
+        self.assertEqual([0, 2, 3],
+                         longest_increasing_subsequence([1, 5, 2, 3, 0]))
+        self.assertEqual([], longest_increasing_subsequence([]))
+
+    def test_match(self):
+        left = build_tree(self.tree('abc', 'd'))
+        right = build_tree(self.tree('acb', ''))
+        FastMatch(left, right).match()
+
+        for left_node in left.children[0].children[0].children:
+            self.assertEqual(left_node.key, left_node.partner.key)
+        # Labelled elements aren't matched to elements with other labels
+        self.assertEqual(None, left.children[0].children[1].children[1].partner)
+
+    def test_match_different_roots(self):
+        with self.assertRaises(ValueError):
+            FastMatch(build_tree(etree.fromstring('<a/>')),
+                      build_tree(etree.fromstring('<b/>'))).match()
+
+    def test_edit_script_unchanged(self):
+        self.assertEqual(0, len(self.edit_script(self.tree('abc', 'd'),
+                                                 self.tree('abc', 'd'))))
+
+    def test_edit_script_update(self):
+        right = self.tree('abc', 'd')
+        right.find('.//{eregs}paragraph[@label="1234-1-b"]/{eregs}content').text = \
+            'The changed second paragraph'
+        operations = list(self.edit_script(self.tree('abc', 'd'), right))
+        self.assertEqual(1, len(operations))
+        self.assertTrue(isinstance(operations[0], Update))
+        self.assertEqual(((), 'The changed second paragraph'),
+                         operations[0].value)
+
+    def test_edit_script_insert(self):
+        operations = list(self.edit_script(self.tree('ac', 'd'),
+                                           self.tree('abc', 'd')))
+        self.assertEqual([Insert, Insert],
+                         [type(operation) for operation in operations])
+        self.assertEqual('1234-1-b', operations[0].node.key)
+        self.assertEqual(2, operations[0].position)
+        self.assertEqual('{eregs}content', operations[1].node.tag)
+
+    def test_edit_script_delete(self):
+        operations = list(self.edit_script(self.tree('abc', 'd'),
+                                           self.tree('ac', 'd')))
+        self.assertEqual([Delete, Delete],
+                         [type(operation) for operation in operations])
+        self.assertEqual('{eregs}content', operations[0].node.tag)
+        self.assertEqual('1234-1-b', operations[1].node.key)
+
+    def test_edit_script_move(self):
+        operations = list(self.edit_script(self.tree('abc', 'd'),
+                                           self.tree('ab', 'dc')))
+        self.assertEqual(1, len(operations))
+        self.assertTrue(isinstance(operations[0], Move))
+        self.assertEqual('1234-1-c', operations[0].node.key)
+        self.assertEqual('1234-2', operations[0].parent.key)
+        self.assertEqual(2, operations[0].position)
+
+    def test_edit_script_reorder(self):
+        operations = list(self.edit_script(self.tree('abc', 'd'),
+                                           self.tree('cab', 'd')))
+        self.assertEqual(1, len(operations))
+        self.assertTrue(isinstance(operations[0], Move))
+        self.assertEqual(1, operations[0].position)
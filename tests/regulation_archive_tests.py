@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from mock import patch
+
+from regulation.archive import (JSONArchive, JSONArchiveWriter, archive_path,
+                                json_layout, member_name)
+from regulation.manifest import JSONManifest
+from regulation.output import load_json
+
+
+class ArchiveTests(TestCase):
+
+    def setUp(self):
+        self.json_root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.json_root)
+
+    def write_version(self, layers, compact=False):
+        with JSONArchiveWriter.for_version('1234', '2015-12345',
+                                           json_root=self.json_root,
+                                           compact=compact) as writer:
+            for layer_type, layer in layers:
+                writer.write(layer, layer_type, '1234', '2015-12345')
+
+    def test_member_name(self):
+        self.assertEqual('layer/terms/1234/2015-12345',
+                         member_name('layer/terms', '1234', '2015-12345'))
+        self.assertEqual('diff/1234/2015-12345/2016-12345',
+                         member_name('diff', '1234', '2016-12345',
+                                     diff_notice='2015-12345'))
+
+    def test_json_layout(self):
+        with patch('regulation.archive.settings.JSON_LAYOUT', 'archive',
+                   create=True):
+            self.assertEqual('archive', json_layout())
+        with patch('regulation.archive.settings.JSON_LAYOUT', 'tar',
+                   create=True):
+            with self.assertRaises(ValueError):
+                json_layout()
+
+    def test_write_and_read(self):
+        self.write_version([('regulation', {'label': ['1234']}),
+                            ('layer/terms', {'referenced': {}})],
+                           compact=True)
+        path = archive_path('1234', '2015-12345', json_root=self.json_root)
+        self.assertEqual(['2015-12345.zip'], os.listdir(os.path.dirname(path)))
+
+        with JSONArchive(path) as archive:
+            self.assertEqual(['regulation/1234/2015-12345',
+                              'layer/terms/1234/2015-12345'],
+                             archive.names())
+            self.assertTrue('regulation/1234/2015-12345' in archive)
+            self.assertFalse('layer/toc/1234/2015-12345' in archive)
+            self.assertEqual(b'{"label":["1234"]}',
+                             archive.read('regulation/1234/2015-12345'))
+            self.assertEqual({'referenced': {}}, archive.load_layer(
+                'layer/terms', '1234', '2015-12345'))
+
+    def test_previous_members_are_kept(self):
+        self.write_version([('regulation', {'label': ['1234']}),
+                            ('layer/terms', {'referenced': {}})])
+        with JSONArchiveWriter.for_version(
+                '1234', '2015-12345', json_root=self.json_root) as writer:
+            writer.write({}, 'diff', '1234', '2015-12345',
+                         diff_notice='2014-12345')
+            writer.write({'label': ['1234', '1']}, 'regulation', '1234',
+                         '2015-12345')
+
+        with JSONArchive.for_version('1234', '2015-12345',
+                                     json_root=self.json_root) as archive:
+            self.assertEqual(['diff/1234/2014-12345/2015-12345',
+                              'regulation/1234/2015-12345',
+                              'layer/terms/1234/2015-12345'],
+                             archive.names())
+            self.assertEqual({'label': ['1234', '1']}, archive.load_layer(
+                'regulation', '1234', '2015-12345'))
+
+    def test_error_keeps_previous_archive(self):
+        self.write_version([('regulation', {'label': ['1234']})])
+        with self.assertRaises(ValueError):
+            with JSONArchiveWriter.for_version(
+                    '1234', '2015-12345', json_root=self.json_root) as writer:
+                writer.write({}, 'layer/terms', '1234', '2015-12345')
+                raise ValueError('bad')
+
+        path = archive_path('1234', '2015-12345', json_root=self.json_root)
+        self.assertEqual(['2015-12345.zip'], os.listdir(os.path.dirname(path)))
+        with JSONArchive(path) as archive:
+            self.assertEqual(['regulation/1234/2015-12345'], archive.names())
+
+    def test_explode(self):
+        self.write_version([('regulation', {'label': ['1234']}),
+                            ('layer/terms', {'referenced': {}})])
+        with JSONArchive.for_version('1234', '2015-12345',
+                                     json_root=self.json_root) as archive:
+            paths = archive.explode(json_root=self.json_root,
+                                    compression='gzip')
+
+        path = os.path.join(self.json_root, 'layer', 'terms', '1234',
+                            '2015-12345')
+        self.assertEqual(path + '.gz', paths[1])
+        self.assertEqual({'referenced': {}}, load_json(path))
+
+    def test_manifest_output_exists(self):
+        manifest = JSONManifest(json_root=self.json_root, parser='1')
+        with patch('regulation.archive.settings.JSON_LAYOUT', 'archive',
+                   create=True):
+            self.assertFalse(manifest.output_exists('regulation', '1234',
+                                                    '2015-12345'))
+            self.write_version([('regulation', {'label': ['1234']})])
+            self.assertTrue(manifest.output_exists('regulation', '1234',
+                                                   '2015-12345'))
+            self.assertFalse(manifest.output_exists('layer/terms', '1234',
+                                                    '2015-12345'))
@@ -5,7 +5,10 @@ from unittest import TestCase
 import lxml.etree as etree
 
 from regulation.changes import (get_parent_label, get_sibling_label,
-                                process_changes, process_analysis, generate_diff)
+                                process_changes, process_analysis, generate_diff,
+                                freeze_reg_tree, generate_frozen_diff,
+                                generate_diff_pair, index_frozen_tree,
+                                reverse_frozen_diff, generate_changeset)
 
 import logging
 
@@ -372,6 +375,57 @@ class ChangesTests(TestCase):
         old_parent = new_xml.find('.//{eregs}subpart[@label="1234-Subpart-A"]/{eregs}content')
         self.assertEqual(len(old_parent.getchildren()), 0)
 
+    def test_process_changes_chained(self):
+        """ Later changes can refer to elements added, replaced, or
+            relabelled by earlier changes in the same notice """
+        notice_xml = etree.fromstring("""
+            <notice xmlns="eregs" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="eregs ../../eregs.xsd">
+              <fdsys></fdsys><preamble></preamble>
+              <changeset>
+                <change operation="added" label="1234-Subpart-B" parent="1234">
+                  <subpart label="1234-Subpart-B">
+                    <content>
+                      <paragraph label="1234-3">A new paragraph</paragraph>
+                    </content>
+                  </subpart>
+                </change>
+                <change operation="moved" label="1234-1" parent="1234-Subpart-B" after="1234-3"></change>
+                <change operation="modified" label="1234-2">
+                  <paragraph label="1234-2">A modified paragraph
+                    <paragraph label="1234-2-a">A new child</paragraph>
+                  </paragraph>
+                </change>
+                <change operation="deleted" label="1234-2-x"></change>
+                <change operation="changeLabel" label="1234-2-a" newLabel="1234-2-b"></change>
+              </changeset>
+            </notice>""")
+        original_xml = etree.fromstring("""
+            <regulation xmlns="eregs" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="eregs ../../eregs.xsd">
+              <fdsys></fdsys>
+              <preamble></preamble>
+              <part label="1234">
+                <content>
+                  <subpart label="1234-Subpart-A">
+                    <content>
+                      <paragraph label="1234-1">An existing paragraph</paragraph>
+                      <paragraph label="1234-2">Another existing paragraph
+                        <paragraph label="1234-2-x">A doomed paragraph</paragraph>
+                      </paragraph>
+                    </content>
+                  </subpart>
+                </content>
+              </part>
+            </regulation>""")
+        new_xml = process_changes(original_xml, notice_xml)
+
+        subpart_b = new_xml.find('.//{eregs}subpart[@label="1234-Subpart-B"]')
+        self.assertEqual(['1234-3', '1234-1'],
+                         [p.get('label') for p in subpart_b.find('{eregs}content')])
+        self.assertIsNone(new_xml.find('.//*[@label="1234-2-x"]'))
+        self.assertIsNone(new_xml.find('.//*[@label="1234-2-a"]'))
+        relabelled = new_xml.find('.//*[@label="1234-2-b"]')
+        self.assertEqual('A new child', relabelled.text)
+
     def test_process_changes_moved_before(self):
         notice_xml = etree.fromstring("""
             <notice xmlns="eregs" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="eregs ../../eregs.xsd">
@@ -675,6 +729,160 @@ class ChangesTests(TestCase):
         self.assertTrue('1234-1-a' in diff)
         self.assertEqual(diff['1234-1-a']['op'], 'deleted')
 
+    def test_generate_frozen_diff(self):
+        """ Frozen trees can be built once and diffed many times """
+        left_xml = etree.fromstring("""
+            <regulation xmlns="eregs" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="eregs ../../eregs.xsd">
+              <fdsys>
+                <title>TEST CASE RUNNING ACT</title>
+              </fdsys>
+              <preamble>
+                <cfr>
+                  <section>1234</section>
+                </cfr>
+              </preamble>
+              <part label="1234">
+                <content>
+                  <subpart>
+                    <content>
+                      <section label="1234-1" sectionNum="1">
+                        <subject>§ 1234.1 Changing a paragraph</subject>
+                        <paragraph label="1234-1-a" marker="(a)">
+                          <content>An old paragraph</content>
+                        </paragraph>
+                      </section>
+                    </content>
+                  </subpart>
+                </content>
+              </part>
+            </regulation>""")
+        right_xml = etree.fromstring("""
+            <regulation xmlns="eregs" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="eregs ../../eregs.xsd">
+              <fdsys>
+                <title>TEST CASE RUNNING ACT</title>
+              </fdsys>
+              <preamble>
+                <cfr>
+                  <section>1234</section>
+                </cfr>
+              </preamble>
+              <part label="1234">
+                <content>
+                  <subpart>
+                    <content>
+                      <section label="1234-1" sectionNum="1">
+                        <subject>§ 1234.1 Changing a paragraph</subject>
+                        <paragraph label="1234-1-a" marker="(a)">
+                          <content>A new paragraph</content>
+                        </paragraph>
+                        <paragraph label="1234-1-b" marker="(b)">
+                          <content>An added paragraph</content>
+                        </paragraph>
+                      </section>
+                    </content>
+                  </subpart>
+                </content>
+              </part>
+            </regulation>""")
+        left_tree = freeze_reg_tree(left_xml)
+        right_tree = freeze_reg_tree(right_xml)
+
+        self.assertEqual(generate_diff(left_xml, right_xml),
+                         generate_frozen_diff(left_tree, right_tree))
+        self.assertEqual(generate_diff(right_xml, left_xml),
+                         generate_frozen_diff(right_tree, left_tree))
+        self.assertEqual({}, generate_frozen_diff(left_tree, left_tree))
+
+        self.assertEqual((generate_frozen_diff(left_tree, right_tree),
+                          generate_frozen_diff(right_tree, left_tree)),
+                         generate_diff_pair(left_tree, right_tree))
+        self.assertEqual(({}, {}), generate_diff_pair(left_tree, left_tree))
+
+    def test_reverse_frozen_diff(self):
+        """ Reversing a diff gives the same diff as regulations-parser """
+        template = """
+            <regulation xmlns="eregs">
+              <fdsys><title>TEST CASE RUNNING ACT</title></fdsys>
+              <preamble><cfr><section>1234</section></cfr></preamble>
+              <part label="1234">
+                <content><subpart><content>{}</content></subpart></content>
+              </part>
+            </regulation>"""
+        left_xml = etree.fromstring(template.format("""
+            <section label="1234-1"><subject>Section 1</subject>
+              <paragraph label="1234-1-a" marker="a"><content>Unchanged</content></paragraph>
+              <paragraph label="1234-1-b" marker="b"><content>Old text</content>
+                <paragraph label="1234-1-b-1" marker="1"><content>Deleted</content></paragraph>
+              </paragraph>
+              <paragraph label="1234-1-c" marker="c"><content>Removed</content>
+                <paragraph label="1234-1-c-1" marker="1"><content>Moved</content></paragraph>
+                <paragraph label="1234-1-c-2" marker="2"><content>Gone</content></paragraph>
+              </paragraph>
+            </section>
+            <section label="1234-2"><subject>Section 2</subject>
+              <paragraph label="1234-2-a" marker="a"><content>Removed section</content></paragraph>
+            </section>"""))
+        right_xml = etree.fromstring(template.format("""
+            <section label="1234-1"><subject>Section 1 changed</subject>
+              <paragraph label="1234-1-a" marker="a"><content>Unchanged</content></paragraph>
+              <paragraph label="1234-1-b" marker="b"><content>New text</content></paragraph>
+              <paragraph label="1234-1-d" marker="d"><content>Added</content>
+                <paragraph label="1234-1-c-1" marker="1"><content>Moved and changed</content></paragraph>
+                <paragraph label="1234-1-d-2" marker="2"><content>New</content></paragraph>
+              </paragraph>
+            </section>
+            <section label="1234-3"><subject>Section 3</subject>
+              <paragraph label="1234-3-a" marker="a"><content>Added section</content></paragraph>
+            </section>"""))
+        left_tree = freeze_reg_tree(left_xml)
+        right_tree = freeze_reg_tree(right_xml)
+        left_nodes = index_frozen_tree(left_tree)
+        right_nodes = index_frozen_tree(right_tree)
+
+        for lhs, rhs, lhs_nodes, rhs_nodes in (
+                (left_tree, right_tree, left_nodes, right_nodes),
+                (right_tree, left_tree, right_nodes, left_nodes)):
+            diff = generate_frozen_diff(lhs, rhs)
+            self.assertEqual(set(['added', 'deleted', 'modified']),
+                             set(change['op'] for change in diff.values()))
+            self.assertEqual(generate_frozen_diff(rhs, lhs),
+                             reverse_frozen_diff(diff, lhs_nodes, rhs_nodes))
+
+        self.assertEqual(None, reverse_frozen_diff(
+            generate_frozen_diff(left_tree, right_tree), left_nodes, None))
+
+    def test_index_frozen_tree_duplicates(self):
+        """ Trees with duplicate labels can't be indexed """
+        xml = etree.fromstring("""
+            <regulation xmlns="eregs" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="eregs ../../eregs.xsd">
+              <fdsys>
+                <title>TEST CASE RUNNING ACT</title>
+              </fdsys>
+              <preamble>
+                <cfr>
+                  <section>1234</section>
+                </cfr>
+              </preamble>
+              <part label="1234">
+                <content>
+                  <subpart>
+                    <content>
+                      <section label="1234-1" sectionNum="1">
+                        <subject>§ 1234.1 Duplicate paragraphs</subject>
+                        <paragraph label="1234-1-a" marker="(a)">
+                          <content>A paragraph</content>
+                        </paragraph>
+                        <paragraph label="1234-1-a" marker="(a)">
+                          <content>The same paragraph</content>
+                        </paragraph>
+                      </section>
+                    </content>
+                  </subpart>
+                </content>
+              </part>
+            </regulation>""")
+        self.assertEqual(None, index_frozen_tree(freeze_reg_tree(xml)))
+
     def test_process_changes_modified_xpath(self):
         notice_xml = etree.fromstring("""
             <notice xmlns="eregs" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="eregs ../../eregs.xsd">
@@ -830,3 +1038,90 @@ class ChangesTests(TestCase):
 
         sections = analysis.findall('{eregs}analysisSection')
         self.assertEquals(len(sections), 2)
+
+    changeset_regulation = """
+        <regulation xmlns="eregs">
+          <fdsys></fdsys>
+          <preamble><documentNumber>{}</documentNumber></preamble>
+          <part label="1234">
+            <content>
+              <subpart label="1234-Subpart-A">
+                <content>
+                  <section label="1234-1">
+                    <subject>{}</subject>
+                    {}
+                  </section>
+                  <section label="1234-2">
+                    <subject>Section 2</subject>
+                    {}
+                  </section>
+                </content>
+              </subpart>
+            </content>
+          </part>
+        </regulation>"""
+
+    def changeset_versions(self):
+        left_xml = etree.fromstring(self.changeset_regulation.format(
+            '2015-12345', 'Section 1', """
+            <paragraph label="1234-1-a" marker="a"><content>Unchanged</content></paragraph>
+            <paragraph label="1234-1-b" marker="b"><content>Old text</content></paragraph>
+            <paragraph label="1234-1-c" marker="c"><content>Deleted</content></paragraph>
+            <paragraph label="1234-1-d" marker="d"><content>Moved</content></paragraph>
+            """, """
+            <paragraph label="1234-2-a" marker="a"><content>Unchanged</content></paragraph>
+            """))
+        right_xml = etree.fromstring(self.changeset_regulation.format(
+            '2016-12345', 'Section 1 changed', """
+            <paragraph label="1234-1-a" marker="a"><content>Unchanged</content></paragraph>
+            <paragraph label="1234-1-a-1" marker="1"><content>Added</content></paragraph>
+            <paragraph label="1234-1-b" marker="b"><content>New text</content></paragraph>
+            """, """
+            <paragraph label="1234-2-a" marker="a"><content>Unchanged</content></paragraph>
+            <paragraph label="1234-1-d" marker="d"><content>Moved</content></paragraph>
+            """))
+        return left_xml, right_xml
+
+    def test_generate_changeset(self):
+        left_xml, right_xml = self.changeset_versions()
+        changeset = generate_changeset(left_xml, right_xml)
+
+        self.assertEqual('2015-12345', changeset.get('leftDocumentNumber'))
+        self.assertEqual('2016-12345', changeset.get('rightDocumentNumber'))
+        changes = dict(((change.get('operation'), change.get('label'),
+                         change.get('subpath')), change)
+                       for change in changeset)
+        self.assertEqual(set([('added', '1234-1-a-1', None),
+                              ('deleted', '1234-1-c', None),
+                              ('moved', '1234-1-d', None),
+                              ('modified', '1234-1-b', 'content'),
+                              ('modified', '1234-1', 'subject')]),
+                         set(changes.keys()))
+
+        added = changes[('added', '1234-1-a-1', None)]
+        self.assertEqual('1234-1', added.get('parent'))
+        self.assertEqual('1234-1-a', added.get('after'))
+        moved = changes[('moved', '1234-1-d', None)]
+        self.assertEqual('1234-2', moved.get('parent'))
+        self.assertEqual('1234-2-a', moved.get('after'))
+        modified = changes[('modified', '1234-1-b', 'content')]
+        self.assertEqual('New text', modified[0].text)
+
+    def test_generate_changeset_process_changes(self):
+        left_xml, right_xml = self.changeset_versions()
+        notice_xml = etree.Element('{eregs}notice')
+        notice_xml.append(right_xml.find('{eregs}fdsys'))
+        notice_xml.append(right_xml.find('{eregs}preamble'))
+        notice_xml.append(generate_changeset(left_xml, right_xml))
+
+        new_xml = process_changes(left_xml, notice_xml)
+
+        def content(xml_tree):
+            return [(element.get('label'), element.findtext('{eregs}content'))
+                    for element in xml_tree.iter('{eregs}paragraph')] + \
+                [element.text for element in xml_tree.iter('{eregs}subject')]
+        self.assertEqual(content(right_xml), content(new_xml))
+
+    def test_generate_changeset_unchanged(self):
+        left_xml, right_xml = self.changeset_versions()
+        self.assertEqual(0, len(generate_changeset(left_xml, left_xml)))
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+import os
+import pickle
+import shutil
+import tempfile
+from unittest import TestCase
+
+import lxml.etree as etree
+from mock import patch
+
+from regulation.diff import DiffVersion, diff_files, diff_versions
+from regulation.node import xml_node_text
+
+
+class DiffTests(TestCase):
+
+    regulation = """
+        <regulation xmlns="eregs">
+          <fdsys></fdsys>
+          <preamble>
+            <documentNumber>{}</documentNumber>
+            <effectiveDate>2015-11-17</effectiveDate>
+          </preamble>
+          <part label="1234">
+            <tableOfContents>
+              <tocSecEntry target="1234-1"><sectionNum>1</sectionNum><sectionSubject>Section 1</sectionSubject></tocSecEntry>
+            </tableOfContents>
+            <content>
+              <section label="1234-1">
+                <subject>Section 1</subject>
+                {}
+              </section>
+            </content>
+          </part>
+        </regulation>"""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def write_version(self, doc_number, paragraphs):
+        filename = os.path.join(self.tempdir, doc_number + '.xml')
+        with open(filename, 'w') as f:
+            f.write(self.regulation.format(doc_number, paragraphs).strip())
+        return filename
+
+    def test_diff_files(self):
+        left_file = self.write_version('2015-12345', """
+            <paragraph label="1234-1-a" marker="a"><content>Unchanged</content></paragraph>
+            <paragraph label="1234-1-b" marker="b"><content>Old text</content></paragraph>
+            <paragraph label="1234-1-c" marker="c"><content>Deleted</content></paragraph>
+            """)
+        right_file = self.write_version('2016-12345', """
+            <paragraph label="1234-1-a" marker="a"><content>Unchanged</content></paragraph>
+            <paragraph label="1234-1-b" marker="b"><content>New text</content>
+              <paragraph label="1234-1-b-1" marker="1"><content>Added</content></paragraph>
+            </paragraph>
+            """)
+
+        tree, left_version, right_version = diff_files(left_file, right_file)
+        self.assertEqual('2015-12345:2015-11-17', left_version)
+        self.assertEqual('2016-12345:2015-11-17', right_version)
+
+        def find(label):
+            return tree.find('.//*[@label="{}"]'.format(label))
+
+        self.assertEqual(None, find('1234-1-a').get('action'))
+        self.assertEqual('deleted', find('1234-1-c').get('action'))
+
+        modified = find('1234-1-b')
+        self.assertEqual('modified', modified.get('action'))
+        self.assertEqual('Old text',
+                         modified.find('{eregs}leftContent').text)
+        self.assertEqual('New text',
+                         modified.find('{eregs}rightContent').text)
+        self.assertEqual('modified', tree.find(
+            './/{eregs}tocSecEntry[@target="1234-1"]').get('action'))
+
+        added = find('1234-1-b-1')
+        self.assertEqual('added', added.get('action'))
+        self.assertEqual(modified, added.getparent())
+
+    def test_diff_files_skips_unchanged(self):
+        left_file = self.write_version('2015-12345', """
+            <paragraph label="1234-1-a" marker="a"><content>Unchanged</content>
+              <paragraph label="1234-1-a-1" marker="1"><content>Unchanged</content></paragraph>
+            </paragraph>
+            <paragraph label="1234-1-b" marker="b"><content>Old text</content></paragraph>
+            """)
+        right_file = self.write_version('2016-12345', """
+            <paragraph label="1234-1-a" marker="a"><content>Unchanged</content>
+              <paragraph label="1234-1-a-1" marker="1"><content>Unchanged</content></paragraph>
+            </paragraph>
+            <paragraph label="1234-1-b" marker="b"><content>New text</content></paragraph>
+            """)
+
+        with patch('regulation.diff.xml_node_text',
+                   side_effect=xml_node_text) as node_text:
+            tree, left_version, right_version = diff_files(left_file,
+                                                           right_file)
+        # Only the changed paragraph's content is compared
+        self.assertEqual(2, node_text.call_count)
+        self.assertEqual('modified', tree.find(
+            './/*[@label="1234-1-b"]').get('action'))
+
+    def test_diff_versions_reuses_prepared_versions(self):
+        left_file = self.write_version('2015-12345', """
+            <paragraph label="1234-1-a" marker="a"><content>Old text</content></paragraph>
+            """)
+        right_file = self.write_version('2016-12345', """
+            <paragraph label="1234-1-a" marker="a"><content>New text</content></paragraph>
+            """)
+        expected = diff_files(left_file, right_file)
+
+        # Prepared versions can be sent to other processes and diffed
+        # more than once
+        left = pickle.loads(pickle.dumps(DiffVersion(left_file)))
+        right = pickle.loads(pickle.dumps(DiffVersion(right_file)))
+        for i in range(2):
+            tree, left_version, right_version = diff_versions(left, right)
+            self.assertEqual(expected[1:], (left_version, right_version))
+            self.assertEqual(etree.tostring(expected[0]),
+                             etree.tostring(tree))
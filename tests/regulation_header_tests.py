@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from mock import patch
+
+from regulation.header import Header, HeaderIndex, read_header
+
+from tests.common import test_xml
+
+
+class HeaderTests(TestCase):
+
+    notice_xml = """
+        <notice xmlns="eregs" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="eregs ../../eregs.xsd">
+          <fdsys>
+            <date>2016-11-17</date>
+            <title>NOTICE TESTING</title>
+          </fdsys>
+          <preamble>
+            <cfr>
+              <title>12</title>
+              <section>1234</section>
+            </cfr>
+            <documentNumber>2016-12345</documentNumber>
+            <effectiveDate>2016-11-17</effectiveDate>
+            <federalRegisterURL>https://www.federalregister.gov/some/url/</federalRegisterURL>
+          </preamble>
+          <changeset leftDocumentNumber="2015-12345" rightDocumentNumber="2016-12345">
+            <change operation="added" label="1234-1-b">
+              <paragraph label="1234-1-b" marker="b">
+                <content>A new paragraph</content>
+              </paragraph>
+            </change>
+          </changeset>
+        </notice>
+        """
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def write_file(self, name, content):
+        filename = os.path.join(self.tempdir, name)
+        with open(filename, 'w') as f:
+            f.write(content.strip())
+        return filename
+
+    def test_read_header_regulation(self):
+        filename = self.write_file('2015-12345.xml', test_xml)
+        self.assertEqual(Header('2015-12345', '2015-11-17', None),
+                         read_header(filename))
+
+    def test_read_header_notice(self):
+        filename = self.write_file('2016-12345.xml', self.notice_xml)
+        self.assertEqual(Header('2016-12345', '2016-11-17', '2015-12345'),
+                         read_header(filename))
+
+    def test_read_header_stops_at_changeset(self):
+        # Everything after the changeset opens is never read
+        filename = self.write_file(
+            '2016-12345.xml',
+            self.notice_xml.replace('</changeset>', '</changeset><<<'))
+        self.assertEqual(Header('2016-12345', '2016-11-17', '2015-12345'),
+                         read_header(filename))
+
+    def test_header_index(self):
+        filename = self.write_file('2016-12345.xml', self.notice_xml)
+        index_path = os.path.join(self.tempdir, 'headers.json')
+
+        index = HeaderIndex(index_path)
+        header = index.get(filename)
+        index.save()
+        self.assertTrue(os.path.exists(index_path))
+
+        # An unchanged file isn't read again
+        index = HeaderIndex(index_path)
+        with patch('regulation.header.read_header') as read:
+            self.assertEqual(header, index.get(filename))
+            self.assertFalse(read.called)
+
+        # A changed file is
+        self.write_file('2016-12345.xml',
+                        self.notice_xml.replace('2016-11-17', '2016-11-18'))
+        os.utime(filename, (1000000000, 1000000000))
+        self.assertEqual('2016-11-18', index.get(filename).effective_date)
+
+    def test_header_index_in_memory(self):
+        filename = self.write_file('2016-12345.xml', self.notice_xml)
+
+        index = HeaderIndex()
+        header = index.get(filename)
+        index.save()
+        self.assertEqual([], [f for f in os.listdir(self.tempdir)
+                              if f.endswith('.json')])
+
+        # Headers are still only read once
+        with patch('regulation.header.read_header') as read:
+            self.assertEqual(header, index.get(filename))
+            self.assertFalse(read.called)
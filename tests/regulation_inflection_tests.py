@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from mock import patch
+
+from regulation import inflection
+from regulation.inflection import Inflector
+
+
+class InflectionTests(TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'inflections.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_singular(self):
+        inflector = Inflector()
+        self.assertEqual('consumer', inflector.singular('consumers'))
+        self.assertEqual('consumer', inflector.singular('consumer'))
+        self.assertEqual('bonus', inflector.singular('bonuses'))
+
+    def test_special_singular_nouns(self):
+        inflector = Inflector()
+        self.assertEqual('bonus', inflector.singular('bonus'))
+        self.assertEqual('surplus', inflector.singular('surplus'))
+
+    def test_plural(self):
+        inflector = Inflector()
+        self.assertEqual('consumers', inflector.plural('consumer'))
+        self.assertEqual('bonuses', inflector.plural('bonus'))
+        self.assertEqual('Bonuses', inflector.plural('Bonus'))
+
+    def test_forms_are_remembered(self):
+        inflector = Inflector()
+        with patch.object(inflector.engine, 'plural',
+                          return_value='consumers') as plural:
+            inflector.plural('consumer')
+            inflector.plural('consumer')
+        self.assertEqual(1, plural.call_count)
+
+    def test_save_and_load(self):
+        inflector = Inflector(self.path)
+        inflector.singular('consumers')
+        inflector.plural('consumer')
+        inflector.save()
+        self.assertFalse(inflector.changed)
+        self.assertEqual(['inflections.json'], os.listdir(self.tempdir))
+
+        inflector = Inflector(self.path)
+        with patch.object(inflector.engine, 'singular_noun') as singular:
+            self.assertEqual('consumer', inflector.singular('consumers'))
+        self.assertFalse(singular.called)
+        self.assertEqual({'consumer': 'consumers'}, inflector.plurals)
+        self.assertFalse(inflector.changed)
+
+    def test_load_other_fingerprint(self):
+        with open(self.path, 'w') as f:
+            json.dump({'fingerprint': ['0.0.1', [], []],
+                       'singular': {'bonus': 'bonu'},
+                       'plural': {}}, f)
+        inflector = Inflector(self.path)
+        self.assertEqual({}, inflector.singulars)
+        self.assertEqual('bonus', inflector.singular('bonus'))
+
+    def test_shared_inflector(self):
+        with patch('regulation.inflection._inflector', None):
+            with patch('regulation.inflection.settings.INFLECTION_CACHE_FILE',
+                       self.path, create=True):
+                self.assertEqual('consumers', inflection.plural('consumer'))
+                self.assertTrue(inflection.inflector() is
+                                inflection.inflector())
+                inflection.save()
+        with open(self.path) as f:
+            self.assertEqual({'consumer': 'consumers'}, json.load(f)['plural'])
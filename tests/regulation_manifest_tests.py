@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from mock import patch
+
+from regulation.manifest import (JSONManifest, VERSION_OUTPUT_TYPES,
+                                 file_digest)
+
+
+class ManifestTests(TestCase):
+
+    def setUp(self):
+        self.json_root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.json_root)
+
+    def write_output(self, layer_type, reg_number, notice, diff_notice=None):
+        path = os.path.join(self.json_root, layer_type, reg_number)
+        if diff_notice is not None:
+            path = os.path.join(path, diff_notice)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        with open(os.path.join(path, notice), 'w') as f:
+            f.write('{}')
+
+    def test_file_digest(self):
+        filename = os.path.join(self.json_root, 'test.xml')
+        with open(filename, 'w') as f:
+            f.write('<regulation/>')
+        self.assertEqual(
+            'aa3b29a49b77b80580fd4a4d1876b8d56dd1cdc19ae15f3c6b237f4bd3e63446',
+            file_digest(filename))
+
+    def test_version(self):
+        manifest = JSONManifest(json_root=self.json_root, parser='1')
+        manifest.add_version('regulation/1234/2015-12345.xml', 'abc',
+                             '1234', '2015-12345')
+        manifest.save()
+
+        manifest = JSONManifest.load(json_root=self.json_root, parser='1')
+        # The JSON hasn't been written
+        self.assertEqual(None, manifest.version(
+            'regulation/1234/2015-12345.xml', 'abc'))
+
+        for layer_type in VERSION_OUTPUT_TYPES:
+            self.write_output(layer_type, '1234', '2015-12345')
+        self.assertEqual(('1234', '2015-12345'), manifest.version(
+            'regulation/1234/2015-12345.xml', 'abc'))
+
+        # The RegML has changed
+        self.assertEqual(None, manifest.version(
+            'regulation/1234/2015-12345.xml', 'def'))
+
+        manifest.remove_version('regulation/1234/2015-12345.xml')
+        self.assertEqual(None, manifest.version(
+            'regulation/1234/2015-12345.xml', 'abc'))
+
+    def test_diff_is_current(self):
+        manifest = JSONManifest(json_root=self.json_root, parser='1')
+        manifest.add_diff('1234', '2015-12345', '2016-12345', 'abc', 'def')
+        self.assertFalse(manifest.diff_is_current(
+            '1234', '2015-12345', '2016-12345', 'abc', 'def'))
+
+        self.write_output('diff', '1234', '2016-12345',
+                          diff_notice='2015-12345')
+        self.assertTrue(manifest.diff_is_current(
+            '1234', '2015-12345', '2016-12345', 'abc', 'def'))
+        self.assertFalse(manifest.diff_is_current(
+            '1234', '2015-12345', '2016-12345', 'abc', 'xyz'))
+        self.assertFalse(manifest.diff_is_current(
+            '1234', '2016-12345', '2015-12345', 'def', 'abc'))
+
+        manifest.remove_diff('1234', '2015-12345', '2016-12345')
+        self.assertFalse(manifest.diff_is_current(
+            '1234', '2015-12345', '2016-12345', 'abc', 'def'))
+
+    def test_switch_compact(self):
+        """ JSON written compact, or not, is out of date when the next run
+            writes it the other way """
+        for layer_type in VERSION_OUTPUT_TYPES:
+            self.write_output(layer_type, '1234', '2015-12345')
+        self.write_output('diff', '1234', '2015-12345',
+                          diff_notice='2015-12345')
+        manifest = JSONManifest(json_root=self.json_root, parser='1')
+        manifest.add_version('regulation/1234/2015-12345.xml', 'abc',
+                             '1234', '2015-12345')
+        manifest.add_diff('1234', '2015-12345', '2015-12345', 'abc', 'abc')
+        manifest.save()
+
+        manifest = JSONManifest.load(json_root=self.json_root, parser='1',
+                                     compact=True)
+        self.assertEqual(None, manifest.version(
+            'regulation/1234/2015-12345.xml', 'abc'))
+        self.assertFalse(manifest.diff_is_current(
+            '1234', '2015-12345', '2015-12345', 'abc', 'abc'))
+        manifest.add_version('regulation/1234/2015-12345.xml', 'abc',
+                             '1234', '2015-12345')
+        manifest.add_diff('1234', '2015-12345', '2015-12345', 'abc', 'abc')
+        manifest.save()
+
+        manifest = JSONManifest.load(json_root=self.json_root, parser='1',
+                                     compact=True)
+        self.assertEqual(('1234', '2015-12345'), manifest.version(
+            'regulation/1234/2015-12345.xml', 'abc'))
+        self.assertTrue(manifest.diff_is_current(
+            '1234', '2015-12345', '2015-12345', 'abc', 'abc'))
+
+        manifest = JSONManifest.load(json_root=self.json_root, parser='1')
+        self.assertEqual(None, manifest.version(
+            'regulation/1234/2015-12345.xml', 'abc'))
+        self.assertFalse(manifest.diff_is_current(
+            '1234', '2015-12345', '2015-12345', 'abc', 'abc'))
+
+    def test_output_exists_compressed(self):
+        manifest = JSONManifest(json_root=self.json_root, parser='1')
+        self.write_output('regulation', '1234', '2015-12345.gz')
+        self.assertFalse(manifest.output_exists('regulation', '1234',
+                                                '2015-12345'))
+        with patch('regulation.manifest.settings.JSON_COMPRESSION', 'gzip',
+                   create=True):
+            self.assertTrue(manifest.output_exists('regulation', '1234',
+                                                   '2015-12345'))
+
+    def test_load_other_parser_version(self):
+        manifest = JSONManifest(json_root=self.json_root, parser='1')
+        manifest.add_version('regulation/1234/2015-12345.xml', 'abc',
+                             '1234', '2015-12345')
+        manifest.add_diff('1234', '2015-12345', '2016-12345', 'abc', 'def')
+        manifest.save()
+
+        manifest = JSONManifest.load(json_root=self.json_root, parser='2')
+        self.assertEqual({}, manifest.versions)
+        self.assertEqual({}, manifest.diffs)
+
+    def test_load_missing(self):
+        manifest = JSONManifest.load(json_root=self.json_root, parser='1')
+        self.assertEqual({}, manifest.versions)
+        self.assertEqual({}, manifest.diffs)
@@ -1,16 +1,56 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
 
+from io import BytesIO
 from unittest import TestCase
 
 import lxml.etree as etree
 
-from regulation.node import find_all_occurrences
+from regulation.node import (enclosed_in_tag, find_all_occurrences, LabelIndex,
+                             PatternMatcher, RegNode, TagSpans)
+from regulation.output import encode_json
 
 import settings
 
 class NodeTests(TestCase):
 
+    def reg_tree(self):
+        root = RegNode(include_children=True)
+        root.label = ['1234']
+        root.node_type = 'regtext'
+        root.title = 'Title'
+        paragraph = RegNode(include_children=True)
+        paragraph.label = ['1234', '1', 'a']
+        paragraph.node_type = 'regtext'
+        paragraph.marker = '(a)'
+        paragraph.text = u'(a) A \u201cparagraph\u201d.'
+        leaf = RegNode()
+        leaf.label = ['1234', '1', 'a', '1']
+        leaf.children = [RegNode()]
+        paragraph.children = [leaf, RegNode(include_children=True)]
+        root.children = [paragraph]
+        return root
+
+    def test_reg_node_slots(self):
+        node = RegNode()
+        self.assertFalse(hasattr(node, '__dict__'))
+        with self.assertRaises(AttributeError):
+            node.notes = []
+
+    def test_reg_node_iterencode(self):
+        tree = self.reg_tree()
+        for compact in (False, True):
+            self.assertEqual(
+                b''.join(encode_json(tree.to_json(), compact=compact)),
+                b''.join(tree.iterencode(compact=compact)))
+
+    def test_reg_node_write_json(self):
+        stream = BytesIO()
+        self.reg_tree().children[0].children[0].write_json(stream,
+                                                           compact=True)
+        self.assertEqual(b'{"label":["1234","1","a","1"],'
+                         b'"node_type":"","text":""}', stream.getvalue())
+
     def test_find_all_occurrences(self):
         s = "There are many days. Sunday is a day. Saturday is a day too. Days happen.".lower()
         occurances = find_all_occurrences(s, 'day')
@@ -22,3 +62,105 @@ class NodeTests(TestCase):
         self.assertTrue(61 in occurances)
         self.assertEqual(len(occurances), 2)
 
+    def test_pattern_matcher(self):
+        s = "There are many days. Sunday is a day. Saturday is a day too. Days happen.".lower()
+        matcher = PatternMatcher(['day', 'days', 'a day', 'night'])
+        self.assertEqual(sorted([(15, 'day'), (15, 'days'), (24, 'day'),
+                                 (31, 'a day'), (33, 'day'), (43, 'day'),
+                                 (50, 'a day'), (52, 'day'), (61, 'day'),
+                                 (61, 'days')]),
+                         sorted(matcher.matches(s)))
+
+        occurrences = matcher.find_all_occurrences(s)
+        for pattern in ['day', 'days', 'a day']:
+            self.assertEqual(find_all_occurrences(s, pattern),
+                             occurrences[pattern])
+        self.assertFalse('night' in occurrences)
+
+    def test_pattern_matcher_overlapping(self):
+        # Overlapping occurrences of a pattern are found as a regular
+        # expression would find them
+        s = 'a a a a'
+        self.assertEqual({'a a': [0, 4]},
+                         PatternMatcher(['a a']).find_all_occurrences(s))
+        self.assertEqual(find_all_occurrences(s, 'a a'), [0, 4])
+
+    def test_enclosed_in_tag(self):
+        self.assertTrue(enclosed_in_tag('<foo>bar</foo>', 'foo', 6))
+        self.assertFalse(enclosed_in_tag('<foo>bar</foo>', 'foo', 0))
+        self.assertFalse(enclosed_in_tag('<foo>bar</foo>', 'bar', 6))
+
+    def test_tag_spans(self):
+        s = ('<content>A <ref target="1234-1">term</ref> and '
+             '<def term="x"><b>a</b> x</def>.</content>')
+        spans = TagSpans(s)
+        term = s.index('term<')
+        self.assertTrue(spans.encloses('ref', term))
+        self.assertFalse(spans.encloses('def', term))
+        self.assertFalse(spans.encloses('ref', s.index('and')))
+        # Only the text after the last tag within a tag is enclosed in it
+        self.assertFalse(spans.encloses('def', s.index('a</b>')))
+        self.assertTrue(spans.encloses('b', s.index('a</b>')))
+        self.assertTrue(spans.encloses('def', s.index(' x<')))
+        self.assertFalse(spans.encloses('title', term))
+
+    def test_label_index(self):
+        tree = etree.fromstring("""
+            <section xmlns="eregs" label="1234-1">
+              <paragraph label="1234-1-a">
+                <title>A title</title>
+                <paragraph label="1234-1-a-1"/>
+              </paragraph>
+              <paragraph label="1234-1-b"/>
+            </section>""")
+        index = LabelIndex(tree)
+
+        # The root itself is not indexed, just like find('.//*')
+        self.assertFalse('1234-1' in index)
+        self.assertEqual(3, len(index))
+        self.assertEqual(set(['1234-1-a', '1234-1-a-1', '1234-1-b']),
+                         index.labels())
+        self.assertIs(tree.find('.//*[@label="1234-1-a-1"]'),
+                      index.get('1234-1-a-1'))
+        self.assertIsNone(index.get('1234-1-c'))
+        self.assertIsNone(index.get(None))
+        self.assertEqual('A title',
+                         index.find('1234-1-a', '{eregs}title').text)
+
+        # Removing an element removes its labelled descendants
+        para_a = index.get('1234-1-a')
+        tree.remove(para_a)
+        index.remove(para_a)
+        self.assertIsNone(index.get('1234-1-a'))
+        self.assertIsNone(index.get('1234-1-a-1'))
+
+        # Adding an element adds its labelled descendants
+        tree.append(para_a)
+        index.add(para_a)
+        self.assertIs(para_a, index.get('1234-1-a'))
+        self.assertIsNotNone(index.get('1234-1-a-1'))
+
+        para_b = index.get('1234-1-b')
+        index.relabel(para_b, '1234-1-c')
+        self.assertEqual('1234-1-c', para_b.get('label'))
+        self.assertIs(para_b, index.get('1234-1-c'))
+        self.assertFalse('1234-1-b' in index)
+
+    def test_label_index_duplicates(self):
+        tree = etree.fromstring("""
+            <section xmlns="eregs" label="1234-1">
+              <paragraph label="1234-1-a"/>
+              <paragraph label="1234-1-b"/>
+            </section>""")
+        index = LabelIndex(tree)
+
+        # A duplicate label resolves to the first element in document
+        # order, just like find()
+        duplicate = etree.Element('{eregs}paragraph', label='1234-1-b')
+        tree.insert(0, duplicate)
+        index.add(duplicate)
+        self.assertIs(duplicate, index.get('1234-1-b'))
+
+        tree.remove(duplicate)
+        index.remove(duplicate)
+        self.assertIs(tree[1], index.get('1234-1-b'))
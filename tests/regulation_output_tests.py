@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+from collections import OrderedDict, namedtuple
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase, skipIf
+
+from mock import patch
+
+from regulation.output import (find_json, iterencode, load_json, write_json,
+                               zstandard)
+
+
+class OutputTests(TestCase):
+
+    layer = OrderedDict([
+        ('1234-1', [{'offsets': [[0, 4]], 'ref': 'term:1234-1-a'}]),
+        ('1234-2', {'text': u'Caf\xe9', 'children': [
+            {'label': ['1234', '2', 'a'], 'children': [
+                {'label': ['1234', '2', 'a', '1'],
+                 'children': [{'node_type': 'regtext', 'n': 1.5,
+                               'empty': [], 'none': None}]}]}]}),
+        ('1234-3', []),
+        ('1234-4', {1: 'non-string key'}),
+    ])
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_iterencode(self):
+        self.assertEqual(
+            json.dumps(self.layer, indent=4, separators=(',', ':')),
+            ''.join(iterencode(self.layer)))
+
+    def test_iterencode_compact(self):
+        self.assertEqual(json.dumps(self.layer, separators=(',', ':')),
+                         ''.join(iterencode(self.layer, compact=True)))
+
+    def test_iterencode_compact_namedtuple(self):
+        Point = namedtuple('Point', ['x', 'y'])
+        self.assertEqual('[[1,2]]',
+                         ''.join(iterencode([Point(1, 2)], compact=True)))
+
+    def test_write_json(self):
+        path = os.path.join(self.tempdir, '2015-12345')
+        write_json(self.layer, path, compact=True)
+        with open(path) as f:
+            self.assertEqual(json.loads(json.dumps(self.layer)), json.load(f))
+        self.assertEqual(['2015-12345'], os.listdir(self.tempdir))
+
+    def test_write_json_error_keeps_file(self):
+        path = os.path.join(self.tempdir, '2015-12345')
+        with open(path, 'w') as f:
+            f.write('{}')
+
+        def iterencode(obj, compact=False):
+            yield '{'
+            raise ValueError('bad')
+
+        with patch('regulation.output.iterencode', side_effect=iterencode):
+            with self.assertRaises(ValueError):
+                write_json(self.layer, path)
+
+        with open(path) as f:
+            self.assertEqual('{}', f.read())
+        self.assertEqual(['2015-12345'], os.listdir(self.tempdir))
+
+    def test_write_json_gzip(self):
+        path = os.path.join(self.tempdir, '2015-12345')
+        write_json(self.layer, path)
+        self.assertEqual(path + '.gz',
+                         write_json(self.layer, path, compression='gzip'))
+        # The uncompressed JSON is replaced
+        self.assertEqual(['2015-12345.gz'], os.listdir(self.tempdir))
+        self.assertEqual(path + '.gz', find_json(path))
+        self.assertEqual(json.loads(json.dumps(self.layer)), load_json(path))
+
+        # The same JSON is always compressed the same way
+        with open(path + '.gz', 'rb') as f:
+            compressed = f.read()
+        write_json(self.layer, path, compression='gzip')
+        with open(path + '.gz', 'rb') as f:
+            self.assertEqual(compressed, f.read())
+
+    @skipIf(zstandard is None, 'zstandard is not installed')
+    def test_write_json_zstd(self):
+        path = os.path.join(self.tempdir, '2015-12345')
+        write_json(self.layer, path, compression='gzip')
+        self.assertEqual(path + '.zst',
+                         write_json(self.layer, path, compression='zstd'))
+        self.assertEqual(['2015-12345.zst'], os.listdir(self.tempdir))
+        self.assertEqual(json.loads(json.dumps(self.layer)), load_json(path))
+
+    def test_write_json_unknown_compression(self):
+        with self.assertRaises(ValueError):
+            write_json(self.layer, os.path.join(self.tempdir, '2015-12345'),
+                       compression='bz2')
+
+    def test_load_json(self):
+        path = os.path.join(self.tempdir, '2015-12345')
+        write_json(self.layer, path)
+        self.assertEqual(list(self.layer.keys()),
+                         list(load_json(path, object_pairs_hook=OrderedDict)))
+        self.assertEqual(None, find_json(path + '-missing'))
+        with self.assertRaises(IOError):
+            load_json(path + '-missing')
@@ -17,8 +17,18 @@ from regulation.tree import (build_reg_tree,
                              apply_formatting,
                              build_toc_layer,
                              build_keyterm_layer, 
+                             build_internal_citations_layer,
+                             build_external_citations_layer,
+                             build_graphics_layer,
+                             child_offsets,
                              get_offset,
-                             is_intro_text)
+                             is_intro_text,
+                             FormattedContentCache,
+                             LayerBuilder,
+                             LayerPipeline,
+                             LAYER_BUILDERS,
+                             MetaLayerBuilder,
+                             TermsLayerBuilder)
 from regulation.node import RegNode
 
 
@@ -192,6 +202,48 @@ class TreeTestCase(TestCase):
 
         self.assertEqual(result, 5)
 
+    def test_iter_nodes(self):
+        xml_tree = etree.fromstring(test_xml)
+        reg_tree = build_reg_tree(xml_tree)
+
+        section = reg_tree.find_node(
+            lambda n: n.string_label == '1234-1')[0]
+        self.assertEqual(['1234-1', '1234-1-a', '1234-1-a-p1', '1234-1-a-p2'],
+                         list(section.iter_labels()))
+        self.assertEqual(list(reg_tree.iter_labels()),
+                         [node.string_label for node in reg_tree.iter_nodes()])
+
+    def test_iter_find(self):
+        xml_tree = etree.fromstring(test_xml)
+        reg_tree = build_reg_tree(xml_tree)
+
+        # Matching children come before the matches below each child
+        matches = reg_tree.iter_find(
+            lambda n: n.string_label != '1234-Subpart')
+        self.assertEqual(['1234-A', '1234-Interp', '1234-1'],
+                         [node.string_label for node in
+                          [next(matches) for i in range(3)]])
+
+    def test_build_deep_reg_tree(self):
+        """ Trees deeper than Python's recursion limit can be built and
+            traversed """
+        section = etree.Element('{eregs}section', label='1234-1')
+        etree.SubElement(section, '{eregs}subject').text = 'Deep'
+        element = section
+        for i in range(2000):
+            element = etree.SubElement(element, '{eregs}paragraph',
+                                       label='1234-1-{}'.format(i),
+                                       marker='({})'.format(i))
+            etree.SubElement(element, '{eregs}content').text = 'Text'
+        reg_tree = build_reg_tree(section)
+
+        self.assertEqual(2001, reg_tree.height())
+        self.assertEqual(2001, len(reg_tree.labels()))
+        self.assertEqual('1234-1-1999', reg_tree.find_node(
+            lambda n: n.children == [])[0].string_label)
+        self.assertEqual(2000, reg_tree.find_node(
+            lambda n: n.children == [])[0].depth)
+
     def test_markerless_nodes(self):
         """ Make sure marker: '' comes through in the json """
         xml_tree = etree.fromstring(test_xml)
@@ -665,6 +717,51 @@ class TreeTestCase(TestCase):
         result = build_toc_layer(tree)
         self.assertEqual(expected_result, result)
 
+    def test_references_to_several_definition_paragraphs(self):
+        reg_xml = etree.fromstring("""
+        <section label="1024-2" sectionNum="2" xmlns="eregs">
+          <subject/>
+          <paragraph label="1024-2-a" marker="(a)">
+            <content>Definitions of <def term="bureau">Bureau</def> and <def term="lender">Lender</def>.</content>
+          </paragraph>
+          <paragraph label="1024-2-b" marker="(b)">
+            <content>Definition of <def term="respa">RESPA</def>.</content>
+          </paragraph>
+          <paragraph label="1024-2-c" marker="(c)">
+            <content>A <ref target="1024-2-b" reftype="term">RESPA</ref> <ref target="1024-2-a" reftype="term">Lender</ref>.</content>
+          </paragraph>
+        </section>""")
+        result = build_terms_layer(reg_xml)
+
+        # Each ref points to the first definition in its target paragraph
+        self.assertEqual([OrderedDict([('offsets', [[6, 11]]),
+                                       ('ref', 'respa:1024-2-b')]),
+                          OrderedDict([('offsets', [[12, 18]]),
+                                       ('ref', 'bureau:1024-2-a')])],
+                         result['1024-2-c'])
+        self.assertEqual(['bureau:1024-2-a', 'lender:1024-2-a',
+                          'respa:1024-2-b'],
+                         list(result['referenced'].keys()))
+
+    def test_nested_term_references(self):
+        reg_xml = etree.fromstring("""
+        <section label="1024-2" sectionNum="2" xmlns="eregs">
+          <subject/>
+          <paragraph label="1024-2-a" marker="(a)">
+            <content>Definition of <def term="bureau">Bureau</def>.</content>
+          </paragraph>
+          <paragraph label="1024-2-b" marker="(b)">
+            <content>The <em>x <ref target="1024-2-a" reftype="term">Bureau</ref></em> and the <ref target="1024-2-a" reftype="term">Bureau</ref> again.</content>
+          </paragraph>
+        </section>""")
+        result = build_terms_layer(reg_xml)
+
+        # A ref within another element in the content is still in the
+        # layer, placed at the end of the content's children
+        self.assertEqual([OrderedDict([('offsets', [[32, 38], [19, 25]]),
+                                       ('ref', 'bureau:1024-2-a')])],
+                         result['1024-2-b'])
+
     def test_para_with_defs_offsets(self):
         reg_xml = etree.fromstring("""
         <appendixSection appendixSecNum="1" label="1024-s1" xmlns="eregs">
@@ -749,6 +846,26 @@ class TreeTestCase(TestCase):
         result = build_keyterm_layer(tree)
         self.assertEqual(expected_result, result)
 
+    def test_child_offsets(self):
+        content = etree.fromstring(
+            '<content xmlns="eregs">A <ref target="1234-1">cite</ref> and '
+            '<variable>x</variable><ref target="1234-2">term</ref>'
+            '<ref target="1234-3"/> end.</content>')
+        children = content.getchildren()
+        offsets = child_offsets(content)
+        self.assertEqual([2, 11, 12, 16],
+                         [offsets[child] for child in children])
+        self.assertEqual({}, child_offsets(etree.fromstring(
+            '<content xmlns="eregs">No children.</content>')))
+
+        # Nested elements are placed at the end of the children's text
+        content = etree.fromstring(
+            '<content xmlns="eregs">A <em>b <ref target="1234-1">c</ref>'
+            '</em> d.</content>')
+        offsets = child_offsets(content)
+        self.assertEqual(2, offsets[content[0]])
+        self.assertEqual(7, offsets[content[0][0]])
+
     def test_get_offset(self):
         """ Make sure offsets returned are correct """
         element = etree.fromstring("""
@@ -832,3 +949,88 @@ class TreeTestCase(TestCase):
         </paragraph>""")
         etree.Element('parent').append(intro_text)
         self.assertTrue(is_intro_text(intro_text))
+
+    def test_layer_pipeline_matches_layer_functions(self):
+        """ The single-pass pipeline should produce exactly the same
+            layers as the individual build functions """
+        # The test tree has no cfrTitleNum, so leave out the meta layer
+        builders = [b for b in LAYER_BUILDERS if b is not MetaLayerBuilder]
+        layers = LayerPipeline(builders).run(self.root)
+
+        expected = OrderedDict([
+            ('layer/paragraph-markers', build_paragraph_marker_layer(self.root)),
+            ('layer/internal-citations', build_internal_citations_layer(self.root)),
+            ('layer/external-citations', build_external_citations_layer(self.root)),
+            ('layer/terms', build_terms_layer(self.root)),
+            ('layer/toc', build_toc_layer(self.root)),
+            ('layer/keyterms', build_keyterm_layer(self.root)),
+            ('layer/graphics', build_graphics_layer(self.root)),
+            ('layer/formatting', build_formatting_layer(self.root)),
+            ('layer/interpretations', build_interp_layer(self.root)),
+            ('layer/analyses', build_analysis(self.root)),
+            ('notice', build_notice(self.root)),
+        ])
+        self.assertEqual(list(expected.keys()), list(layers.keys()))
+        for layer_type, layer in expected.items():
+            self.assertEqual(layer, layers[layer_type])
+
+    def test_layer_pipeline_visit_order(self):
+        """ Builders see all elements of their first tag in document
+            order before any element of their second tag """
+        class LabelBuilder(LayerBuilder):
+            layer_type = 'labels'
+            tags = ('{eregs}interpParagraph', '{eregs}paragraph')
+
+            def visit(self, element):
+                self.layer.setdefault('labels', []).append(
+                    element.get('label'))
+
+        class SectionBuilder(LayerBuilder):
+            layer_type = 'sections'
+            tags = ('{eregs}appendixSection',)
+
+            def visit(self, element):
+                self.layer[element.get('label')] = True
+
+        pipeline = LayerPipeline([LabelBuilder])
+        pipeline.register(SectionBuilder)
+        layers = pipeline.run(self.root)
+
+        self.assertEqual(['labels', 'sections'], list(layers.keys()))
+        self.assertEqual(['1234-1-A-Interp', '1234-1-A-Interp-1',
+                          '1234-1-p1', '1234-1-a', '1234-1-a-p1',
+                          '1234-1-a-p2', '1234-A-p1-p1'],
+                         layers['labels']['labels'])
+        self.assertEqual(['1234-A-p1'], list(layers['sections'].keys()))
+
+    def test_formatted_content_cache(self):
+        """ Content is formatted once and shared until invalidated """
+        tree = etree.fromstring("""
+        <paragraph xmlns="eregs" label="foo" marker="">
+          <content>I'm a paragraph with a <variable>Val<subscript>n</subscript></variable> variable.</content>
+        </paragraph>
+        """)
+        content = tree.find('{eregs}content')
+        cache = FormattedContentCache()
+
+        formatted = cache.formatted(content)
+        self.assertIs(formatted, cache.formatted(content))
+        self.assertIsNot(formatted, content)
+        self.assertEqual("I'm a paragraph with a Val_{n} variable.",
+                         cache.text(content))
+
+        # Modifying the tree requires invalidating the modified element
+        content.text = "I'm a modified paragraph with a "
+        cache.invalidate(tree)
+        self.assertIsNot(formatted, cache.formatted(content))
+        self.assertEqual("I'm a modified paragraph with a Val_{n} variable.",
+                         cache.text(content))
+
+    def test_formatted_content_cache_shared(self):
+        """ The reg tree and the layers can share one cache """
+        cache = FormattedContentCache()
+        node = build_reg_tree(self.root, cache=cache)
+        layers = LayerPipeline([TermsLayerBuilder]).run(self.root, cache=cache)
+
+        self.assertEqual(build_reg_tree(self.root).to_json(), node.to_json())
+        self.assertEqual(build_terms_layer(self.root), layers['layer/terms'])
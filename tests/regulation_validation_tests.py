@@ -1,15 +1,20 @@
 # -*- coding: utf-8 -*-
+from collections import OrderedDict
+from copy import deepcopy
 import lxml.etree as etree
 import os
 import settings
 import shutil
 import tempfile
+import time
 
 from git import Repo
+from mock import patch
 from unittest import TestCase
 
+import regulation.validation
 from regulation.validation import (
-    EregsValidationEvent, EregsValidator, Severity
+    EregsValidationEvent, EregsValidator, Severity, get_schema
 )
 
 
@@ -67,6 +72,62 @@ class EregsValidatorTests(TestCase):
         self.assertEqual(validator.events[2].severity, Severity.WARNING)
         self.assertTrue('repeating keyterms' in validator.events[2].msg)
 
+    def test_validate_internal_cites(self):
+        tree = etree.fromstring("""
+        <section xmlns="eregs" label="1234-1">
+          <paragraph label="1234-1-a">
+            <content>See <ref target="1234-1-b" reftype="internal">b</ref>.</content>
+          </paragraph>
+          <paragraph label="1234-1-b">
+            <content>See <ref target="1234-1-c" reftype="internal">c</ref>.</content>
+          </paragraph>
+        </section>
+        """)
+        layer = OrderedDict([
+            ('1234-1-a', [{'citation': ['1234', '1', 'b'],
+                           'offsets': [[4, 5]]}]),
+            ('1234-1-b', [{'citation': ['1234', '1', 'c'],
+                           'offsets': [[4, 5]]}]),
+        ])
+        validator = EregsValidator(settings.XSD_FILE)
+        validator.validate_internal_cites(tree, layer)
+
+        self.assertEqual(len(validator.events), 2)
+        self.assertEqual(validator.events[0].severity, Severity.ERROR)
+        self.assertTrue('NONEXISTENT CITATION' in validator.events[0].msg)
+        self.assertTrue('1234-1-c in 1234-1-b' in validator.events[0].msg)
+        self.assertEqual(validator.events[1].severity, Severity.ERROR)
+
+        validator = EregsValidator(settings.XSD_FILE)
+        validator.validate_internal_cites(
+            tree, layer, labels=frozenset(['1234-1-a', '1234-1-b',
+                                           '1234-1-c']))
+        self.assertEqual(len(validator.events), 1)
+        self.assertEqual(validator.events[0].severity, Severity.OK)
+
+    def test_fix_omitted_cites_returns_whether_saved(self):
+        tree = etree.fromstring("""
+        <section xmlns="eregs" label="1234-1">
+          <paragraph label="1234-1-a">
+            <content>See 1234.1(b).</content>
+          </paragraph>
+        </section>
+        """)
+        regulation_file = os.path.join(self.schemadir, 'fixed.xml')
+        validator = EregsValidator(settings.XSD_FILE)
+
+        with patch('__builtin__.raw_input', side_effect=['y', 'n']):
+            self.assertFalse(validator.fix_omitted_cites(
+                deepcopy(tree), regulation_file))
+        self.assertFalse(os.path.exists(regulation_file))
+
+        with patch('__builtin__.raw_input', side_effect=['y', 'y']):
+            self.assertTrue(validator.fix_omitted_cites(
+                tree, regulation_file))
+        with open(regulation_file) as f:
+            self.assertTrue('<ref target="1234-1-b" reftype="internal">'
+                            '1234.1(b)</ref>' in f.read())
+
     def test_migrate_analysis_reg(self):
         tree = etree.fromstring("""
             <regulation xmlns="eregs" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="eregs ../../eregs.xsd">
@@ -247,3 +308,110 @@ class EregsValidatorTests(TestCase):
         validator.validate_reg(xml)
         self.assertFalse(validator.is_valid)
         self.assertTrue(validator.has_critical_errors)
+
+
+class SchemaCacheTests(TestCase):
+    XSD = """<?xml version="1.0"?>
+<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema"
+           targetNamespace="eregs" xmlns="eregs"
+           elementFormDefault="qualified">
+  <xs:element name="{}" type="xs:string"/>
+</xs:schema>"""
+
+    def setUp(self):
+        regulation.validation._schema_cache.clear()
+        self.tempdir = tempfile.mkdtemp()
+        self.xsd_file = os.path.join(self.tempdir, 'eregs.xsd')
+        self.cache_dir = os.path.join(self.tempdir, 'cache')
+        self.write_xsd('regulation')
+
+    def tearDown(self):
+        regulation.validation._schema_cache.clear()
+        shutil.rmtree(self.tempdir, ignore_errors=True)
+
+    def write_xsd(self, element, mtime=None):
+        with open(self.xsd_file, 'w') as f:
+            f.write(self.XSD.format(element))
+        if mtime is not None:
+            os.utime(self.xsd_file, (mtime, mtime))
+
+    def test_schema_is_compiled_once(self):
+        schema = get_schema(self.xsd_file)
+        self.assertIs(schema, get_schema(self.xsd_file))
+        self.assertIs(schema, EregsValidator(self.xsd_file).schema)
+
+    def test_schema_is_compiled_again_when_changed(self):
+        self.write_xsd('regulation', mtime=1000000000)
+        schema = get_schema(self.xsd_file)
+        self.assertTrue(schema.validate(
+            etree.fromstring('<regulation xmlns="eregs"/>')))
+
+        self.write_xsd('notice', mtime=1000000001)
+        schema = get_schema(self.xsd_file)
+        self.assertFalse(schema.validate(
+            etree.fromstring('<regulation xmlns="eregs"/>')))
+        self.assertTrue(schema.validate(
+            etree.fromstring('<notice xmlns="eregs"/>')))
+
+    def test_schema_copy(self):
+        get_schema(self.xsd_file, cache_dir=self.cache_dir)
+        self.assertEqual(1, len(os.listdir(self.cache_dir)))
+
+        regulation.validation._schema_cache.clear()
+        with patch('regulation.validation.etree.XMLSchema',
+                   wraps=etree.XMLSchema) as xml_schema:
+            schema = get_schema(self.xsd_file, cache_dir=self.cache_dir)
+            self.assertNotIn('file', xml_schema.call_args[1])
+        self.assertTrue(schema.validate(
+            etree.fromstring('<regulation xmlns="eregs"/>')))
+
+    def test_schema_copy_includes(self):
+        """ Included XSD documents are copied too, and a change to one
+            replaces the copies """
+        include_file = os.path.join(self.tempdir, 'include.xsd')
+        with open(include_file, 'w') as f:
+            f.write(self.XSD.format('regulation'))
+        os.utime(include_file, (1000000000, 1000000000))
+        with open(self.xsd_file, 'w') as f:
+            f.write(self.XSD.format('notice').replace(
+                '<xs:element', '<xs:include schemaLocation="include.xsd"/>'
+                '<xs:element'))
+        get_schema(self.xsd_file, cache_dir=self.cache_dir)
+
+        regulation.validation._schema_cache.clear()
+        with patch('regulation.validation.etree.parse') as parse:
+            schema = get_schema(self.xsd_file, cache_dir=self.cache_dir)
+        self.assertFalse(parse.called)
+        self.assertTrue(schema.validate(
+            etree.fromstring('<regulation xmlns="eregs"/>')))
+
+        with open(include_file, 'w') as f:
+            f.write(self.XSD.format('analysis'))
+        regulation.validation._schema_cache.clear()
+        schema = get_schema(self.xsd_file, cache_dir=self.cache_dir)
+        self.assertFalse(schema.validate(
+            etree.fromstring('<regulation xmlns="eregs"/>')))
+        self.assertTrue(schema.validate(
+            etree.fromstring('<analysis xmlns="eregs"/>')))
+
+    def test_remote_schema_copy_expires(self):
+        url = 'http://example.com/eregs.xsd'
+        key = (url, None)
+        documents = {url: self.XSD.format('regulation').encode('utf-8')}
+
+        regulation.validation._save_schema_copy(
+            self.cache_dir, key, documents, time.time() - 60)
+        schema = regulation.validation._load_schema_copy(
+            self.cache_dir, key, 3600)
+        self.assertTrue(schema.validate(
+            etree.fromstring('<regulation xmlns="eregs"/>')))
+
+        regulation.validation._save_schema_copy(
+            self.cache_dir, key, documents, time.time() - 7200)
+        self.assertEqual(None, regulation.validation._load_schema_copy(
+            self.cache_dir, key, 3600))
+
+    def test_load_schema_raises_if_local_schema_does_not_exist(self):
+        with self.assertRaises(etree.XMLSchemaParseError):
+            get_schema(os.path.join(self.tempdir, 'missing.xsd'),
+                       cache_dir=self.cache_dir)
@@ -1,10 +1,12 @@
 import os
-from tempfile import NamedTemporaryFile
+import shutil
+from tempfile import NamedTemporaryFile, mkdtemp
 from unittest import TestCase
 
+from lxml import etree
 from mock import Mock, patch
 
-from regml import validate
+from regml import validate, generate_json_job, TreeWriter
 
 
 class TestValidateCommand(TestCase):
@@ -47,3 +49,76 @@ class TestValidateCommand(TestCase):
                 self.assertEqual(e.code, 1)
             else:
                 self.fail('invalid files should exit with code 1')
+
+
+class TestGenerateJsonJob(TestCase):
+    def test_output_is_captured(self):
+        def generate_json(regulation_file, check_terms=False, compact=False):
+            print('writing {}'.format(regulation_file))
+            return '1234', '2015-12345', None
+
+        with patch('regml.generate_json', side_effect=generate_json):
+            output, result, exit_code = generate_json_job(
+                ('1234/2015-12345.xml', False, False))
+
+        self.assertEqual('writing 1234/2015-12345.xml\n', output)
+        self.assertEqual(('1234', '2015-12345'), result)
+        self.assertIsNone(exit_code)
+
+    def test_exit_is_returned(self):
+        with patch('regml.generate_json', side_effect=SystemExit(1)):
+            output, result, exit_code = generate_json_job(
+                ('1234/2015-12345.xml', False, False))
+
+        self.assertIsNone(result)
+        self.assertEqual(1, exit_code)
+
+    def test_error_is_returned(self):
+        with patch('regml.generate_json', side_effect=ValueError('bad')):
+            output, result, exit_code = generate_json_job(
+                ('1234/2015-12345.xml', False, False))
+
+        self.assertIsNone(result)
+        self.assertEqual(1, exit_code)
+        self.assertIn('ValueError: bad', output)
+
+
+class TestTreeWriter(TestCase):
+    def setUp(self):
+        self.tempdir = mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_trees_are_written(self):
+        writer = TreeWriter()
+        for version in ['2015-12345', '2016-12345']:
+            writer.write(os.path.join(self.tempdir, version + '.xml'),
+                         etree.fromstring(
+                             '<regulation xmlns="eregs">{}</regulation>'
+                             .format(version)))
+        writer.close()
+
+        for version in ['2015-12345', '2016-12345']:
+            with open(os.path.join(self.tempdir, version + '.xml')) as f:
+                xml = f.read()
+            self.assertTrue(xml.startswith("<?xml version='1.0'"))
+            self.assertEqual(version, etree.fromstring(xml).text)
+
+    def test_trees_are_serialized_when_given(self):
+        writer = TreeWriter()
+        path = os.path.join(self.tempdir, '2015-12345.xml')
+        xml_tree = etree.fromstring('<regulation xmlns="eregs">old</regulation>')
+        writer.write(path, xml_tree)
+        xml_tree.text = 'new'
+        writer.close()
+
+        with open(path) as f:
+            self.assertEqual('old', etree.fromstring(f.read()).text)
+
+    def test_error_is_raised(self):
+        writer = TreeWriter()
+        writer.write(os.path.join(self.tempdir, 'missing', '2015-12345.xml'),
+                     etree.fromstring('<regulation xmlns="eregs"/>'))
+        with self.assertRaises(IOError):
+            writer.close()
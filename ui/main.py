@@ -5,13 +5,13 @@ import tkFileDialog
 import tkMessageBox
 import tkSimpleDialog
 import ttk
-import inflect
 import cPickle
 
 from lxml import etree
 from notice import Notice
 from regml import find_all
-from regulation.node import find_all_occurrences, enclosed_in_tag, interpolate_string
+from regulation import inflection
+from regulation.node import find_all_occurrences, interpolate_string, TagSpans
 from operator import itemgetter
 from itertools import chain
 
@@ -65,7 +65,6 @@ class EregsApp(tk.Frame):
         self.terms = []
         self.always_fix = set()
         self.never_fix = set()
-        self.inf = inflect.engine()
         self.initialize_gui()
         self.work_state_filename = None
 
@@ -377,10 +376,11 @@ class EregsApp(tk.Frame):
         label = self.current_node.get('label')
         self.terms = []
         self.unmarked_defs.delete(0, tk.END)
+        spans = TagSpans(node_text)
 
         for term, def_label, _ in self.gather_defined_terms():
             term_locations = set(find_all_occurrences(node_text, term))
-            plural_term = self.inf.plural(term)
+            plural_term = inflection.plural(term)
             plural_term_locations = set(find_all_occurrences(node_text, plural_term))
             unmarked_locs = list(plural_term_locations | term_locations ^ plural_term_locations)
             for start in unmarked_locs:
@@ -392,10 +392,10 @@ class EregsApp(tk.Frame):
                 start_index = '1.0 + {} chars'.format(start)
                 end_index = '1.0 + {} chars'.format(end)
 
-                if not enclosed_in_tag(node_text, 'ref', start) and \
-                        not enclosed_in_tag(node_text, 'def', start) and \
-                        not enclosed_in_tag(node_text, 'title', start) and \
-                        not enclosed_in_tag(node_text, 'subject', start):
+                if not spans.encloses('ref', start) and \
+                        not spans.encloses('def', start) and \
+                        not spans.encloses('title', start) and \
+                        not spans.encloses('subject', start):
                     term_data = (term_to_use, start, end, start_index, end_index, def_label)
                     if term_data not in self.terms:
                         self.terms.append(term_data)
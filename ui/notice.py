@@ -2,7 +2,7 @@ from dateutil import parser as date_parser
 
 from lxml import etree
 
-from inflect import engine
+from regulation import inflection
 
 from operator import itemgetter
 
@@ -40,12 +40,11 @@ class Notice:
 
         definitions = self.tree.findall('.//{eregs}def')
         self.terms = []
-        inf = engine()
 
         for defn in definitions:
             defined_in = defn.find('../..').get('label')
             term = defn.get('term')
-            plural = inf.plural(term)
+            plural = inflection.plural(term)
             self.terms.append((term, defined_in, self.document_number))
             self.terms.append((plural, defined_in, self.document_number))
 